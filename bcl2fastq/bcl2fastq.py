@@ -14,6 +14,8 @@ import os
 import argparse
 import logging
 import subprocess
+import copy
+from concurrent.futures import ThreadPoolExecutor
 
 #--- third-party imports
 #
@@ -38,6 +40,8 @@ from pipelines import default_argparser
 from config import site_cfg
 from utils import generate_timestamp
 from generate_bcl2fastq_cfg import MUXINFO_CFG, SAMPLESHEET_CSV, USEBASES_CFG, MuxUnit
+from generate_bcl2fastq_cfg import generate_bcl2fastq_cfg
+from elm import get_client
 
 
 __author__ = "Andreas Wilm"
@@ -56,6 +60,9 @@ CFG_DIR = os.path.join(PIPELINE_BASEDIR, "cfg")
 # same as folder name. also used for cluster job names
 PIPELINE_NAME = "bcl2fastq"
 
+# max. number of runs set up in parallel (batch mode)
+DEFAULT_MAX_PARALLEL = 8
+
 
 # global logger
 logger = logging.getLogger(__name__)
@@ -151,8 +158,7 @@ def seqrunfailed(mongo_status_script, run_num, outdir, testing):
         logger.fatal("The following command failed with return code %s: %s",
                      e.returncode, ' '.join(mongo_update_cmd))
         logger.fatal("Output: %s", e.output.decode())
-        logger.fatal("Exiting")
-        sys.exit(1)
+        raise
 
     flagfile = os.path.join(outdir, "SEQRUNFAILED")
     logger.info("Creating flag file %s", flagfile)
@@ -160,96 +166,24 @@ def seqrunfailed(mongo_status_script, run_num, outdir, testing):
         pass
 
 
-def main():
-    """main function
+def setup_run(args, rundir, lane_info, lane_nos, mongo_status_script):
+    """Creates output directory and configs for one run and submits
+    the pipeline. args are the parsed wrapper arguments (args.outdir
+    might be None). Returns output directory.
     """
 
-    # FIXME ugly and code duplication in bcl2fastq_dbupdate.py
-    mongo_status_script = os.path.abspath(os.path.join(
-        os.path.dirname(sys.argv[0]), "mongo_status.py"))
-    assert os.path.exists(mongo_status_script)
-    
-    default_parser = default_argparser(CFG_DIR, allow_missing_cfgfile=True, allow_missing_outdir=True)
-    parser = argparse.ArgumentParser(description=__doc__.format(
-        PIPELINE_NAME=PIPELINE_NAME, PIPELINE_VERSION=get_pipeline_version()),
-                                     parents=[default_parser])
-    parser._optionals.title = "Arguments"
-    # pipeline specific args
-    parser.add_argument('-r', "--runid",
-                        help="Run ID plus flowcell ID (clashes with -d)")
-    parser.add_argument('-d', "--rundir",
-                        help="BCL input directory (clashes with -r)")
-    parser.add_argument('-t', "--testing", action='store_true',
-                        help="Use MongoDB test server")
-    parser.add_argument('--no-archive', action='store_true',
-                        help="Don't archieve this analysis")
-    parser.add_argument('-l', '--lanes', type=int, nargs="*",
-                        help="Limit run to given lane/s (multiples separated by space")
-    parser.add_argument('-i', '--mismatches', type=int,
-                        help="Max. number of allowed barcode mismatches (0>=x<=2)"
-                        " setting a value here overrides the default settings read from ELM)")
-
-    args = parser.parse_args()
-
-    # Repeateable -v and -q for setting logging level.
-    # See https://www.reddit.com/r/Python/comments/3nctlm/what_python_tools_should_i_be_using_on_every/
-    # and https://gist.github.com/andreas-wilm/b6031a84a33e652680d4
-    # script -vv -> DEBUG
-    # script -v -> INFO
-    # script -> WARNING
-    # script -q -> ERROR
-    # script -qq -> CRITICAL
-    # script -qqq -> no logging at all
-    logger.setLevel(logging.WARN + 10*args.quiet - 10*args.verbose)
-    aux_logger.setLevel(logging.WARN + 10*args.quiet - 10*args.verbose)
-
-    if args.mismatches is not None:
-        if args.mismatches > 2 or args.mismatches < 0:
-            logger.fatal("Number of mismatches must be between 0-2")
-            sys.exit(1)
-
-    lane_info = ''
-    lane_nos = []
-    if args.lanes:
-        lane_info = '--tiles '
-        for lane in args.lanes:
-            if lane > 8 or lane < 1:
-                logger.fatal("Lane number must be between 1-8")
-                sys.exit(1)
-            else:
-                lane_info += 's_{}'.format(lane)+','
-        lane_info = lane_info.rstrip()
-        lane_info = lane_info[:-1]
-        lane_nos = list(args.lanes)
-
-
-    if args.runid and args.rundir:
-        logger.fatal("Cannot use run-id and input directory arguments simultaneously")
-        sys.exit(1)
-    elif args.runid:
-        rundir = run_folder_for_run_id(args.runid)
-    elif args.rundir:
-        rundir = os.path.abspath(args.rundir)
-    else:
-        logger.fatal("Need either run-id or input directory")
-        sys.exit(1)
-    if not os.path.exists(rundir):
-        logger.fatal("Expected run directory %s does not exist", rundir)
-    logger.info("Rundir is %s", rundir)
-
+    args = copy.copy(args)# outdir is set per run
     if not args.outdir:
-        outdir = get_bcl2fastq_outdir(args.runid)
+        outdir = get_bcl2fastq_outdir(rundir)
         args.outdir = outdir
     else:
         outdir = args.outdir
     if os.path.exists(outdir):
-        logger.fatal("Output directory %s already exists", outdir)
-        sys.exit(1)
-    # create now so that generate_bcl2fastq_cfg.py can run
+        raise ValueError("Output directory {} already exists".format(outdir))
+    # create now so that bcl2fastq configs can be written
     os.makedirs(outdir)
 
 
-
     # catch cases where rundir was user provided and looks weird
     try:
         _, runid, flowcellid = get_machine_run_flowcell_id(rundir)
@@ -258,41 +192,23 @@ def main():
         run_num = "UNKNOWN-" + rundir.split("/")[-1]
 
 
-    # call generate_bcl2fastq_cfg
+    # generate bcl2fastq configs from ELM info (in-process)
     #
-    # FIXME ugly assumes same directory (just like import above). better to import and run main()?
-    generate_bcl2fastq = os.path.join(
-        os.path.dirname(sys.argv[0]), "generate_bcl2fastq_cfg.py")
-    assert os.path.exists(generate_bcl2fastq)
-    cmd = [generate_bcl2fastq, '-r', rundir, '-o', outdir]
-    if args.testing:
-        cmd.append("-t")
-    logger.debug("Executing %s", ' ' .join(cmd))
-    try:
-        res = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
-    except subprocess.CalledProcessError as e:
-        logger.fatal("The following command failed with return code %s: %s",
-                     e.returncode, ' '.join(cmd))
-        logger.fatal("Output: %s", e.output.decode())
-        logger.fatal("Exiting")
-        sys.exit(1)
-    # generate_bcl2fastq is normally quiet. if there's output, make caller aware of it
-    # use sys instead of logger to avoid double logging
-    if res:
-        sys.stderr.write(res.decode())
+    logger.debug("Generating bcl2fastq config for %s in %s", rundir, outdir)
+    generate_bcl2fastq_cfg(rundir, outdir, test_server=args.testing)
 
     # just created files
     muxinfo_cfg = os.path.join(outdir, MUXINFO_CFG)
     samplesheet_csv = os.path.join(outdir, SAMPLESHEET_CSV)
     usebases_cfg = os.path.join(outdir, USEBASES_CFG)
 
-    # NOTE: signal for failed runs is exit 0 from generate_bcl2fastq and missing output files
+    # NOTE: signal for failed runs is missing output files
     #
     if any([not os.path.exists(x) for x in [muxinfo_cfg, samplesheet_csv, usebases_cfg]]):
         # one missing means all should be missing
         assert all([not os.path.exists(x) for x in [muxinfo_cfg, samplesheet_csv, usebases_cfg]])
         seqrunfailed(mongo_status_script, run_num, outdir, args.testing)
-        sys.exit(0)
+        return outdir
 
 
     # turn arguments into cfg_dict that gets merged into pipeline config
@@ -300,6 +216,7 @@ def main():
                 'lanes_arg': lane_info,
                 'samplesheet_csv': samplesheet_csv,
                 'no_archive': args.no_archive,
+                'lane_grouped': args.lane_grouped,
                 'run_num': run_num}
 
 
@@ -349,6 +266,118 @@ def main():
 
     pipeline_handler.setup_env()
     pipeline_handler.submit(args.no_run)
+    return outdir
+
+
+def main():
+    """main function
+    """
+
+    # FIXME ugly and code duplication in bcl2fastq_dbupdate.py
+    mongo_status_script = os.path.abspath(os.path.join(
+        os.path.dirname(sys.argv[0]), "mongo_status.py"))
+    assert os.path.exists(mongo_status_script)
+    
+    default_parser = default_argparser(CFG_DIR, allow_missing_cfgfile=True, allow_missing_outdir=True)
+    parser = argparse.ArgumentParser(description=__doc__.format(
+        PIPELINE_NAME=PIPELINE_NAME, PIPELINE_VERSION=get_pipeline_version()),
+                                     parents=[default_parser])
+    parser._optionals.title = "Arguments"
+    # pipeline specific args
+    parser.add_argument('-r', "--runid", nargs="+",
+                        help="Run ID plus flowcell ID (clashes with -d)."
+                        " Multiple runs are set up in parallel (requires automatic output directory)")
+    parser.add_argument('-d', "--rundir",
+                        help="BCL input directory (clashes with -r)")
+    parser.add_argument('-t', "--testing", action='store_true',
+                        help="Use MongoDB test server")
+    parser.add_argument('--no-archive', action='store_true',
+                        help="Don't archieve this analysis")
+    parser.add_argument('-l', '--lanes', type=int, nargs="*",
+                        help="Limit run to given lane/s (multiples separated by space")
+    parser.add_argument('-i', '--mismatches', type=int,
+                        help="Max. number of allowed barcode mismatches (0>=x<=2)"
+                        " setting a value here overrides the default settings read from ELM)")
+    parser.add_argument('--lane-grouped', action='store_true',
+                        help="Run bcl2fastq once per group of MUXes sharing lanes"
+                        " instead of once per MUX")
+    parser.add_argument('--max-parallel', type=int, default=DEFAULT_MAX_PARALLEL,
+                        help="Max. number of runs to set up in parallel (default: {})".format(
+                            DEFAULT_MAX_PARALLEL))
+
+    args = parser.parse_args()
+
+    # Repeateable -v and -q for setting logging level.
+    # See https://www.reddit.com/r/Python/comments/3nctlm/what_python_tools_should_i_be_using_on_every/
+    # and https://gist.github.com/andreas-wilm/b6031a84a33e652680d4
+    # script -vv -> DEBUG
+    # script -v -> INFO
+    # script -> WARNING
+    # script -q -> ERROR
+    # script -qq -> CRITICAL
+    # script -qqq -> no logging at all
+    logger.setLevel(logging.WARN + 10*args.quiet - 10*args.verbose)
+    aux_logger.setLevel(logging.WARN + 10*args.quiet - 10*args.verbose)
+
+    if args.mismatches is not None:
+        if args.mismatches > 2 or args.mismatches < 0:
+            logger.fatal("Number of mismatches must be between 0-2")
+            sys.exit(1)
+
+    lane_info = ''
+    lane_nos = []
+    if args.lanes:
+        lane_info = '--tiles '
+        for lane in args.lanes:
+            if lane > 8 or lane < 1:
+                logger.fatal("Lane number must be between 1-8")
+                sys.exit(1)
+            else:
+                lane_info += 's_{}'.format(lane)+','
+        lane_info = lane_info.rstrip()
+        lane_info = lane_info[:-1]
+        lane_nos = list(args.lanes)
+
+
+    if args.runid and args.rundir:
+        logger.fatal("Cannot use run-id and input directory arguments simultaneously")
+        sys.exit(1)
+    elif args.runid:
+        rundirs = [run_folder_for_run_id(r) for r in args.runid]
+    elif args.rundir:
+        rundirs = [os.path.abspath(args.rundir)]
+    else:
+        logger.fatal("Need either run-id or input directory")
+        sys.exit(1)
+    if len(rundirs) > 1 and args.outdir:
+        logger.fatal("Output directory can only be given for a single run")
+        sys.exit(1)
+    for rundir in rundirs:
+        if not os.path.exists(rundir):
+            logger.fatal("Expected run directory %s does not exist", rundir)
+        logger.info("Rundir is %s", rundir)
+
+    # ELM queries and setup of runs in parallel, sharing one ELM
+    # client (and thereby HTTP connection pool)
+    num_workers = max(1, min(args.max_parallel, len(rundirs)))
+    get_client(args.testing, poolsize=num_workers)
+    num_failed = 0
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        futures = [(rundir, executor.submit(
+            setup_run, args, rundir, lane_info, lane_nos, mongo_status_script))
+                   for rundir in rundirs]
+        for rundir, future in futures:
+            try:
+                outdir = future.result()
+            except Exception as e:
+                logger.fatal("Setting up run %s failed: %s", rundir, e)
+                num_failed += 1
+            else:
+                logger.info("Run %s set up in %s", rundir, outdir)
+
+    if num_failed:
+        logger.fatal("%d of %d runs failed. Exiting", num_failed, len(rundirs))
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -11,7 +11,6 @@ import sys
 import os
 import argparse
 import logging
-import subprocess
 from datetime import datetime
 
 #--- third-party imports
@@ -28,8 +27,12 @@ LIB_PATH = os.path.abspath(
 if LIB_PATH not in sys.path:
     sys.path.insert(0, LIB_PATH)
 from mongodb import mongodb_conn
+from mongodb import update_run_status
+from mongodb import update_mux_statuses
 from pipelines import generate_window
+from pipelines import is_production_user
 from pipelines import PipelineHandler
+from utils import generate_timestamp
 from utils import timestamp_from_string
 
 
@@ -43,6 +46,9 @@ DBUPDATE_TRIGGER_FILE_FMT = "TRIGGER.DBUPDATE.{num}"
 # up to DBUPDATE_TRIGGER_FILE_MAXNUM trigger files allowed
 DBUPDATE_TRIGGER_FILE_MAXNUM = 9
 
+# user name recorded for analyses (as in mongo_status.py)
+PRODUCTION_USER = "userrig"
+
 
 BASEDIR = os.path.dirname(sys.argv[0])
 
@@ -57,84 +63,44 @@ logger.addHandler(handler)
 
 
 class MongoUpdate(object):
-    """Helper class for mongodb updates
+    """Helper class for mongodb updates. Updates are done in process
+    on the given runcomplete collection (shared between instances)
     """
 
-    def __init__(self, run_num, analysis_id, testing=False, dryrun=False):
+    def __init__(self, db, run_num, analysis_id, dryrun=False):
+        self.db = db
         self.run_num = run_num
         self.analysis_id = analysis_id
-        self.testing = testing
         self.dryrun = dryrun
 
-        mongo_status_script = os.path.abspath(os.path.join(
-            os.path.dirname(sys.argv[0]), "mongo_status.py"))
-        assert os.path.exists(mongo_status_script), (
-            "Missing {}".format(mongo_status_script))
-        self.mongo_status_script = mongo_status_script
-
-        mongo_status_per_mux_script = os.path.abspath(os.path.join(
-            os.path.dirname(sys.argv[0]), "mongo_status_per_mux.py"))
-        assert os.path.exists(mongo_status_per_mux_script), (
-            "Missing {}".format(mongo_status_per_mux_script))
-        self.mongo_status_per_mux_script = mongo_status_per_mux_script
-
 
     def update_run(self, status, outdir):
         """update status for run
         """
         logger.info("Updating status for run %s analysis %s to %s",
-                    self.analysis_id, self.run_num, status)
-        cmd = [self.mongo_status_script, '-r', self.run_num,
-               '-a', self.analysis_id, '-s', status, '-o', outdir]
-
-        if self.testing:
-            cmd.append("-t")
-        if self.dryrun:
-            cmd.append("--dry-run")
-
-        try:
-            _ = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
-        except subprocess.CalledProcessError as e:
-            logger.critical("The following command failed with return code %s: %s",
-                            e.returncode, ' '.join(cmd))
-            logger.critical("Output: %s", e.output.decode())
-            return False
-        else:
-            return True
-
-
-    def update_mux(self, status, mux_id, mux_dir):
-        """update status for mux
+                    self.run_num, self.analysis_id, status)
+        end_time = None
+        if status in ["SUCCESS", "FAILED"]:
+            end_time = generate_timestamp()
+        return update_run_status(self.db, self.run_num, self.analysis_id,
+                                 status, outdir, PRODUCTION_USER,
+                                 end_time=end_time, dry_run=self.dryrun)
+
+
+    def update_muxes(self, mux_statuses):
+        """update status for all (mux_id, mux_dir, status) in
+        mux_statuses with one bulk write. returns list of mux_ids
+        that failed to update
         """
-        logger.info("Updating status for mux %s of analysis %s in run %s to %s",
-                    mux_id, self.analysis_id, self.run_num, status)
-        cmd = [self.mongo_status_per_mux_script, '-r', self.run_num,
-               '-a', self.analysis_id, '-s', status,
-               '-i', mux_id, '-d', mux_dir]
-
-        if self.testing:
-            cmd.append("-t")
-        if self.dryrun:
-            cmd.append("--dry-run")
-
-        try:
-            _ = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
-        except subprocess.CalledProcessError as e:
-            logger.critical("The following command failed with return code %s: %s",
-                            e.returncode, ' '.join(cmd))
-            logger.critical("Output: %s", e.output.decode())
-            return False
-        else:
-            return True
-
+        logger.info("Updating status for %d muxes of analysis %s in run %s",
+                    len(mux_statuses), self.analysis_id, self.run_num)
+        return update_mux_statuses(self.db, self.run_num, self.analysis_id,
+                                   mux_statuses, dry_run=self.dryrun)
 
-def get_started_outdirs_from_db(testing=True, win=None):
-    """FIXME:add-doc"""
-    connection = mongodb_conn(testing)
-    if connection is None:
-        sys.exit(1)
 
-    db = connection.gisds.runcomplete
+def get_started_outdirs_from_db(db, win=None):
+    """yield output directories of started analyses in runcomplete
+    collection db"""
 
     if win:
         epoch_present, epoch_back = generate_window(win)
@@ -181,12 +147,6 @@ def mux_dir_complete(muxdir, completed_after=None):
 def main():
     """main function
     """
-    # FIXME ugly and duplicated in bcl2fastq.py
-    mongo_status_per_mux_script = os.path.abspath(os.path.join(
-        os.path.dirname(sys.argv[0]), "mongo_status_per_mux.py"))
-    assert os.path.exists(mongo_status_per_mux_script)
-    assert os.path.exists(mongo_status_per_mux_script)
-
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument('-t', "--testing", action='store_true',
                         help="Use MongoDB test server")
@@ -214,12 +174,22 @@ def main():
     # script -qqq -> no logging at all
     logger.setLevel(logging.WARN + 10*args.quiet - 10*args.verbose)
 
+    if not args.dry_run and not is_production_user():
+        logger.warning("Not a production user. Skipping MongoDB update")
+        sys.exit(1)
+
+    # one connection for all updates
+    connection = mongodb_conn(args.testing)
+    if connection is None:
+        sys.exit(1)
+    db = connection.gisds.runcomplete
+
     if args.outdirs:
         logger.warning("Using manually defined outdirs")
         outdirs = args.outdirs
     else:
         # generator!
-        outdirs = get_started_outdirs_from_db(args.testing, args.win)
+        outdirs = get_started_outdirs_from_db(db, args.win)
 
     num_triggers = 0
     for outdir in outdirs:
@@ -248,9 +218,8 @@ def main():
             with open(trigger_file) as fh:
                 update_info = yaml.safe_load(fh)
 
-            mongo_updater = MongoUpdate(update_info['run_num'],
-                                        update_info['analysis_id'],
-                                        args.testing, args.dry_run)
+            mongo_updater = MongoUpdate(db, update_info['run_num'],
+                                        update_info['analysis_id'], args.dry_run)
 
             res = mongo_updater.update_run(update_info['status'], outdir)
             if not res:
@@ -261,7 +230,7 @@ def main():
 
             # update per MUX
             #
-            keep_trigger = False
+            mux_statuses = []
             for mux_id, mux_dir_base in muxes.items():
                 mux_dir = os.path.join(outdir, "out", mux_dir_base)# ugly
                 if mux_dir_complete(mux_dir):
@@ -276,18 +245,21 @@ def main():
                         status = 'SUCCESS'
                 else:
                     status = 'FAILED'
+                mux_statuses.append((mux_id, mux_dir_base, status))
 
-                res = mongo_updater.update_mux(status, mux_id, mux_dir_base)
-                if not res:
-                    # don't delete trigger. try again later
-                    logger.critical("Skipping rest of analysis %s for run %s",
-                                    update_info['analysis_id'], update_info['run_num'])
-                    keep_trigger = True
-                    break
+            failed_muxes = mongo_updater.update_muxes(mux_statuses)
+            keep_trigger = False
+            if failed_muxes:
+                # don't delete trigger. try again later
+                logger.critical("Update failed for muxes %s of analysis %s for run %s",
+                                ", ".join(failed_muxes), update_info['analysis_id'],
+                                update_info['run_num'])
+                keep_trigger = True
 
             if not args.dry_run and not keep_trigger:
                 os.unlink(trigger_file)
     logger.info("%s dirs with triggers", num_triggers)
+    connection.close()
 
 if __name__ == "__main__":
     main()
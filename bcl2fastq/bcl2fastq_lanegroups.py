@@ -0,0 +1,151 @@
+"""Lane-grouped bcl2fastq execution
+
+Per default bcl2fastq runs once per MUX, restricted to the MUX's
+lanes. Since the sample sheet covers the whole run, MUXes sharing a
+lane decode the same tiles more than once. In lane-grouped mode MUXes
+sharing lanes are grouped, bcl2fastq runs once per (disjoint) lane
+group with a sample sheet restricted to the group's lanes and the
+stats and reports are then fanned out into the per-MUX directories.
+"""
+
+#--- standard library imports
+#
+import os
+import json
+import shutil
+from collections import OrderedDict
+
+#--- third-party imports
+#
+#/
+
+#--- project specific imports
+#
+#/
+
+
+__author__ = "Andreas Wilm"
+__email__ = "wilma@gis.a-star.edu.sg"
+__copyright__ = "2017 Genome Institute of Singapore"
+__license__ = "The MIT License (MIT)"
+
+
+LANE_GROUP_PREFIX = "LaneGroup_"
+# written to lane group dir on success
+LANE_GROUP_FLAG = "bcl2fastq_lanegroup.SUCCESS"
+STATS_JSON = "Stats.json"
+
+
+def lane_groups(units):
+    """return lane groups for units (as in conf.yaml) as ordered dict
+    with group name as key and dict with keys lane_ids, mux_dirs and
+    barcode_mismatches as values. MUXes sharing lanes end up in the
+    same group, so groups don't share lanes. The exception are MUXes
+    sharing lanes but with different barcode_mismatches, which can't be
+    run together. These get a group of their own (as in per-MUX mode)
+    """
+    # connected components of MUXes via shared lanes
+    components = []
+    for mux_dir, unit in sorted(units.items()):
+        lanes = set(str(l) for l in unit['lane_ids'])
+        mux_dirs = [mux_dir]
+        for comp in [c for c in components if c[0] & lanes]:
+            components.remove(comp)
+            lanes |= comp[0]
+            mux_dirs.extend(comp[1])
+        components.append((lanes, mux_dirs))
+
+    groups = OrderedDict()
+    for lanes, mux_dirs in sorted(components, key=lambda c: sorted(c[0])):
+        mismatches = set(units[m]['barcode_mismatches'] for m in mux_dirs)
+        if len(mismatches) == 1:
+            split = [(sorted(lanes, key=int), sorted(mux_dirs))]
+        else:
+            split = [(sorted([str(l) for l in units[m]['lane_ids']], key=int), [m])
+                     for m in sorted(mux_dirs)]
+        for group_lanes, group_mux_dirs in split:
+            name = LANE_GROUP_PREFIX + "_".join(group_lanes)
+            if len(split) > 1:
+                name += "_" + group_mux_dirs[0]
+            groups[name] = {'lane_ids': group_lanes,
+                            'mux_dirs': group_mux_dirs,
+                            'barcode_mismatches': units[group_mux_dirs[0]]['barcode_mismatches']}
+    return groups
+
+
+def group_for_mux_dir(groups, mux_dir):
+    """return name of lane group containing mux_dir"""
+    for name, group in groups.items():
+        if mux_dir in group['mux_dirs']:
+            return name
+    raise KeyError(mux_dir)
+
+
+def write_lane_group_samplesheet(samplesheet, lane_ids, outfile):
+    """copy samplesheet to outfile keeping only [Data] rows for
+    lane_ids. everything else is kept as is
+    """
+    lane_ids = set(str(l) for l in lane_ids)
+    in_data = False
+    lane_col = None
+    with open(samplesheet) as fh_in, open(outfile, 'w') as fh_out:
+        for line in fh_in:
+            if line.startswith('['):
+                in_data = line.strip().startswith('[Data]')
+                lane_col = None
+                fh_out.write(line)
+                continue
+            if in_data and line.strip():
+                fields = line.rstrip('\r\n').split(',')
+                if lane_col is None:
+                    # header
+                    lane_col = fields.index('Lane') if 'Lane' in fields else -1
+                elif lane_col >= 0 and fields[lane_col] not in lane_ids:
+                    continue
+            fh_out.write(line)
+
+
+def restrict_stats_json(stats_json, lane_ids, outfile):
+    """write bcl2fastq's stats_json restricted to lane_ids to outfile
+    """
+    lane_ids = set(int(l) for l in lane_ids)
+    with open(stats_json) as fh:
+        stats = json.load(fh, object_pairs_hook=OrderedDict)
+    for key in ['ConversionResults', 'UnknownBarcodes']:
+        if key in stats:
+            stats[key] = [r for r in stats[key] if r.get('Lane', r.get('LaneNumber')) in lane_ids]
+    with open(outfile, 'w') as fh:
+        json.dump(stats, fh, indent=4)
+
+
+def link_or_copy(src, dst):
+    """hard link src to dst, falling back to copying"""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def fan_out(group_dir, mux_dir, lane_ids):
+    """make stats and reports of lane group in group_dir (bcl2fastq's
+    --stats-dir and --reports-dir) available in mux_dir as if bcl2fastq
+    had been run for this MUX only. Stats.json is restricted to the
+    MUX's lane_ids, everything else is hard linked
+    """
+    os.makedirs(mux_dir, exist_ok=True)
+    for name in os.listdir(group_dir):
+        src = os.path.join(group_dir, name)
+        dst = os.path.join(mux_dir, name)
+        if name == LANE_GROUP_FLAG:
+            continue
+        if os.path.isdir(src):
+            if os.path.exists(dst):
+                shutil.rmtree(dst)
+            shutil.copytree(src, dst, copy_function=link_or_copy)
+            continue
+        if os.path.exists(dst):
+            os.unlink(dst)
+        if name == STATS_JSON:
+            restrict_stats_json(src, lane_ids, dst)
+        else:
+            link_or_copy(src, dst)
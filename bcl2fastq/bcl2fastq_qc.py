@@ -28,6 +28,9 @@ import pprint
 from collections import OrderedDict
 import argparse
 import logging
+import json
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
 
 #--- third-party imports
 #
@@ -46,6 +49,8 @@ from pipelines import is_devel_version
 from pipelines import email_for_user
 from pipelines import send_mail
 from pipelines import path_to_url
+from utils import load_json_cache
+from utils import save_json_cache
 
 __author__ = "Andreas Wilm"
 __email__ = "wilma@gis.a-star.edu.sg"
@@ -63,6 +68,18 @@ logger.addHandler(handler)
 
 DEMUX_HTML_FILE_PATTERN = r'.*Project_(\w+)/html/([\w-]+)/\w+/\w+/\w+/lane.html'
 
+# machine readable stats written by bcl2fastq to --stats-dir, which is
+# the project dir (see Snakefile)
+STATS_JSON = "Stats.json"
+CONVERSION_STATS_XML = "ConversionStats.xml"
+
+# QC summary written next to conf.yaml for reuse by later steps. see
+# load_qc_summary(). bump version on format changes
+QC_SUMMARY_JSON = "bcl2fastq_qc.json"
+QC_SUMMARY_KEY = {'version': 1}
+
+DEFAULT_NUM_PROCS = 8
+
 
 def get_machine_type_from_run_num(run_num):
     """these are the values to be used in config for machine dependent settings"""
@@ -179,17 +196,39 @@ def process_demux_html(html_file):
     return flowcell_table, lane_table
 
 
+def merge_demux_tables(tables):
+    """Combine flowcell and lane tables of several MUXes (logically
+    representing one run). tables is a list of (flowcell_table,
+    lane_table) tuples. Returns combined flowcell and lane table
+    """
+
+    flowcell_table = OrderedDict()
+    lane_table = OrderedDict()
+    for this_flowcell_table, this_lane_table in tables:
+        for lane in this_lane_table.keys():
+            assert lane not in lane_table.keys(), (
+                "Seen lane {} before, i.e. html files are not from same run".format(lane))
+        lane_table.update(this_lane_table)
+
+        for flowcell_id in this_flowcell_table:
+            if not flowcell_id in flowcell_table:
+                flowcell_table[flowcell_id] = OrderedDict(this_flowcell_table[flowcell_id])
+            else:
+                for k, v in this_flowcell_table[flowcell_id].items():
+                    flowcell_table[flowcell_id][k] += v
+
+    return flowcell_table, lane_table
+
+
 def gather_demux_stats(demux_html_files):
     """Parse all demux html stats, parse and combine (logically
     representing one run). Teturn flowcell summary table and lane
     summary table as two dicts()
     """
 
-    flowcell_table = OrderedDict()
-    lane_table = OrderedDict()
-
     # extract tables from all demux_html_files
     #
+    tables = []
     for html_file in demux_html_files:
         m = re.search(DEMUX_HTML_FILE_PATTERN, html_file)
         if not m or not len(m.groups()) == 2:
@@ -204,42 +243,186 @@ def gather_demux_stats(demux_html_files):
         this_flowcell_table, this_lane_table = process_demux_html(html_file)
         # pure paranoia test
         assert [flowcell_id] == list(this_flowcell_table.keys())
+        tables.append((this_flowcell_table, this_lane_table))
 
-        for lane in this_lane_table.keys():
-            assert lane not in lane_table.keys(), (
-                "Seen lane {} before, i.e. html files are not from same run".format(lane))
-        lane_table.update(this_lane_table)
+    return merge_demux_tables(tables)
 
-        if not flowcell_id in flowcell_table:
-            flowcell_table = this_flowcell_table
-        else:
-            for k, v in this_flowcell_table[flowcell_id].items():
-                flowcell_table[flowcell_id][k] += v
 
-    return flowcell_table, lane_table
+def conversion_stats_cluster_counts(xml_file):
+    """Return raw and PF cluster counts per lane as two dicts, summed
+    over all tiles of project 'all' in bcl2fastq's ConversionStats.xml.
+    The file is parsed incrementally, since it can be huge
+    """
+
+    raw = OrderedDict()
+    pf = OrderedDict()
+    project = lane = None
+    path = []
+    for event, elem in ET.iterparse(xml_file, events=('start', 'end')):
+        if event == 'start':
+            path.append(elem.tag)
+            if elem.tag == 'Project':
+                project = elem.get('name')
+            elif elem.tag == 'Lane':
+                lane = int(elem.get('number'))
+            continue
 
+        path.pop()
+        if project == 'all' and elem.tag == 'ClusterCount':
+            counts = raw if path[-1] == 'Raw' else pf
+            counts[lane] = counts.get(lane, 0) + int(elem.text)
+        elif elem.tag in ['Tile', 'Sample']:
+            # free memory
+            elem.clear()
+    return raw, pf
+
+
+def stats_json_demux_tables(stats_json, conversion_stats_xml=None):
+    """Fast alternative to process_demux_html() using bcl2fastq's
+    Stats.json (and ConversionStats.xml for raw cluster counts if
+    missing in the former). Returns flowcell, lane and undetermined
+    lane table with same keys and (rounded) values as in the html
+    report. Raises KeyError or ValueError on unexpected content
+    """
 
+    with open(stats_json) as fh:
+        stats = json.load(fh)
+    flowcell_id = stats['Flowcell']
+
+    # gather per lane columns. perfect barcodes are None for non-muxed input
+    cols = OrderedDict((k, []) for k in [
+        'lane', 'raw', 'pf', 'yield', 'yield_q30', 'qscore_sum', 'perfect', 'undet'])
+    for res in stats['ConversionResults']:
+        cols['lane'].append(int(res['LaneNumber']))
+        cols['raw'].append(res.get('TotalClustersRaw'))
+        cols['pf'].append(res['TotalClustersPF'])
+        cols['yield'].append(res['Yield'])
+        samples = list(res['DemuxResults'])
+        perfect = None
+        for sample in samples:
+            for index in sample.get('IndexMetrics', []):
+                perfect = (perfect or 0) + index['MismatchCounts'].get('0', 0)
+        cols['perfect'].append(perfect)
+        undet = res.get('Undetermined')
+        cols['undet'].append(undet['NumberReads'] if undet else None)
+        if undet:
+            samples.append(undet)
+        read_metrics = [rm for sample in samples for rm in sample['ReadMetrics']]
+        cols['yield_q30'].append(sum(rm['YieldQ30'] for rm in read_metrics))
+        cols['qscore_sum'].append(sum(rm['QualityScoreSum'] for rm in read_metrics))
+
+    if None in cols['raw']:
+        if not conversion_stats_xml:
+            raise ValueError("Raw cluster counts missing in {}".format(stats_json))
+        raw, _ = conversion_stats_cluster_counts(conversion_stats_xml)
+        cols['raw'] = [raw[lane] for lane in cols['lane']]
+
+    def percent(a, b):
+        """percent rounded as in html. None if undefined"""
+        if a is None or not b:
+            return None
+        return round(100.0 * a / b, 2)
 
-def run_qc_checks(project_dirs, machine_type):
-    """main function"""
-    qcfails = []
-    assert len(project_dirs) >= 1
+    lane_table = OrderedDict()
+    undet_lane_table = OrderedDict()
+    for i, lane in enumerate(cols['lane']):
+        lane_table[lane] = OrderedDict([
+            ('PF Clusters', cols['pf'][i]),
+            ('% of the lane', 100.0),
+            ('% Perfect barcode', percent(cols['perfect'][i], cols['pf'][i])),
+            ('Yield (Mbases)', int(round(cols['yield'][i] / 1000000.0))),
+            ('% PF Clusters', percent(cols['pf'][i], cols['raw'][i])),
+            ('% >= Q30 bases', percent(cols['yield_q30'][i], cols['yield'][i])),
+            ('Mean Quality Score', round(cols['qscore_sum'][i] / cols['yield'][i], 2)
+             if cols['yield'][i] else None),
+        ])
+        # undetermined is only reported for muxed input
+        if cols['perfect'][i] is not None and cols['undet'][i] is not None:
+            undet_lane_table[lane] = OrderedDict([
+                ('PF Clusters', cols['undet'][i]),
+                ('% of the lane', percent(cols['undet'][i], cols['pf'][i])),
+            ])
+
+    flowcell_table = OrderedDict([(flowcell_id, OrderedDict([
+        ('Clusters (Raw)', sum(cols['raw'])),
+        ('Clusters(PF)', sum(cols['pf'])),
+        ('Yield (MBases)', int(round(sum(cols['yield']) / 1000000.0)))]))])
+    return flowcell_table, lane_table, undet_lane_table
+
+
+def parse_project_dir(project_dir):
+    """Return flowcell, lane and undetermined lane table for a
+    project/MUX dir. Uses bcl2fastq's Stats.json if present and falls
+    back to parsing the html report
+    """
 
-    # determine all all/all/all/lane.html in project subdirs of given demux_dir
-    #
-    demux_html_files = []
-    for d in project_dirs:
-        g = os.path.join(d, 'html/*/all/all/all/lane.html')
-        f = glob.glob(g)
-        assert len(f) == 1, (
-            "Was expecting exactly one matching demux html"
-            " but found {} for glob {}".format(f, g))
-        demux_html_files.extend(f)
-    flowcell_table, lane_table = gather_demux_stats(demux_html_files)
+    stats_json = os.path.join(project_dir, STATS_JSON)
+    if os.path.exists(stats_json):
+        conversion_stats_xml = os.path.join(project_dir, CONVERSION_STATS_XML)
+        if not os.path.exists(conversion_stats_xml):
+            conversion_stats_xml = None
+        logger.info("Reading %s", stats_json)
+        try:
+            return stats_json_demux_tables(stats_json, conversion_stats_xml)
+        except (KeyError, ValueError, ET.ParseError) as e:
+            logger.warning("Parsing %s failed (%s). Falling back to html", stats_json, e)
+
+    g = os.path.join(project_dir, 'html/*/all/all/all/lane.html')
+    f = glob.glob(g)
+    assert len(f) == 1, (
+        "Was expecting exactly one matching demux html"
+        " but found {} for glob {}".format(f, g))
+    flowcell_table, lane_table = gather_demux_stats(f)
+
+    # info about 'undetermined' sits elsewhere (only makes sense if demuxed)
+    g = os.path.join(project_dir, 'html/*/default/Undetermined/all/lane.html')
+    # for non-demuxed input (no files) this still works as expected
+    _, undet_lane_table = gather_demux_stats(glob.glob(g))
+
+    return flowcell_table, lane_table, undet_lane_table
+
+
+def qc_project_dir(project_dir):
+    """parse_project_dir() plus demux html path (or None). Run in a
+    worker process
+    """
+    tables = parse_project_dir(project_dir)
+    html_files = glob.glob(os.path.join(project_dir, 'html/*/all/all/all/lane.html'))
+    return tables + (os.path.abspath(html_files[0]) if html_files else None,)
+
+
+def collect_qc_tables(project_dirs, num_procs=DEFAULT_NUM_PROCS):
+    """Parse all project dirs in parallel and merge their tables in
+    order of project_dirs. Returns combined flowcell, lane and
+    undetermined lane table plus per project dir info (dict with
+    demux html and lanes)
+    """
+    assert len(project_dirs) >= 1
+    num_procs = max(1, min(num_procs, len(project_dirs)))
+    if num_procs == 1:
+        results = [qc_project_dir(d) for d in project_dirs]
+    else:
+        with ProcessPoolExecutor(max_workers=num_procs) as executor:
+            # map keeps order, i.e. merging is deterministic
+            results = list(executor.map(qc_project_dir, project_dirs))
+
+    flowcell_table, lane_table = merge_demux_tables(
+        [(f, l) for f, l, _, _ in results])
+    _, undet_lane_table = merge_demux_tables(
+        [(OrderedDict(), u) for _, _, u, _ in results])
     logger.debug("# Combined Flowcell Summary")
     logger.debug(pprint.pformat(flowcell_table))
     logger.debug("# Combined per Lane")
     logger.debug(pprint.pformat(lane_table))
+    project_info = OrderedDict()
+    for d, (_, l, _, html_file) in zip(project_dirs, results):
+        project_info[d] = {'html': html_file, 'lanes': list(l.keys())}
+    return flowcell_table, lane_table, undet_lane_table, project_info
+
+
+def run_qc_checks(lane_table, undet_lane_table, machine_type):
+    """run QC checks on (combined) lane tables. returns list of failures"""
+    qcfails = []
 
     for lane, values in lane_table.items():
         # test: pf
@@ -280,22 +463,10 @@ def run_qc_checks(project_dirs, machine_type):
 
         
 
-    # info about 'undetermined' sits elsewhere (only makes sense if demuxed)
+    # test: undetermined reads
     #
-    undet_demux_html_files = []
-    for d in project_dirs:
-        g = os.path.join(d, 'html/*/default/Undetermined/all/lane.html')
-        f = glob.glob(g)
-        if f:
-            # otherwise probably non-muxed
-            undet_demux_html_files.extend(f)
-    # for non-demuxed input (empty input files) everything below still works as expected
-    _, undet_lane_table = gather_demux_stats(undet_demux_html_files)
     logger.debug("# Undetermined combined per Lane")
     logger.debug(pprint.pformat(undet_lane_table))
-
-    # test: undetermined reads
-    #
     for lane, values in undet_lane_table.items():
         v = values['% of the lane']
         l = config['max-percent-undetermined']
@@ -307,6 +478,32 @@ def run_qc_checks(project_dirs, machine_type):
     return qcfails
 
 
+def write_qc_summary(bcl2fastq_dir, run_num, tables, qcfails):
+    """write QC summary (tables as returned by collect_qc_tables()) as
+    json next to conf.yaml. lanes become strings (json keys)
+    """
+    flowcell_table, lane_table, undet_lane_table, project_info = tables
+    summary = {'run_num': run_num,
+               'flowcell': flowcell_table,
+               'lanes': lane_table,
+               'undetermined': undet_lane_table,
+               'muxes': dict((os.path.basename(d.rstrip(os.sep)), v)
+                             for d, v in project_info.items()),
+               'qcfails': qcfails}
+    summary_file = os.path.join(bcl2fastq_dir, QC_SUMMARY_JSON)
+    save_json_cache(summary_file, QC_SUMMARY_KEY, summary)
+    logger.info("QC summary written to %s", summary_file)
+
+
+def load_qc_summary(bcl2fastq_dir):
+    """Return QC summary for bcl2fastq_dir written by this script (see
+    write_qc_summary()) or None if missing or outdated. Lane keys are
+    strings. MUX info is keyed by mux_dir
+    """
+    return load_json_cache(os.path.join(bcl2fastq_dir, QC_SUMMARY_JSON),
+                           QC_SUMMARY_KEY)
+
+
 def main():
     """main function
     """
@@ -316,6 +513,12 @@ def main():
                         help="bcl2fastq directory (containing a conf.yaml)")
     parser.add_argument('--no-mail', action='store_true',
                         help="Don't send email on detected failures")
+    parser.add_argument('--no-summary', action='store_true',
+                        help="Don't write QC summary {}".format(QC_SUMMARY_JSON))
+    default = DEFAULT_NUM_PROCS
+    parser.add_argument('-p', '--procs', type=int, default=default,
+                        help="Number of processes for parsing project dirs"
+                        " (default: {})".format(default))
     parser.add_argument('-v', '--verbose', action='count', default=0,
                         help="Increase verbosity")
     parser.add_argument('-q', '--quiet', action='count', default=0,
@@ -356,7 +559,14 @@ def main():
         logger.error("Exiting because no project directories where found in %s", args.bcl2fastq_dir)
         sys.exit(1)
         
-    qcfails = run_qc_checks(project_dirs, machine_type)
+    tables = collect_qc_tables(project_dirs, args.procs)
+    _, lane_table, undet_lane_table, _ = tables
+    qcfails = run_qc_checks(lane_table, undet_lane_table, machine_type)
+    if not args.no_summary:
+        try:
+            write_qc_summary(args.bcl2fastq_dir, run_num, tables, qcfails)
+        except OSError as e:
+            logger.warning("Couldn't write QC summary: %s", e)
 
     if qcfails:
         subject = "bcl2fastq QC checks failed for {} ({}):".format(
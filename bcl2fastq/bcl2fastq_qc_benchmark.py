@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+"""Benchmark parsing of bcl2fastq demux stats in bcl2fastq_qc.py:
+Stats.json/ConversionStats.xml fast path vs. html report. Times both
+parsers on the given project/MUX dirs of a real bcl2fastq run and
+checks that they agree. Without arguments, synthetic output for a
+single MUX (NovaSeq-sized by default) is used. Synthetic timings only
+indicate scaling and agreement there only shows that both parsers
+read the generator's output consistently
+"""
+
+#--- standard library imports
+#
+import os
+import sys
+import logging
+import argparse
+import json
+import glob
+import random
+import shutil
+import tempfile
+import time
+
+#--- third-party imports
+#
+#/
+
+#--- project specific imports
+#
+from bcl2fastq_qc import stats_json_demux_tables
+from bcl2fastq_qc import gather_demux_stats
+from bcl2fastq_qc import STATS_JSON
+from bcl2fastq_qc import CONVERSION_STATS_XML
+
+
+__author__ = "Andreas Wilm"
+__email__ = "wilma@gis.a-star.edu.sg"
+__copyright__ = "2017 Genome Institute of Singapore"
+__license__ = "The MIT License (MIT)"
+
+
+# NovaSeq S4: 4 lanes with 2x 312 tiles each
+DEFAULT_NUM_LANES = 4
+DEFAULT_NUM_TILES = 624
+DEFAULT_NUM_SAMPLES = 96
+FLOWCELL_ID = "HBENCHDSXX"
+MUX_ID = "MUX0001"
+# compared keys and allowed absolute difference (html values are rounded)
+COMPARED_KEYS = {'PF Clusters': 0, '% Perfect barcode': 0.011,
+                 'Yield (Mbases)': 1, '% >= Q30 bases': 0.011}
+
+
+# global logger
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler()
+handler.setFormatter(logging.Formatter(
+    '[{asctime}] {levelname:8s} {filename} {message}', style='{'))
+logger.addHandler(handler)
+
+
+def synthetic_lane_stats(num_lanes, num_tiles, num_samples, read_len=151):
+    """return per lane, tile and sample cluster counts etc as nested
+    lists: lanes[lane][tile][sample] = (raw, pf, perfect). index
+    num_samples is undetermined
+    """
+    lanes = []
+    for _ in range(num_lanes):
+        tiles = []
+        for _ in range(num_tiles):
+            counts = []
+            for _ in range(num_samples+1):
+                raw = random.randint(2000, 4000)
+                pf = int(raw * random.uniform(0.7, 0.9))
+                perfect = int(pf * random.uniform(0.9, 1.0))
+                counts.append((raw, pf, perfect))
+            tiles.append(counts)
+        lanes.append(tiles)
+    return lanes, read_len
+
+
+def html_table(rows):
+    """return html table for rows (first is header)"""
+    html = "<table border=\"1\" ID=\"ReportTable\">\n"
+    html += "<tr>" + "".join("<th>{}</th>".format(c) for c in rows[0]) + "</tr>\n"
+    for row in rows[1:]:
+        html += "<tr>" + "".join("<td>{}</td>".format(c) for c in row) + "</tr>\n"
+    return html + "</table>\n"
+
+
+def write_html(html_file, flowcell_row, lane_rows):
+    """write html in bcl2fastq lane.html layout"""
+    os.makedirs(os.path.dirname(html_file))
+    with open(html_file, 'w') as fh:
+        fh.write("<html><body>\n")
+        fh.write(html_table([["{} / [all projects] / [all samples] / [all barcodes]".format(
+            FLOWCELL_ID)]]))
+        fh.write(html_table([["Clusters (Raw)", "Clusters(PF)", "Yield (MBases)"],
+                             flowcell_row]))
+        fh.write(html_table([["Lane", "PF Clusters", "% of the lane", "% Perfect barcode",
+                              "% One mismatch barcode", "Yield (Mbases)", "% PF Clusters",
+                              "% >= Q30 bases", "Mean Quality Score"]] + lane_rows))
+        fh.write("</body></html>\n")
+
+
+def write_synthetic_mux(project_dir, num_lanes, num_tiles, num_samples):
+    """write Stats.json, ConversionStats.xml and html reports for a
+    synthetic MUX to project_dir
+    """
+    lanes, read_len = synthetic_lane_stats(num_lanes, num_tiles, num_samples)
+
+    conversion_results = []
+    lane_rows = []
+    undet_lane_rows = []
+    tot_raw = tot_pf = tot_yield = 0
+    for lane_no, tiles in enumerate(lanes, 1):
+        sample_sums = [[sum(t[s][i] for t in tiles) for i in range(3)]
+                       for s in range(num_samples+1)]
+        demux_results = []
+        yield_q30 = qscore_sum = 0
+        for s, (_, pf, perfect) in enumerate(sample_sums):
+            sample_yield = pf * read_len
+            q30 = int(sample_yield * 0.85)
+            qsum = sample_yield * 35
+            yield_q30 += q30
+            qscore_sum += qsum
+            entry = {"NumberReads": pf, "Yield": sample_yield,
+                     "ReadMetrics": [{"ReadNumber": 1, "Yield": sample_yield,
+                                      "YieldQ30": q30, "QualityScoreSum": qsum}]}
+            if s < num_samples:
+                entry.update({"SampleId": "S{}".format(s), "SampleName": "S{}".format(s),
+                              "IndexMetrics": [{"IndexSequence": "ACGTACGT",
+                                                "MismatchCounts": {"0": perfect,
+                                                                   "1": pf-perfect}}]})
+                demux_results.append(entry)
+            else:
+                undetermined = entry
+        lane_raw = sum(x[0] for x in sample_sums)
+        lane_pf = sum(x[1] for x in sample_sums)
+        lane_perfect = sum(x[2] for x in sample_sums[:num_samples])
+        lane_yield = lane_pf * read_len
+        conversion_results.append({"LaneNumber": lane_no, "TotalClustersRaw": lane_raw,
+                                   "TotalClustersPF": lane_pf, "Yield": lane_yield,
+                                   "DemuxResults": demux_results,
+                                   "Undetermined": undetermined})
+        lane_rows.append([lane_no, "{:,}".format(lane_pf), "100.00",
+                          "{:.2f}".format(100.0*lane_perfect/lane_pf), "0.00",
+                          "{:,}".format(int(round(lane_yield/1000000.0))),
+                          "{:.2f}".format(100.0*lane_pf/lane_raw),
+                          "{:.2f}".format(100.0*yield_q30/lane_yield),
+                          "{:.2f}".format(qscore_sum/lane_yield)])
+        undet_pf = undetermined["NumberReads"]
+        undet_lane_rows.append([lane_no, "{:,}".format(undet_pf),
+                                "{:.2f}".format(100.0*undet_pf/lane_pf), "NaN", "NaN",
+                                "0", "0.00", "0.00", "0.00"])
+        tot_raw += lane_raw
+        tot_pf += lane_pf
+        tot_yield += lane_yield
+
+    with open(os.path.join(project_dir, STATS_JSON), 'w') as fh:
+        json.dump({"Flowcell": FLOWCELL_ID, "RunNumber": 1,
+                   "ConversionResults": conversion_results}, fh, indent=2)
+
+    with open(os.path.join(project_dir, CONVERSION_STATS_XML), 'w') as fh:
+        fh.write('<?xml version="1.0" encoding="utf-8"?>\n<Stats>\n')
+        fh.write('<Flowcell flowcell-id="{}">\n'.format(FLOWCELL_ID))
+        for project in [MUX_ID, "all"]:
+            fh.write('<Project name="{}"><Sample name="all"><Barcode name="all">\n'.format(
+                project))
+            for lane_no, tiles in enumerate(lanes, 1):
+                fh.write('<Lane number="{}">\n'.format(lane_no))
+                for tile_no, counts in enumerate(tiles):
+                    fh.write('<Tile number="{}"><Raw><ClusterCount>{}</ClusterCount></Raw>'
+                             '<Pf><ClusterCount>{}</ClusterCount></Pf></Tile>\n'.format(
+                                 1101+tile_no, sum(c[0] for c in counts),
+                                 sum(c[1] for c in counts)))
+                fh.write('</Lane>\n')
+            fh.write('</Barcode></Sample></Project>\n')
+        fh.write('</Flowcell>\n</Stats>\n')
+
+    flowcell_row = ["{:,}".format(tot_raw), "{:,}".format(tot_pf),
+                    "{:,}".format(int(round(tot_yield/1000000.0)))]
+    write_html(os.path.join(project_dir, "html", FLOWCELL_ID, "all/all/all/lane.html"),
+               flowcell_row, lane_rows)
+    write_html(os.path.join(project_dir, "html", FLOWCELL_ID,
+                            "default/Undetermined/all/lane.html"),
+               flowcell_row, undet_lane_rows)
+
+
+def timed(func, *args, repeats=1):
+    """return result of func(*args) and the fastest of repeats runs in seconds"""
+    best = None
+    for _ in range(repeats):
+        start = time.time()
+        res = func(*args)
+        secs = time.time() - start
+        if best is None or secs < best:
+            best = secs
+    return res, best
+
+
+def tables_agree(lane_table_a, lane_table_b, keys):
+    """check whether values for keys (dict of key: allowed difference)
+    agree between the two lane tables
+    """
+    if list(lane_table_a.keys()) != list(lane_table_b.keys()):
+        return False
+    for lane, values in lane_table_a.items():
+        for k, maxdiff in keys.items():
+            a, b = values[k], lane_table_b[lane][k]
+            if (a is None) != (b is None) or (a is not None and abs(a-b) > maxdiff):
+                logger.warning("Lane %s %s differs: %s vs %s", lane, k, a, b)
+                return False
+    return True
+
+
+def benchmark_project_dir(project_dir, tmpdir, repeats=1):
+    """time Stats.json (with and without ConversionStats.xml) and html
+    parsing for one bcl2fastq project/MUX dir and print results.
+    returns whether both parsers agree
+    """
+    stats_json = os.path.join(project_dir, STATS_JSON)
+    conv_xml = os.path.join(project_dir, CONVERSION_STATS_XML)
+    for f in [stats_json, conv_xml]:
+        if os.path.exists(f):
+            print("{}: {:.1f} MB".format(f, os.path.getsize(f)/1024.0**2))
+
+    html_files = glob.glob(os.path.join(project_dir, "html/*/all/all/all/lane.html"))
+    assert len(html_files) == 1, (
+        "Was expecting exactly one demux html in {} but found {}".format(
+            project_dir, html_files))
+    undet_html_files = glob.glob(os.path.join(
+        project_dir, "html/*/default/Undetermined/all/lane.html"))
+
+    (_, json_lanes, json_undet), json_secs = timed(
+        stats_json_demux_tables, stats_json, repeats=repeats)
+    (_, html_lanes), html_secs = timed(
+        gather_demux_stats, html_files, repeats=repeats)
+    (_, html_undet), undet_secs = timed(
+        gather_demux_stats, undet_html_files, repeats=repeats)
+    html_secs += undet_secs
+    print("Stats.json: {:.3f}s".format(json_secs))
+
+    # forced raw cluster count parsing on a copy without raw counts
+    if os.path.exists(conv_xml):
+        with open(stats_json) as fh:
+            stats = json.load(fh)
+        for res in stats['ConversionResults']:
+            res.pop('TotalClustersRaw', None)
+        stripped_json = os.path.join(tmpdir, STATS_JSON)
+        with open(stripped_json, 'w') as fh:
+            json.dump(stats, fh)
+        _, xml_secs = timed(stats_json_demux_tables, stripped_json, conv_xml,
+                            repeats=repeats)
+        print("Stats.json plus ConversionStats.xml: {:.3f}s".format(xml_secs))
+    print("html: {:.3f}s".format(html_secs))
+
+    return tables_agree(json_lanes, html_lanes, COMPARED_KEYS) and \
+        tables_agree(json_undet, html_undet, {'% of the lane': 0.011})
+
+
+def main():
+    """main function"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('project_dirs', nargs='*',
+                        help="Project/MUX dirs of real bcl2fastq output (containing"
+                        " Stats.json and html report). Synthetic data is used if none given")
+    parser.add_argument('--repeats', type=int, default=3,
+                        help="Report fastest of this many runs (default: 3)")
+    parser.add_argument('--lanes', type=int, default=DEFAULT_NUM_LANES,
+                        help="Number of synthetic lanes (default: {})".format(DEFAULT_NUM_LANES))
+    parser.add_argument('--tiles', type=int, default=DEFAULT_NUM_TILES,
+                        help="Number of synthetic tiles per lane (default: {})".format(
+                            DEFAULT_NUM_TILES))
+    parser.add_argument('--samples', type=int, default=DEFAULT_NUM_SAMPLES,
+                        help="Number of synthetic samples (default: {})".format(
+                            DEFAULT_NUM_SAMPLES))
+    parser.add_argument('--keep', action='store_true',
+                        help="Don't delete synthetic data")
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+                        help="Increase verbosity")
+    parser.add_argument('-q', '--quiet', action='count', default=0,
+                        help="Decrease verbosity")
+    args = parser.parse_args()
+
+    logger.setLevel(logging.WARN + 10*args.quiet - 10*args.verbose)
+
+    agree = True
+    tmpdir = tempfile.mkdtemp(prefix="bcl2fastq_qc_benchmark.")
+    try:
+        if args.project_dirs:
+            for project_dir in args.project_dirs:
+                if not os.path.exists(os.path.join(project_dir, STATS_JSON)):
+                    logger.fatal("No %s in %s", STATS_JSON, project_dir)
+                    sys.exit(1)
+                agree = benchmark_project_dir(project_dir, tmpdir, args.repeats) and agree
+            print("Results agree: {}".format(agree))
+        else:
+            project_dir = os.path.join(tmpdir, "Project_{}".format(MUX_ID))
+            os.makedirs(project_dir)
+            logger.info("Writing synthetic data to %s", project_dir)
+            write_synthetic_mux(project_dir, args.lanes, args.tiles, args.samples)
+            agree = benchmark_project_dir(project_dir, tmpdir, args.repeats)
+            # both parsers read data written by the same generator, so
+            # this is only a consistency check
+            print("Results agree (synthetic data): {}".format(agree))
+    finally:
+        if args.keep and not args.project_dirs:
+            print("Synthetic data kept in {}".format(tmpdir))
+        else:
+            shutil.rmtree(tmpdir)
+    if not agree:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -35,6 +35,38 @@ handler.setFormatter(logging.Formatter(
 logger.addHandler(handler)
 
 
+def wrapper_cmd(bcl2fastq_wrapper, run_numbers, args):
+    """return bcl2fastq wrapper command for run_numbers"""
+    cmd = [bcl2fastq_wrapper, "-r"] + run_numbers + ["-v"]
+    if args.testing:
+        cmd.append("-t")
+    if args.wrapper_args:
+        cmd.extend([x.lstrip('X') for x in args.wrapper_args])
+    return cmd
+
+
+def run_wrapper(cmd):
+    """run bcl2fastq wrapper command. returns True on success, False on
+    failure and None on a qmaster problem (commlib error), in which case
+    no further runs should be attempted
+    """
+    try:
+        logger.info("Executing: %s", ' '.join(cmd))
+        res = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
+        if res:
+            logger.info("bcl2fastq wrapper returned:\n%s",
+                        res.decode().rstrip())
+    except subprocess.CalledProcessError as e:
+        logger.critical("The following command failed with"
+                        " return code %s: %s", e.returncode, ' '.join(cmd))
+        logger.critical("Full error message was: %s", e.stdout)
+        if 'commlib error' in e.stdout.decode():
+            logger.critical("Looks like a qmaster problem (commlib error)")
+            return None
+        return False
+    return True
+
+
 def main():
     """main function"""
 
@@ -81,41 +113,36 @@ def main():
                        "timestamp": {"$gt": epoch_back, "$lt": epoch_present}})
     # results is a pymongo.cursor.Cursor which works like an iterator i.e. dont use len()
     logger.info("Found %s runs", results.count())
-    for record in results:
-        run_number = record['run']
-        logger.debug("Processing record %s", record)
-        cmd = [bcl2fastq_wrapper, "-r", run_number, "-v"]
-        if args.testing:
-            cmd.append("-t")
-        if args.wrapper_args:
-            cmd.extend([x.lstrip('X') for x in args.wrapper_args])
-        if args.dry_run:
-            logger.warning("Skipped following run: %s", ' '.join(cmd))
-            continue
-        else:
-            try:
-                logger.info("Executing: %s", ' '.join(cmd))
-                res = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
-                if res:
-                    logger.info("bcl2fastq wrapper returned:\n%s",
-                                res.decode().rstrip())
-            except subprocess.CalledProcessError as e:
-                logger.critical("The following command failed with"
-                                " return code %s: %s", e.returncode, ' '.join(cmd))
-                logger.critical("Full error message was: %s", e.stdout)
-                if 'commlib error' in e.stdout.decode():
-                    logger.critical(
-                        "Looks like a qmaster problem (commlib error). Exiting")
-                    break
-                else:
-                    logger.critical("Will keep going")
-                # continue so that a failed run doesn't count,
-                # i.e. args.break_after_first shouldn't be trigger
-                continue
 
-        if args.break_after_first:
-            logger.info("Stopping after first sequencing run")
-            break
+    if args.break_after_first:
+        # one run at a time until the first one started successfully.
+        # a failed run doesn't count
+        for record in results:
+            logger.debug("Processing record %s", record)
+            cmd = wrapper_cmd(bcl2fastq_wrapper, [record['run']], args)
+            if args.dry_run:
+                logger.warning("Skipped following run: %s", ' '.join(cmd))
+                continue
+            success = run_wrapper(cmd)
+            if success is None:
+                logger.critical("Exiting")
+                break
+            if success:
+                logger.info("Stopping after first sequencing run")
+                break
+            logger.critical("Will keep going")
+    else:
+        run_numbers = []
+        for record in results:
+            logger.debug("Processing record %s", record)
+            run_numbers.append(record['run'])
+        # all runs are handled by one wrapper call, which sets them up in parallel
+        if run_numbers:
+            cmd = wrapper_cmd(bcl2fastq_wrapper, run_numbers, args)
+            if args.dry_run:
+                logger.warning("Skipped following run/s: %s", ' '.join(cmd))
+            else:
+                run_wrapper(cmd)
 
     # close the connection to MongoDB
     connection.close()
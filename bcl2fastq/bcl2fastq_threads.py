@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+"""Thread planner for bcl2fastq
+
+Derives bcl2fastq's loading, writing, demultiplexing and processing
+threads plus the number of threads per MUX job from the number of
+lanes and tiles (RunInfo.xml), the number of MUXes and the cluster
+profile of the site. Loading and writing threads are I/O bound and
+all MUXes of a run might run at the same time, so the site's I/O
+budget is split between MUXes. Processing threads scale with the
+number of tiles.
+
+Run as script to replay recorded bcl2fastq runs (see collect_timings())
+and compare the planner's choices with the recorded timings.
+"""
+
+#--- standard library imports
+#
+import os
+import sys
+import re
+import math
+import logging
+import argparse
+import csv
+from collections import namedtuple
+from collections import OrderedDict
+from datetime import datetime
+import xml.etree.ElementTree as ET
+
+#--- third-party imports
+#
+import yaml
+
+#--- project specific imports
+#
+#/
+
+
+__author__ = "Andreas Wilm"
+__email__ = "wilma@gis.a-star.edu.sg"
+__copyright__ = "2017 Genome Institute of Singapore"
+__license__ = "The MIT License (MIT)"
+
+
+# per site: max threads per bcl2fastq job and concurrent I/O
+# (loading plus writing) threads the filers handle well per run
+CLUSTER_PROFILES = {
+    'GIS': {'max_threads': 16, 'io_threads': 16},
+    'NSCC': {'max_threads': 24, 'io_threads': 24},
+    'AWS': {'max_threads': 16, 'io_threads': 32},
+}
+DEFAULT_CLUSTER_PROFILE = {'max_threads': 16, 'io_threads': 16}
+
+MIN_THREADS = 2
+# Illumina default for loading and writing threads (each)
+MAX_IO_THREADS = 4
+# number of tiles one processing thread keeps up with
+TILES_PER_THREAD = 24
+# demultiplexing threads as fraction of processing threads (Illumina default)
+DEMUX_FRACTION = 0.2
+
+# recorded timings columns. see collect_timings()
+TIMINGS_COLUMNS = ['outdir', 'mux_dir', 'site', 'lanes', 'tiles', 'muxes',
+                   'loading', 'writing', 'demux', 'processing', 'wallclock_s']
+
+BCL2FASTQ_LOG_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+# global logger
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler()
+handler.setFormatter(logging.Formatter(
+    '[{asctime}] {levelname:8s} {filename} {message}', style='{'))
+logger.addHandler(handler)
+
+
+class ThreadPlan(namedtuple('ThreadPlan',
+                            ['threads', 'loading', 'writing', 'demux', 'processing'])):
+    """bcl2fastq thread settings for one MUX. threads is what the
+    job should request
+    """
+    __slots__ = ()
+
+    def args(self):
+        """return bcl2fastq thread arguments"""
+        return "-r {} -w {} -d {} -p {}".format(
+            self.loading, self.writing, self.demux, self.processing)
+
+
+def tiles_per_lane(runinfo):
+    """return number of tiles per lane according to RunInfo.xml
+    """
+    root = ET.parse(runinfo).getroot()
+    layout = root.find('Run/FlowcellLayout')
+    assert layout is not None, ("No FlowcellLayout in {}".format(runinfo))
+    # NovaSeq lists tiles explicitly (all lanes)
+    tiles = layout.findall('TileSet/Tiles/Tile')
+    if tiles:
+        return len(tiles) // int(layout.get('LaneCount'))
+    return int(layout.get('SurfaceCount', 1)) * int(layout.get('SwathCount', 1)) \
+        * int(layout.get('TileCount'))
+
+
+def plan_threads(num_lanes, num_tiles, num_muxes, profile=None):
+    """return ThreadPlan for a MUX in num_lanes lanes with num_tiles
+    tiles per lane, for a run with num_muxes MUXes
+    """
+    if not profile:
+        profile = DEFAULT_CLUSTER_PROFILE
+    processing = int(math.ceil(num_lanes * num_tiles / float(TILES_PER_THREAD)))
+    processing = max(MIN_THREADS, min(processing, profile['max_threads']))
+    # all muxes might run at once and loading/writing share the budget
+    io_threads = max(1, profile['io_threads'] // max(1, num_muxes) // 2)
+    loading = writing = min(MAX_IO_THREADS, io_threads, processing)
+    demux = int(math.ceil(DEMUX_FRACTION * processing))
+    return ThreadPlan(processing, loading, writing, demux, processing)
+
+
+def plan_run(units, runinfo, site=None):
+    """return ThreadPlan per key of units (as in conf.yaml, i.e. per
+    mux_dir, or lane groups). units only need lane_ids
+    """
+    num_tiles = tiles_per_lane(runinfo)
+    profile = CLUSTER_PROFILES.get(site, DEFAULT_CLUSTER_PROFILE)
+    plans = OrderedDict()
+    for key, unit in units.items():
+        plans[key] = plan_threads(
+            len(unit['lane_ids']), num_tiles, len(units), profile)
+    return plans
+
+
+def bcl2fastq_log_timing(logfile):
+    """return thread arguments (dict with keys loading, writing, demux
+    and processing), lanes (from --tiles) and wallclock seconds of a
+    bcl2fastq run according to its log, or None if incomplete
+    """
+    first = last = None
+    cmdline = None
+    with open(logfile) as fh:
+        for line in fh:
+            if "Command-line invocation:" in line:
+                cmdline = line.split("Command-line invocation:", 1)[1].split()
+            try:
+                t = datetime.strptime(line[:19], BCL2FASTQ_LOG_TIME_FORMAT)
+            except ValueError:
+                continue
+            if first is None:
+                first = t
+            last = t
+    if not cmdline or first is None:
+        return None
+    opts = {'-r': 'loading', '--loading-threads': 'loading',
+            '-w': 'writing', '--writing-threads': 'writing',
+            '-d': 'demux', '--demultiplexing-threads': 'demux',
+            '-p': 'processing', '--processing-threads': 'processing'}
+    timing = dict()
+    lanes = None
+    for opt, val in zip(cmdline, cmdline[1:]):
+        if opt in opts:
+            timing[opts[opt]] = int(val)
+        elif opt == '--tiles':
+            lanes = len(re.findall(r's_\d+', val))
+    if len(timing) != 4 or not lanes:
+        return None
+    return timing, lanes, (last - first).total_seconds()
+
+
+def collect_timings(outdirs, site):
+    """collect recorded timings (list of dicts with TIMINGS_COLUMNS)
+    from bcl2fastq output directories. runs whose run directory (for
+    RunInfo.xml) is gone are skipped
+    """
+    rows = []
+    for outdir in outdirs:
+        conf = os.path.join(outdir, "conf.yaml")
+        if not os.path.exists(conf):
+            logger.warning("Skipping %s: no conf.yaml", outdir)
+            continue
+        with open(conf) as fh:
+            cfg = yaml.safe_load(fh)
+        runinfo = os.path.join(cfg['rundir'], 'RunInfo.xml')
+        if not os.path.exists(runinfo):
+            logger.warning("Skipping %s: %s missing", outdir, runinfo)
+            continue
+        num_tiles = tiles_per_lane(runinfo)
+        for unit in cfg['units'].values():
+            logfile = os.path.join(outdir, "out", "{}.log".format(unit['mux_dir']))
+            if not os.path.exists(logfile):
+                continue
+            res = bcl2fastq_log_timing(logfile)
+            if not res:
+                logger.warning("Skipping incomplete log %s", logfile)
+                continue
+            timing, num_lanes, secs = res
+            row = dict(outdir=outdir, mux_dir=unit['mux_dir'], site=site,
+                       lanes=num_lanes, tiles=num_tiles, muxes=len(cfg['units']),
+                       wallclock_s=secs)
+            row.update(timing)
+            rows.append(row)
+    return rows
+
+
+def setting(row):
+    """return thread setting of a timings row"""
+    return tuple(int(row[k]) for k in ['loading', 'writing', 'demux', 'processing'])
+
+
+def replay(rows, max_slowdown):
+    """compare planned settings with recorded timings, grouped by
+    lanes, tiles, muxes and site. prints one line per group and
+    returns number of groups where the planned setting was recorded
+    and is more than max_slowdown times slower than the fastest
+    recorded setting
+    """
+    groups = OrderedDict()
+    for row in rows:
+        key = tuple(int(row[k]) for k in ['lanes', 'tiles', 'muxes']) + (row['site'],)
+        groups.setdefault(key, []).append(row)
+
+    num_failed = 0
+    fmt = "{:>5} {:>5} {:>5} {:6} {:>12} {:>9} {:>12} {:>9} {:>9}"
+    print(fmt.format("lanes", "tiles", "muxes", "site", "planned", "plan_s",
+                     "best", "best_s", "slowdown"))
+    for (lanes, tiles, muxes, site), group in groups.items():
+        plan = plan_threads(lanes, tiles, muxes, CLUSTER_PROFILES.get(site))
+        planned = (plan.loading, plan.writing, plan.demux, plan.processing)
+        best = min(group, key=lambda r: float(r['wallclock_s']))
+        best_s = float(best['wallclock_s'])
+        recorded = [float(r['wallclock_s']) for r in group if setting(r) == planned]
+        if recorded:
+            plan_s = sorted(recorded)[len(recorded)//2]
+            slowdown = plan_s / best_s if best_s else 1.0
+            if slowdown > max_slowdown:
+                num_failed += 1
+            plan_s, slowdown = "{:.0f}".format(plan_s), "{:.2f}".format(slowdown)
+        else:
+            plan_s = slowdown = "n/a"
+        print(fmt.format(lanes, tiles, muxes, site, "/".join(str(x) for x in planned),
+                         plan_s, "/".join(str(x) for x in setting(best)),
+                         "{:.0f}".format(best_s), slowdown))
+    return num_failed
+
+
+def main():
+    """main function"""
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--collect', nargs='+', metavar="OUTDIR",
+                        help="Collect timings from these bcl2fastq output directories")
+    parser.add_argument('--site', choices=sorted(CLUSTER_PROFILES.keys()),
+                        help="Site of collected timings (needed for --collect)")
+    parser.add_argument('-t', '--timings',
+                        help="Timings file (TSV). Written with --collect,"
+                        " otherwise replayed")
+    default = 1.2
+    parser.add_argument('--max-slowdown', type=float, default=default,
+                        help="Fail if planned setting was recorded and is this much"
+                        " slower than the fastest recorded one (default: {})".format(default))
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+                        help="Increase verbosity")
+    parser.add_argument('-q', '--quiet', action='count', default=0,
+                        help="Decrease verbosity")
+    args = parser.parse_args()
+
+    logger.setLevel(logging.WARN + 10*args.quiet - 10*args.verbose)
+
+    if args.collect:
+        if not args.site:
+            parser.error("Need --site for --collect")
+        rows = collect_timings(args.collect, args.site)
+        fh = open(args.timings, 'w') if args.timings else sys.stdout
+        writer = csv.DictWriter(fh, fieldnames=TIMINGS_COLUMNS, delimiter='\t')
+        writer.writeheader()
+        writer.writerows(rows)
+        if fh is not sys.stdout:
+            fh.close()
+        return
+
+    if not args.timings:
+        parser.error("Need timings file to replay (or --collect)")
+    with open(args.timings) as fh:
+        rows = list(csv.DictReader(fh, delimiter='\t'))
+    if replay(rows, args.max_slowdown):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
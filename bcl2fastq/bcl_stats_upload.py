@@ -23,6 +23,7 @@ if LIB_PATH not in sys.path:
     sys.path.insert(0, LIB_PATH)
 from config import rest_services
 from pipelines import get_machine_run_flowcell_id
+from bcl2fastq_qc import load_qc_summary
 
 
 __author__ = "Lavanya Veeravalli"
@@ -101,12 +102,17 @@ def main():
             if k == "Project_{}".format(args.mux_id):
                 data = {}
                 mux_dir = v.get('mux_dir')
-                index_html_path = glob.glob(
-                    os.path.join(args.out_dir, "out",
-                                 mux_dir, "html/*/all/all/all/lane.html"))
-                index_html = index_html_path[0]
+                # reuse demux html found by QC if possible
+                qc_summary = load_qc_summary(args.out_dir)
+                if qc_summary and qc_summary['muxes'].get(mux_dir, {}).get('html'):
+                    index_html = qc_summary['muxes'][mux_dir]['html']
+                else:
+                    index_html_path = glob.glob(
+                        os.path.join(args.out_dir, "out",
+                                     mux_dir, "html/*/all/all/all/lane.html"))
+                    index_html = index_html_path[0] if index_html_path else None
                 # FIXME should use the snakemake trigger to decide if complete
-                if os.path.exists(index_html):
+                if index_html and os.path.exists(index_html):
                     logger.info("Uploading stats for completed bcl2fastq %s", mux_dir)
                     data['path'] = index_html
                     data['software'] = soft_ver
@@ -12,7 +12,6 @@ import xml.etree.ElementTree as ET
 
 #--- third-party imports
 #
-import requests
 import yaml
 
 #--- project specific imports
@@ -22,7 +21,7 @@ LIB_PATH = os.path.abspath(
     os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "lib"))
 if LIB_PATH not in sys.path:
     sys.path.insert(0, LIB_PATH)
-from config import rest_services
+from elm import get_client
 from pipelines import get_machine_run_flowcell_id
 
 # WARNING changes here, must be reflected in bcl2fastq.py as well
@@ -111,74 +110,45 @@ def get_rest_data(run_num, test_server=None):
     """ Get rest info from ELM
     """
     if test_server:
-        rest_url = rest_services['run_details']['testing'].replace("run_num", run_num)
         logger.info("development server")
     else:
-        rest_url = rest_services['run_details']['production'].replace("run_num", run_num)
         logger.info("production server")
-    response = requests.get(rest_url)
-    if response.status_code != requests.codes.ok:
-        response.raise_for_status()
-        sys.exit(1)
-    rest_data = response.json()
-    logger.debug("rest_data from {}: {}".format(rest_url, rest_data))
-    return rest_data
+    return get_client(test_server).run_details(run_num)
 
-def main():
-    """
-    The main function
+
+def generate_bcl2fastq_cfg(rundir, outdir, test_server=False, force_overwrite=False,
+                           rest_data=None):
+    """Writes samplesheet, usebases and muxinfo config for rundir to
+    outdir. Queries ELM unless rest_data is given. Returns False if
+    the run didn't pass (no files are written in that case), True
+    otherwise
     """
-    parser = argparse.ArgumentParser(description=__doc__)
-    parser.add_argument("--force-overwrite",
-                        action="store_true",
-                        help="Force overwriting of output files")
-    parser.add_argument("-r", "--rundir",
-                        dest="rundir",
-                        required=True,
-                        help="rundir, e.g. /mnt/seq/userrig/HS004/HS004-PE-R00139_BC6A7HANXX")
-    parser.add_argument('-t', "--test-server", action='store_true')
-    parser.add_argument("-o", "--outdir",
-                        required=True,
-                        dest="outdir",
-                        help="Output directory")
-    parser.add_argument('-v', '--verbose', action='count', default=0,
-                        help="Increase verbosity")
-    parser.add_argument('-q', '--quiet', action='count', default=0,
-                        help="Decrease verbosity")
-    args = parser.parse_args()
 
-    # Repeateable -v and -q for setting logging level.
-    # See https://www.reddit.com/r/Python/comments/3nctlm/what_python_tools_should_i_be_using_on_every/
-    # and https://gist.github.com/andreas-wilm/b6031a84a33e652680d4
-    # script -vv -> DEBUG
-    # script -v -> INFO
-    # script -> WARNING
-    # script -q -> ERROR
-    # script -qq -> CRITICAL
-    # script -qqq -> no logging at all
-    logger.setLevel(logging.WARN + 10*args.quiet - 10*args.verbose)
+    runinfo = os.path.join(rundir, 'RunInfo.xml')
+    if not os.path.exists(runinfo):
+        raise ValueError("RunInfo '{}' does not exist under Run directory".format(runinfo))
+    if not os.path.exists(outdir):
+        raise ValueError("output directory '{}' does not exist".format(outdir))
 
-    (rundir, outdir, runinfo) = getdirs(args)
     samplesheet_csv = os.path.join(outdir, SAMPLESHEET_CSV)
     usebases_cfg = os.path.join(outdir, USEBASES_CFG)
     muxinfo_cfg = os.path.join(outdir, MUXINFO_CFG)
     for f in [samplesheet_csv, usebases_cfg, muxinfo_cfg]:
-        if not args.force_overwrite and os.path.exists(f):
-            logger.fatal("Refusing to overwrite existing file %s", f)
-            sys.exit(1)
+        if not force_overwrite and os.path.exists(f):
+            raise ValueError("Refusing to overwrite existing file {}".format(f))
 
     _, run_num, flowcellid = get_machine_run_flowcell_id(rundir)
-    logger.info("Querying ELM for %s", run_num)
-
-    rest_data = get_rest_data(run_num, args.test_server)
+    if rest_data is None:
+        logger.info("Querying ELM for %s", run_num)
+        rest_data = get_rest_data(run_num, test_server)
     assert rest_data['runId'], ("Rest data from ELM does not have runId {}".format(run_num))
 
     run_id = rest_data['runId']
     #counter = 0
     if rest_data['runPass'] != 'Pass':
         logger.warning("Skipping non-passed run")
-        # NOTE: exit 0 and missing output files is the upstream signal for a failed run
-        sys.exit(0)
+        # NOTE: missing output files is the upstream signal for a failed run
+        return False
 
     # this is the master samplesheet
     logger.info("Writing to %s", samplesheet_csv)
@@ -257,6 +227,51 @@ def main():
     with open(muxinfo_cfg, 'w') as fh:
         fh.write(yaml.dump([dict(mu._asdict()) for mu in mux_units.values()], \
             default_flow_style=True))
+    return True
+
+
+def main():
+    """
+    The main function
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--force-overwrite",
+                        action="store_true",
+                        help="Force overwriting of output files")
+    parser.add_argument("-r", "--rundir",
+                        dest="rundir",
+                        required=True,
+                        help="rundir, e.g. /mnt/seq/userrig/HS004/HS004-PE-R00139_BC6A7HANXX")
+    parser.add_argument('-t', "--test-server", action='store_true')
+    parser.add_argument("-o", "--outdir",
+                        required=True,
+                        dest="outdir",
+                        help="Output directory")
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+                        help="Increase verbosity")
+    parser.add_argument('-q', '--quiet', action='count', default=0,
+                        help="Decrease verbosity")
+    args = parser.parse_args()
+
+    # Repeateable -v and -q for setting logging level.
+    # See https://www.reddit.com/r/Python/comments/3nctlm/what_python_tools_should_i_be_using_on_every/
+    # and https://gist.github.com/andreas-wilm/b6031a84a33e652680d4
+    # script -vv -> DEBUG
+    # script -v -> INFO
+    # script -> WARNING
+    # script -q -> ERROR
+    # script -qq -> CRITICAL
+    # script -qqq -> no logging at all
+    logger.setLevel(logging.WARN + 10*args.quiet - 10*args.verbose)
+
+    (rundir, outdir, _) = getdirs(args)
+    try:
+        generate_bcl2fastq_cfg(rundir, outdir, args.test_server, args.force_overwrite)
+    except ValueError as e:
+        logger.fatal(e)
+        sys.exit(1)
+    # NOTE: exit 0 and missing output files is the upstream signal for a failed run
+
 
 if __name__ == "__main__":
     main()
@@ -9,8 +9,8 @@ import argparse
 import getpass
 
 #--- third party imports
-# WARN: need in conda root and snakemake env
-import pymongo
+#
+#/
 
 #--- project specific imports
 #
@@ -23,6 +23,7 @@ from utils import generate_timestamp
 from pipelines import get_site
 from pipelines import is_production_user
 from mongodb import mongodb_conn
+from mongodb import update_run_status
 
 __author__ = "Lavanya Veeravalli"
 __email__ = "veeravallil@gis.a-star.edu.sg"
@@ -81,48 +82,13 @@ def main():
     logger.info("Database connection established")
     db = connection.gisds.runcomplete
     logger.debug("DB %s", db)
-    logger.info("Status for %s is %s", run_number, args.status)
-    if args.status in ["STARTED", "SEQRUNFAILED"]:
-        try:
-            if not args.dry_run:
-                res = db.update_one({"run": run_number},
-                                    {"$push":
-                                     {"analysis": {
-                                         "analysis_id" : args.analysis_id,
-                                         "user_name" : user_name,
-                                         "out_dir" : args.out,
-                                         "Status" :  args.status,
-                                     }}})
-                assert res.modified_count == 1, (
-                    "Modified {} documents instead of 1".format(res.modified_count))
-        except (pymongo.errors.OperationFailure, AssertionError) as e:
-            logger.fatal("MongoDB update failure while setting run %s analysis_id %s to %s",
-                         run_number, args.analysis_id, args.status)
-            sys.exit(1)
-
-    elif args.status in ["SUCCESS", "FAILED"]:
+    end_time = None
+    if args.status in ["SUCCESS", "FAILED"]:
         end_time = generate_timestamp()
         logger.info("Setting timestamp to %s", end_time)
-        try:
-            if not args.dry_run:
-                res = db.update_one({"run": run_number, 'analysis.analysis_id' : args.analysis_id},
-                                    {"$set":
-                                     {"analysis.$": {
-                                         "analysis_id" : args.analysis_id,
-                                         "end_time" : end_time,
-                                         "user_name" : user_name,
-                                         "out_dir" : args.out,
-                                         "Status" :  args.status,
-                                     }}})
-                assert res.modified_count == 1, (
-                    "Modified {} documents instead of 1".format(res.modified_count))
-        except (pymongo.errors.OperationFailure, AssertionError) as e:
-            logger.fatal("MongoDB update failure while setting run %s analysis_id %s to %s",
-                         run_number, args.analysis_id, args.status)
-            sys.exit(1)
-
-    else:
-        raise ValueError(args.status)
+    if not update_run_status(db, run_number, args.analysis_id, args.status, args.out,
+                             user_name, end_time=end_time, dry_run=args.dry_run):
+        sys.exit(1)
 
     # close the connection to MongoDB
     connection.close()
@@ -9,8 +9,8 @@ import getpass
 import os
 
 #--- third party imports
-# WARN: need in conda root and snakemake env
-import pymongo
+#
+#/
 
 # project specific imports
 #
@@ -20,6 +20,7 @@ LIB_PATH = os.path.abspath(
 if LIB_PATH not in sys.path:
     sys.path.insert(0, LIB_PATH)
 from mongodb import mongodb_conn
+from mongodb import update_mux_statuses
 
 
 __author__ = "Lavanya Veeravalli"
@@ -81,61 +82,12 @@ def main():
         sys.exit(1)
     logger.info("Database connection established")
     db = connection.gisds.runcomplete
-    if args.mux_status == "SUCCESS":
-        try:
-            if not args.dry_run:
-                db.update({"run": run_number, 'analysis.analysis_id' : args.analysis_id},
-                          {
-                              "$push": {
-                                  "analysis.$.per_mux_status":  {
-                                      "mux_id" : args.mux_id,
-                                      "mux_dir" : args.mux_dir,
-                                      "Status" : args.mux_status,
-                                      "StatsSubmission" : "TODO",
-                                      "ArchiveSubmission" : "TODO",
-                                      "DownstreamSubmission" : "TODO",
-                                      "email_sent" : False,
-
-                                  }}})
-        except pymongo.errors.OperationFailure:
-            logger.fatal("mongoDB OperationFailure")
-            sys.exit(0)
-    elif args.mux_status == "FAILED":
-        try:
-            if not args.dry_run:
-                db.update({"run": run_number, 'analysis.analysis_id' : args.analysis_id},
-                          {
-                              "$push": {
-                                  "analysis.$.per_mux_status":  {
-                                      "mux_id" : args.mux_id,
-                                      "mux_dir" : args.mux_dir,
-                                      "Status" : args.mux_status,
-                                      "email_sent" : False,
-                                  }}})
-        except pymongo.errors.OperationFailure:
-            logger.fatal("mongoDB OperationFailure")
-            sys.exit(0)
-    elif args.mux_status == "NOARCHIVE":
-        try:
-            if not args.dry_run:
-                db.update({"run": run_number, 'analysis.analysis_id' : args.analysis_id},
-                          {
-                              "$push": {
-                                  "analysis.$.per_mux_status":  {
-                                      "mux_id" : args.mux_id,
-                                      "mux_dir" : args.mux_dir,
-                                      "Status" : args.mux_status,
-                                      "StatsSubmission" : "NOARCHIVE",
-                                      "ArchiveSubmission" : "NOARCHIVE",
-                                      "DownstreamSubmission" : "TODO",
-                                      "email_sent" : True,
-
-                                  }}})
-        except pymongo.errors.OperationFailure:
-            logger.fatal("mongoDB OperationFailure")
-            sys.exit(0)
-    else:
-        raise ValueError(args.status)
+    failed = update_mux_statuses(db, run_number, args.analysis_id,
+                                 [(args.mux_id, args.mux_dir, args.mux_status)],
+                                 dry_run=args.dry_run)
+    if failed:
+        logger.fatal("mongoDB OperationFailure")
+        sys.exit(0)
      # close the connection to MongoDB
     connection.close()
 
@@ -27,6 +27,7 @@ from pipelines import generate_window, send_mail
 from pipelines import is_devel_version
 from pipelines import path_to_url
 from pipelines import is_production_user
+from bcl2fastq_qc import load_qc_summary
 
 
 __author__ = "Lavanya Veeravalli"
@@ -63,6 +64,23 @@ def get_requestor(mux_id, cfg_file):
     return None
 
 
+def qc_summary_for_email(out_dir, mux_dir):
+    """Return per lane QC stats for mux_dir formatted for email body,
+    based on the QC summary of bcl2fastq_qc.py. Empty if the summary
+    is missing
+    """
+    qc_summary = load_qc_summary(out_dir)
+    if not qc_summary or mux_dir not in qc_summary['muxes']:
+        return ""
+    text = "\n\nQC summary:"
+    for lane in qc_summary['muxes'][mux_dir]['lanes']:
+        values = qc_summary['lanes'][str(lane)]
+        text += "\n- Lane {}: {} PF clusters, {} Mbases, {}% >= Q30 bases".format(
+            lane, values['PF Clusters'], values['Yield (Mbases)'],
+            values['% >= Q30 bases'])
+    return text
+
+
 def main():
     """main function
     """
@@ -161,6 +179,7 @@ def main():
                         mux_id, run_number)
                     body += "\n\nA summary can be found at {}".format(summary)
                     body += "\n\nFastQ files are located in {}".format(muxdir)
+                    body += qc_summary_for_email(out_dir, mux_status.get('mux_dir'))
                     body += "\n\nData can also be downloaded from GIS-SRA (once archival is complete)"
                     
                     confinfo = os.path.join(out_dir, 'conf.yaml')
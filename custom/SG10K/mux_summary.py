@@ -7,10 +7,17 @@ import glob
 import os
 import csv
 import sys
+import itertools
 
 import yaml
 import xlsxwriter
 
+LIB_PATH = os.path.abspath(
+    os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "..", "lib"))
+if LIB_PATH not in sys.path:
+    sys.path.insert(0, LIB_PATH)
+from utils import reverse_lines
+
 WRITE_CSV = False
 WRITE_XLS = True
 WRITE_CONSOLE = False
@@ -88,12 +95,11 @@ def check_completion(conf_yamls, num_expected):
             cfg = dict(yaml.safe_load(fh))
         num_samples = len(cfg['samples'])
         snake_log = os.path.join(os.path.dirname(f), "logs/snakemake.log")
-        with open(snake_log) as fh:
-            loglines = fh.readlines()
-            if 'Pipeline run successfully completed' in ''.join(loglines[-10:]):
-                num_complete += num_samples
-            else:
-                num_incomplete += num_samples
+        lastlines = itertools.islice(reverse_lines(snake_log), 10)
+        if any('Pipeline run successfully completed' in l for l in lastlines):
+            num_complete += num_samples
+        else:
+            num_incomplete += num_samples
     print("{} completed".format(num_complete))
     print("{} incomplete".format(num_incomplete))
     print("(Note, numbers can be misleading for multisample runs (a single failure anywhere fails all samples)")
@@ -12,7 +12,6 @@ from collections import namedtuple
 
 #--- third party imports
 #
-import requests
 import pymongo
 import yaml
 
@@ -23,7 +22,7 @@ LIB_PATH = os.path.abspath(
     os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "lib"))
 if LIB_PATH not in sys.path:
     sys.path.insert(0, LIB_PATH)
-from config import rest_services
+from elm import get_client
 from config import legacy_mapper
 from mongodb import mongodb_conn
 from pipelines import generate_window
@@ -227,16 +226,10 @@ def get_lib_details(run_num_flowcell, mux_list, testing):
     _, run_num, _ = get_machine_run_flowcell_id(run_num_flowcell)
     # Call rest service to get component libraries
     if testing:
-        rest_url = rest_services['run_details']['testing'].replace("run_num", run_num)
         logger.info("development server")
     else:
-        rest_url = rest_services['run_details']['production'].replace("run_num", run_num)
         logger.info("production server")
-    response = requests.get(rest_url)
-    if response.status_code != requests.codes.ok:
-        response.raise_for_status()
-    rest_data = response.json()
-    logger.debug("rest_data from %s: %s", rest_url, rest_data)
+    rest_data = get_client(testing).run_details(run_num)
     sample_info = {}
     mux_analysis_list = set()
     if rest_data.get('runId') is None:
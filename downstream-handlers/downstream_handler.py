@@ -14,6 +14,8 @@ import glob
 from datetime import datetime
 import tempfile
 import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 #--- third party imports
 #
@@ -21,6 +23,7 @@ import subprocess
 import dateutil.parser
 import yaml
 from bson.objectid import ObjectId
+from pymongo import UpdateOne
 
 #--- project specific imports
 #
@@ -38,6 +41,8 @@ from pipelines import PipelineHandler
 from pipelines import is_devel_version
 from pipelines import get_site
 from starterflag import StarterFlag
+from utils import load_json_cache
+from utils import save_json_cache
 path_devel = LIB_PATH + "/../"
 
 
@@ -66,6 +71,20 @@ LOGGER.addHandler(HANDLER)
 # warning thresholds
 THRESHOLD_H_SINCE_LAST_TIMESTAMP = 24
 THRESHOLD_H_SINCE_START = 72
+# warn if checking a single log takes longer (slow filesystem)
+THRESHOLD_SEC_LOG_CHECK = 10
+
+# threads for parsing snakemake logs
+DEFAULT_NUM_THREADS = 8
+
+# incremental mode: state (high-water mark etc.) is kept here
+STATE_FILE_FMT = os.path.expanduser("~/.downstream_handler.{site}.{server}.json")
+# new jobs are queried with this overlap (ms) to catch late inserts
+HWM_OVERLAP_MS = 10*60*1000
+# incremental mode falls back to a full scan after this many hours.
+# restarts of completed jobs are only picked up by full scans
+FULL_SCAN_INTERVAL_H = 6
+ACTIVE_STATUSES = ['STARTED', 'RESTART']
 
 def start_cmd_execution(record, site, out_dir, testing):
     """ Start the analysis
@@ -146,56 +165,105 @@ def list_starterflags(path):
     return glob.glob(os.path.join(
         path, StarterFlag.pattern.format(timestamp="*")))
 
-def set_completion_if(dbcol, dbid, out_dir, dryrun=False):
-    """Update values for already started job based on log file in out_dir
+def warn_if_overdue(dbid, start_time, last_time):
+    """Warn if job dbid was started (start_time) or last active
+    (last_time; may be None) a long time ago
     """
-
-    rec = dbcol.find_one({"_id": dbid})
-    assert rec, "No objects found with db-id {}".format(dbid)
-
-    assert rec.get('execution'), ("Looks like job %s was never started", dbid)
-    old_status = rec['execution'].get('status')
-    start_time = rec['execution'].get('start_time')
-    out_dir = rec['execution'].get('out_dir')
-    assert old_status and start_time, (
-        "Job start for %s was not logged properly (status or start_time not set)", dbid)
-    assert rec['execution']['out_dir'] == out_dir
-
+    if last_time:# without status end_time means last seen time in snakemake
+        delta = datetime.now() - dateutil.parser.parse(last_time)
+        diff_min, _ = divmod(delta.days * 86400 + delta.seconds, 60)
+        diff_hours = diff_min/60.0
+        if diff_hours > THRESHOLD_H_SINCE_LAST_TIMESTAMP:
+            LOGGER.warning("Last log update for job id %s was %s hours ago. That's a bit long.", dbid, diff_hours)
+    # Re-convert start_time from isoformat as it happens in generate_timestamp()
+    delta = datetime.now() - dateutil.parser.parse(start_time.replace("-", ":"))
+    diff_min, _ = divmod(delta.days * 86400 + delta.seconds, 60)
+    diff_hours = diff_min/60.0
+    if diff_hours > THRESHOLD_H_SINCE_START:
+        LOGGER.warning("Job id %s was started %s hours ago. That's a bit long", dbid, diff_hours)
+
+
+def job_log_status(dbid, out_dir, prev_log_mtime=None):
+    """Return status, end time, log mtime and seconds spent for job
+    dbid based on snakemake log in out_dir. Status and end time are
+    'UNCHANGED' and None if the log mtime equals prev_log_mtime.
+    Meant to be run in a thread
+    """
+    start = time.time()
     snakelog = os.path.join(out_dir, PipelineHandler.MASTERLOG)
     LOGGER.info("Checking snakemake log %s for status of job %s", snakelog, dbid)
     assert os.path.exists(snakelog), (
         "Expected snakemake log file %s for job %s doesn't exist.", snakelog, dbid)
+    mtime = os.path.getmtime(snakelog)
+    if prev_log_mtime is not None and mtime == prev_log_mtime:
+        status, end_time = 'UNCHANGED', None
+    else:
+        status, end_time = snakemake_log_status(snakelog, use_sidecar=True)
+    return status, end_time, mtime, time.time() - start
+
+
+def set_completion_if(dbcol, jobs, log_mtimes, prev_log_mtimes=None,
+                      num_threads=DEFAULT_NUM_THREADS, dryrun=False):
+    """Update values for already started jobs based on log files.
+    jobs is a list of (dbid, out_dir) tuples. Logs are parsed in
+    parallel, DB records are read with one query and updated with one
+    bulk write. Log mtimes are recorded in log_mtimes. Logs whose mtime
+    equals the one in prev_log_mtimes (if given) aren't parsed again
+    """
+
+    if not jobs:
+        return
+    recs = dict((rec['_id'], rec) for rec in dbcol.find(
+        {"_id": {"$in": [ObjectId(dbid) for dbid, _ in jobs]}},
+        {"execution": 1}))
+    for dbid, out_dir in jobs:
+        rec = recs.get(ObjectId(dbid))
+        assert rec, "No objects found with db-id {}".format(dbid)
+        assert rec.get('execution'), ("Looks like job %s was never started", dbid)
+        assert rec['execution'].get('status') and rec['execution'].get('start_time'), (
+            "Job start for %s was not logged properly (status or start_time not set)", dbid)
+        assert rec['execution'].get('out_dir') == out_dir
+
+    if prev_log_mtimes is None:
+        prev_log_mtimes = dict()
+    ops = []
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        futures = [(dbid, executor.submit(job_log_status, dbid, out_dir,
+                                          prev_log_mtimes.get(str(dbid))))
+                   for dbid, out_dir in jobs]
+        for dbid, future in futures:
+            # don't let one broken job (e.g. missing log) stop updates for the others
+            try:
+                status, end_time, mtime, secs = future.result()
+            except Exception as err:
+                LOGGER.error("Checking log of job %s failed: %s", dbid, err)
+                continue
+            log_mtimes[str(dbid)] = mtime
+            if secs > THRESHOLD_SEC_LOG_CHECK:
+                LOGGER.warning("Checking log of job %s took %.1fs", dbid, secs)
+            else:
+                LOGGER.debug("Checking log of job %s took %.1fs", dbid, secs)
+            LOGGER.info("Job %s has status %s (end time %s)",
+                        dbid, status, end_time)
+
+            if status in ["SUCCESS", "ERROR"]:
+                assert end_time
+                ops.append(UpdateOne(
+                    {"_id": ObjectId(dbid)},
+                    {"$set": {"execution.status": "SUCCESS" if status == "SUCCESS" else "FAILED",
+                              "execution.end_time": end_time}}))
+            else:
+                start_time = recs[ObjectId(dbid)]['execution']['start_time']
+                if status == 'UNCHANGED':
+                    end_time = datetime.fromtimestamp(mtime).isoformat()
+                warn_if_overdue(dbid, start_time, end_time)
 
-    status, end_time = snakemake_log_status(snakelog)
-    LOGGER.info("Job %s has status %s (end time %s)",
-                dbid, status, end_time)
     if dryrun:
         LOGGER.info("Skipping DB update due to dryrun option")
         return
-
-    if status == "SUCCESS":
-        assert end_time
-        dbcol.update_one({"_id": ObjectId(dbid)},
-                         {"$set": {"execution.status": "SUCCESS",
-                                   "execution.end_time": end_time}})
-    elif status == "ERROR":
-        assert end_time
-        dbcol.update_one({"_id": ObjectId(dbid)},
-                         {"$set": {"execution.status": "FAILED",
-                                   "execution.end_time": end_time}})
-    else:
-        if end_time:# without status end_time means last seen time in snakemake
-            delta = datetime.now() - dateutil.parser.parse(end_time)
-            diff_min, _ = divmod(delta.days * 86400 + delta.seconds, 60)
-            diff_hours = diff_min/60.0
-            if diff_hours > THRESHOLD_H_SINCE_LAST_TIMESTAMP:
-                LOGGER.warning("Last log update for job id %s was %s hours ago. That's a bit long.", dbid, diff_hours)
-        # Re-convert start_time from isoformat as it happens in generate_timestamp()
-        delta = datetime.now() - dateutil.parser.parse(start_time.replace("-", ":"))
-        diff_min, _ = divmod(delta.days * 86400 + delta.seconds, 60)
-        diff_hours = diff_min/60.0
-        if diff_hours > THRESHOLD_H_SINCE_START:
-            LOGGER.warning("Job id %s was started %s hours ago. That's a bit long", dbid, diff_hours)
+    if ops:
+        res = dbcol.bulk_write(ops, ordered=False)
+        LOGGER.info("Set completion for %d jobs", res.modified_count)
 
 
 def set_started(dbcol, dbid, start_time, dryrun=False):
@@ -244,6 +312,18 @@ def set_started(dbcol, dbid, start_time, dryrun=False):
         raise ValueError(mode)
 
 
+def incremental_query(site, epoch_then, hwm):
+    """Return query for jobs which might have changed since the last
+    tick: jobs created after the high-water mark hwm (epoch ms) plus
+    all started but not completed jobs
+    """
+    return {"ctime": {"$gt": epoch_then}, "site": site,
+            "$or": [{"ctime": {"$gt": hwm - HWM_OVERLAP_MS}},
+                    {"execution.status": {"$in": ACTIVE_STATUSES}},
+                    {"execution": {"$exists": True},
+                     "execution.status": {"$exists": False}}]}
+
+
 def main():
     """main function
     """
@@ -255,6 +335,16 @@ def main():
     default = 14
     parser.add_argument('-w', '--win', type=int, default=default,
                         help="Number of days to look back (default {})".format(default))
+    default = DEFAULT_NUM_THREADS
+    parser.add_argument('--threads', type=int, default=default,
+                        help="Number of threads for checking logs (default {})".format(default))
+    parser.add_argument('-i', '--incremental', action='store_true',
+                        help="Only process new jobs and jobs whose state might have changed"
+                        " since the last tick. A full scan is done if no state from the"
+                        " last tick exists or it's older than {}h".format(FULL_SCAN_INTERVAL_H))
+    parser.add_argument('--state-file',
+                        help="State file for --incremental (default: {})".format(
+                            STATE_FILE_FMT))
     parser.add_argument('-v', '--verbose', action='count', default=0,
                         help="Increase verbosity")
     parser.add_argument('-q', '--quiet', action='count', default=0,
@@ -276,10 +366,35 @@ def main():
     dbcol = connection.gisds.pipeline_runs
     site = get_site()
     epoch_now, epoch_then = generate_window(args.win)
-    cursor = dbcol.find({"ctime": {"$gt": epoch_then, "$lt": epoch_now}, "site" : site})
+
+    # state of last tick (incremental mode only)
+    state = None
+    prev_log_mtimes = None
+    if args.incremental:
+        state_file = args.state_file
+        if not state_file:
+            state_file = STATE_FILE_FMT.format(
+                site=site, server='testing' if args.testing else 'production')
+        state_key = {'site': site, 'testing': args.testing}
+        state = load_json_cache(state_file, state_key)
+        if state and time.time() - state['last_full_scan'] < FULL_SCAN_INTERVAL_H*3600:
+            prev_log_mtimes = state['log_mtimes']
+        else:
+            LOGGER.info("Doing full scan")
+            state = {'hwm': 0, 'last_full_scan': time.time()}
+    log_mtimes = dict()
+    # started jobs to check for completion
+    completion_jobs = []
+
+    if prev_log_mtimes is not None:
+        cursor = dbcol.find(incremental_query(site, epoch_then, state['hwm']))
+    else:
+        cursor = dbcol.find({"ctime": {"$gt": epoch_then, "$lt": epoch_now}, "site" : site})
     LOGGER.info("Looping through {} jobs".format(cursor.count()))
     for job in cursor:
         dbid = job['_id']
+        if state is not None:
+            state['hwm'] = max(state['hwm'], job['ctime'])
 
         # only set here to avoid code duplication below
         try:
@@ -329,12 +444,22 @@ def main():
 
         elif job['execution'].get('status') in ['STARTED', 'RESTART']:
             LOGGER.info('Job %s in %s set as re|started so checking on completion', dbid, out_dir)
-            set_completion_if(dbcol, dbid, out_dir, dryrun=args.dryrun)
+            completion_jobs.append((dbid, out_dir))
 
         else:
             # job complete
             LOGGER.debug('Job %s in %s should be completed', dbid, out_dir)
 
+    set_completion_if(dbcol, completion_jobs, log_mtimes, prev_log_mtimes,
+                      num_threads=args.threads, dryrun=args.dryrun)
+
+    if state is not None and not args.dryrun:
+        state['log_mtimes'] = log_mtimes
+        try:
+            save_json_cache(state_file, state_key, state)
+        except OSError as e:
+            LOGGER.warning("Couldn't save state to %s: %s", state_file, e)
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,443 @@
+"""BGZF (blocked gzip) and tabix helpers, mainly for concatenating
+region-split VCFs without decompressing and recompressing all of them.
+
+See the SAM/BAM format specification (section 4.1) for BGZF and the
+tabix specification for the index format.
+"""
+
+#--- standard library imports
+#
+import os
+import gzip
+import struct
+import zlib
+from collections import OrderedDict
+
+#--- third-party imports
+#
+#/ should be none
+
+#--- project specific imports
+#
+#/
+
+
+__author__ = "Andreas Wilm"
+__email__ = "wilma@gis.a-star.edu.sg"
+__copyright__ = "2017 Genome Institute of Singapore"
+__license__ = "The MIT License (MIT)"
+
+
+# empty block marking end of file
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+# max. uncompressed bytes per block as used by bgzip
+BGZF_BLOCK_DATA_SIZE = 0xff00
+BGZF_MAX_BLOCK_SIZE = 0x10000
+# fixed gzip header part up to and including XLEN
+GZIP_HEADER_LEN = 12
+# tabix pseudo-bin holding offsets and record counts (min_shift 14)
+TABIX_META_BIN = 37450
+
+COPY_BUFSIZE = 16*1024*1024
+
+
+def read_block(fh):
+    """read next BGZF block from fh. returns (raw block, uncompressed
+    size) or None at end of file. raises ValueError if the data isn't
+    BGZF
+    """
+    header = fh.read(GZIP_HEADER_LEN)
+    if not header:
+        return None
+    if len(header) < GZIP_HEADER_LEN or header[:4] != b"\x1f\x8b\x08\x04":
+        raise ValueError("Not a BGZF block")
+    xlen = struct.unpack("<H", header[10:12])[0]
+    extra = fh.read(xlen)
+    bsize = None
+    i = 0
+    while i + 4 <= len(extra):
+        slen = struct.unpack("<H", extra[i+2:i+4])[0]
+        if extra[i:i+2] == b"BC" and slen == 2:
+            bsize = struct.unpack("<H", extra[i+4:i+6])[0]
+        i += 4 + slen
+    if bsize is None:
+        raise ValueError("Not a BGZF block (no BC field)")
+    rest = fh.read(bsize + 1 - GZIP_HEADER_LEN - xlen)
+    block = header + extra + rest
+    if len(block) != bsize + 1:
+        raise ValueError("Truncated BGZF block")
+    return block, struct.unpack("<I", block[-4:])[0]
+
+
+def block_data(block):
+    """return uncompressed data of raw BGZF block"""
+    xlen = struct.unpack("<H", block[10:12])[0]
+    return zlib.decompress(block[GZIP_HEADER_LEN+xlen:-8], -15)
+
+
+def compress_block(data):
+    """return BGZF block(s) for data as bytes. data is split if it
+    doesn't compress into a single block
+    """
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+    bsize = len(cdata) + 25
+    if bsize > BGZF_MAX_BLOCK_SIZE:
+        half = len(data) // 2
+        return compress_block(data[:half]) + compress_block(data[half:])
+    return b"".join([b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00",
+                     struct.pack("<H", bsize), cdata,
+                     struct.pack("<I", zlib.crc32(data) & 0xffffffff),
+                     struct.pack("<I", len(data))])
+
+
+def is_bgzf(filename):
+    """check whether filename starts with a BGZF block"""
+    with open(filename, 'rb') as fh:
+        try:
+            return read_block(fh) is not None
+        except ValueError:
+            return False
+
+
+def has_eof_block(filename):
+    """check whether filename ends with the BGZF EOF marker"""
+    with open(filename, 'rb') as fh:
+        fh.seek(0, os.SEEK_END)
+        if fh.tell() < len(BGZF_EOF):
+            return False
+        fh.seek(-len(BGZF_EOF), os.SEEK_END)
+        return fh.read() == BGZF_EOF
+
+
+class BgzfWriter(object):
+    """Writes BGZF. Compresses data passed to write() and copies raw
+    blocks verbatim via write_raw()
+    """
+
+    def __init__(self, filename):
+        self.fh = open(filename, 'wb')
+        self._buf = bytearray()
+
+
+    def write(self, data):
+        """compress and write data"""
+        self._buf.extend(data)
+        while len(self._buf) >= BGZF_BLOCK_DATA_SIZE:
+            self.fh.write(compress_block(bytes(self._buf[:BGZF_BLOCK_DATA_SIZE])))
+            del self._buf[:BGZF_BLOCK_DATA_SIZE]
+
+
+    def flush(self):
+        """compress and write buffered data as (non-full) block"""
+        if self._buf:
+            self.fh.write(compress_block(bytes(self._buf)))
+            self._buf = bytearray()
+
+
+    def tell(self):
+        """return file offset of next block (flushes)"""
+        self.flush()
+        return self.fh.tell()
+
+
+    def write_raw(self, fhin, size):
+        """copy size bytes of raw blocks from fhin"""
+        self.flush()
+        while size > 0:
+            buf = fhin.read(min(size, COPY_BUFSIZE))
+            if not buf:
+                raise ValueError("Premature end of input")
+            self.fh.write(buf)
+            size -= len(buf)
+
+
+    def close(self):
+        """flush and add EOF marker"""
+        self.flush()
+        self.fh.write(BGZF_EOF)
+        self.fh.close()
+
+
+class HeaderScanner(object):
+    """Finds end of header (lines starting with '#') in a stream of
+    data chunks
+    """
+
+    def __init__(self):
+        self.at_line_start = True
+
+
+    def scan(self, data):
+        """return offset of first non-header byte in data chunk or None
+        if data is all header
+        """
+        i = 0
+        while i < len(data):
+            if self.at_line_start and data[i:i+1] != b"#":
+                return i
+            j = data.find(b"\n", i)
+            if j < 0:
+                self.at_line_start = False
+                return None
+            i = j + 1
+            self.at_line_start = True
+        return None
+
+
+class OffsetMapper(object):
+    """Maps tabix virtual offsets of an input file to the concatenated
+    output. Blocks from raw_start on were copied with a constant
+    shift. The block at rewritten_coffset (if any) was rewritten
+    without the first skip bytes, starting at output offset
+    rewritten_out
+    """
+
+    def __init__(self, shift, raw_start=0, rewritten_coffset=None, skip=0,
+                 rewritten_out=None):
+        self.shift = shift
+        self.raw_start = raw_start
+        self.rewritten_coffset = rewritten_coffset
+        self.skip = skip
+        self.rewritten_out = rewritten_out
+        # uncompressed offsets at which compress_block() split the
+        # rewritten data (mostly none) and output offsets of blocks
+        self.splits = []
+
+
+    def __call__(self, voffset):
+        coffset, uoffset = voffset >> 16, voffset & 0xffff
+        if coffset == self.rewritten_coffset:
+            uoffset -= self.skip
+            out = self.rewritten_out
+            for split_u, split_out in self.splits:
+                if uoffset < split_u:
+                    break
+                uoffset -= split_u
+                out = split_out
+            return (out << 16) | uoffset
+        if coffset < self.raw_start:
+            raise ValueError("Virtual offset {} points into removed header".format(voffset))
+        return ((coffset + self.shift) << 16) | uoffset
+
+
+class TabixIndex(object):
+    """Tabix index: header fields, sequence names and per sequence a
+    dict of bin: list of chunks (pairs of virtual offsets) and a
+    linear index (list of virtual offsets)
+    """
+
+    def __init__(self):
+        # format, col_seq, col_beg, col_end, meta, skip
+        self.header = None
+        self.refs = OrderedDict()
+        self.n_no_coor = None
+
+
+    @classmethod
+    def read(cls, filename):
+        """parse tabix index"""
+        with gzip.open(filename, 'rb') as fh:
+            data = fh.read()
+        if data[:4] != b"TBI\x01":
+            raise ValueError("Not a tabix index: {}".format(filename))
+        index = cls()
+        n_ref = struct.unpack("<i", data[4:8])[0]
+        index.header = struct.unpack("<6i", data[8:32])
+        l_nm = struct.unpack("<i", data[32:36])[0]
+        names = data[36:36+l_nm].split(b"\x00")[:n_ref]
+        pos = 36 + l_nm
+        for name in names:
+            bins = OrderedDict()
+            n_bin = struct.unpack("<i", data[pos:pos+4])[0]
+            pos += 4
+            for _ in range(n_bin):
+                bin_no, n_chunk = struct.unpack("<Ii", data[pos:pos+8])
+                pos += 8
+                chunks = struct.unpack("<{}Q".format(2*n_chunk), data[pos:pos+16*n_chunk])
+                pos += 16*n_chunk
+                bins[bin_no] = [list(chunks[i:i+2]) for i in range(0, len(chunks), 2)]
+            n_intv = struct.unpack("<i", data[pos:pos+4])[0]
+            pos += 4
+            intervals = list(struct.unpack("<{}Q".format(n_intv), data[pos:pos+8*n_intv]))
+            pos += 8*n_intv
+            index.refs[name.decode()] = (bins, intervals)
+        if len(data) >= pos + 8:
+            index.n_no_coor = struct.unpack("<Q", data[pos:pos+8])[0]
+        return index
+
+
+    def write(self, filename):
+        """write tabix index (BGZF compressed)"""
+        names = b"".join(name.encode() + b"\x00" for name in self.refs)
+        parts = [b"TBI\x01", struct.pack("<i", len(self.refs)),
+                 struct.pack("<6i", *self.header), struct.pack("<i", len(names)), names]
+        for bins, intervals in self.refs.values():
+            parts.append(struct.pack("<i", len(bins)))
+            for bin_no, chunks in bins.items():
+                parts.append(struct.pack("<Ii", bin_no, len(chunks)))
+                parts.append(struct.pack("<{}Q".format(2*len(chunks)),
+                                         *[v for chunk in chunks for v in chunk]))
+            parts.append(struct.pack("<i", len(intervals)))
+            parts.append(struct.pack("<{}Q".format(len(intervals)), *intervals))
+        if self.n_no_coor is not None:
+            parts.append(struct.pack("<Q", self.n_no_coor))
+        writer = BgzfWriter(filename)
+        writer.write(b"".join(parts))
+        writer.close()
+
+
+    def merge(self, other, mapper):
+        """merge other index into this one, mapping its virtual offsets
+        with mapper. other's records have to follow this one's
+        """
+        if self.header is None:
+            self.header = other.header
+        if other.n_no_coor is not None:
+            self.n_no_coor = (self.n_no_coor or 0) + other.n_no_coor
+        for name, (bins, intervals) in other.refs.items():
+            my_bins, my_intervals = self.refs.setdefault(name, (OrderedDict(), []))
+            for bin_no, chunks in bins.items():
+                if bin_no == TABIX_META_BIN:
+                    # offset range and mapped/unmapped counts
+                    (beg, end), (mapped, unmapped) = chunks
+                    beg, end = mapper(beg), mapper(end)
+                    if bin_no in my_bins:
+                        (my_beg, my_end), (my_mapped, my_unmapped) = my_bins[bin_no]
+                        beg, end = min(beg, my_beg), max(end, my_end)
+                        mapped, unmapped = mapped + my_mapped, unmapped + my_unmapped
+                    my_bins[bin_no] = [[beg, end], [mapped, unmapped]]
+                else:
+                    my_bins.setdefault(bin_no, []).extend(
+                        [[mapper(beg), mapper(end)] for beg, end in chunks])
+            # linear index is a lower bound per window. 0 means unset
+            for i, ioff in enumerate(intervals):
+                ioff = mapper(ioff) if ioff else 0
+                if i < len(my_intervals):
+                    if ioff and my_intervals[i]:
+                        my_intervals[i] = min(my_intervals[i], ioff)
+                    else:
+                        my_intervals[i] = my_intervals[i] or ioff
+                else:
+                    my_intervals.append(ioff)
+
+
+def concat_vcfs(infiles, outfile, tbi=None):
+    """concatenate (region-split) VCFs into bgzipped outfile, keeping
+    only the first header. BGZF input blocks are copied verbatim,
+    except the one where the header ends, which is rewritten without
+    header. Non-BGZF input (plain or gzip) is recompressed.
+
+    If tbi is given, the tabix index is merged from the inputs' indices
+    (<infile>.tbi). returns False if that's not possible, because an
+    input with records isn't BGZF or has no usable index, in which
+    case tabix needs to be run on outfile. Otherwise returns True
+    """
+    writer = BgzfWriter(outfile)
+    index = TabixIndex() if tbi else None
+    header_written = False
+    for infile in infiles:
+        if is_bgzf(infile):
+            header_written, mapper = _concat_bgzf(writer, infile, header_written)
+        else:
+            header_written, mapper = _concat_other(writer, infile, header_written)
+        if index is None or mapper is False:
+            # no records
+            continue
+        try:
+            if mapper is None:
+                raise ValueError("Can't map offsets of {}".format(infile))
+            index.merge(TabixIndex.read(infile + ".tbi"), mapper)
+        except (IOError, OSError, ValueError, struct.error, EOFError):
+            index = None
+    writer.close()
+
+    if not tbi:
+        return True
+    if index is None:
+        return False
+    if index.header is None:
+        # no records at all: need a proper (empty) index from tabix
+        return False
+    index.write(tbi)
+    return True
+
+
+def _concat_bgzf(writer, infile, header_written):
+    """append BGZF infile to writer, dropping its header if
+    header_written. returns updated header_written and an
+    OffsetMapper for infile, or False if infile has no records
+    """
+    size = os.path.getsize(infile)
+    if has_eof_block(infile):
+        size -= len(BGZF_EOF)
+    if size == 0:
+        return header_written, False
+    with open(infile, 'rb') as fh:
+        if not header_written:
+            out = writer.tell()
+            writer.write_raw(fh, size)
+            # header only or no data at all still counts as no records
+            return True, OffsetMapper(out)
+
+        scanner = HeaderScanner()
+        while True:
+            coffset = fh.tell()
+            if coffset >= size:
+                return header_written, False
+            block, _ = read_block(fh)
+            data = block_data(block)
+            skip = scanner.scan(data)
+            if skip is not None:
+                break
+        rewritten_out = writer.tell()
+        mapper = OffsetMapper(None, fh.tell(), coffset, skip, rewritten_out)
+        remainder = data[skip:]
+        if remainder:
+            # blocks written by compress_block() for the remainder
+            blocks = compress_block(remainder)
+            pos = 0
+            u = 0
+            while pos < len(blocks):
+                bsize = struct.unpack("<H", blocks[pos+16:pos+18])[0] + 1
+                isize = struct.unpack("<I", blocks[pos+bsize-4:pos+bsize])[0]
+                if pos:
+                    mapper.splits.append((u, rewritten_out + pos))
+                u = isize
+                pos += bsize
+            writer.fh.write(blocks)
+        mapper.shift = writer.tell() - fh.tell()
+        writer.write_raw(fh, size - fh.tell())
+    return header_written, mapper
+
+
+def _concat_other(writer, infile, header_written):
+    """append plain or gzipped infile to writer, dropping its header if
+    header_written. returns updated header_written and None (offsets
+    can't be mapped) or False if infile has no records
+    """
+    with open(infile, 'rb') as fh:
+        is_gzip = fh.read(2) == b"\x1f\x8b"
+    scanner = HeaderScanner()
+    in_header = True
+    has_header = has_records = False
+    with (gzip.open(infile, 'rb') if is_gzip else open(infile, 'rb')) as fh:
+        while True:
+            data = fh.read(COPY_BUFSIZE)
+            if not data:
+                break
+            if in_header:
+                skip = scanner.scan(data)
+                if skip is None:
+                    has_header = True
+                    if not header_written:
+                        writer.write(data)
+                    continue
+                in_header = False
+                has_header = has_header or skip > 0
+                if not header_written:
+                    writer.write(data[:skip])
+                data = data[skip:]
+            has_records = has_records or len(data) > 0
+            writer.write(data)
+    return header_written or has_header, None if has_records else False
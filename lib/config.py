@@ -1,11 +1,12 @@
 #!/usr/bin/env python3
-"""Imports and parse rest services
+"""Imports and parse rest services and other site configs. Configs
+are only parsed on first access.
 """
 
 # standard library imports
 import os
-import sys
 import logging
+from collections.abc import Mapping
 
 # third party imports
 import yaml
@@ -30,43 +31,58 @@ handler.setFormatter(logging.Formatter(
     '[{asctime}] {levelname:8s} {filename} {message}', style='{'))
 logger.addHandler(handler)
 
-with open(SITE_CFG_FILE, 'r') as stream:
-    try:
-        site_cfg = yaml.load(stream)
-    except yaml.YAMLError as exc:
-        logger.fatal("Error in loading %s", SITE_CFG_FILE)
-        raise
-
-with open(REST_CFG_FILE, 'r') as stream:
-    try:
-        rest_services = yaml.load(stream)
-    except yaml.YAMLError as exc:
-        logger.fatal("Error loading %s", REST_CFG_FILE)
-        raise
-    
-with open(BCL2FASTQQC_CFG_FILE, 'r') as stream:
-    try:
-        bcl2fastq_qc_conf = yaml.load(stream)
-    except yaml.YAMLError as exc:
-        logger.fatal("Error in loading %s", BCL2FASTQQC_CFG_FILE)
-        raise
-with open(MONGO_CFG_FILE, 'r') as stream:
-    try:
-        mongo_conns = yaml.load(stream)
-    except yaml.YAMLError as exc:
-        logger.fatal("Error in loading %s", MONGO_CFG_FILE)
-        raise
-
-with open(LEGACY_MAPPER_CFG_FILE, 'r') as stream:
-    try:
-        legacy_mapper = yaml.load(stream)
-    except yaml.YAMLError as exc:
-        logger.fatal("Error in loading %s", LEGACY_MAPPER_CFG_FILE)
-        raise
-
-with open(NOVOGENE_CFG_FILE, 'r') as stream:
-    try:
-        novogene_conf = yaml.load(stream)
-    except yaml.YAMLError as exc:
-        logger.fatal("Error in loading %s", NOVOGENE_CFG_FILE)
-        raise
+# C implementation is much faster, but might not be available
+try:
+    YamlLoader = yaml.CSafeLoader
+except AttributeError:
+    YamlLoader = yaml.SafeLoader
+
+
+class LazyConfig(Mapping):
+    """Read-only dict-like access to a yaml config file, which is only
+    parsed on first access. Means importing this module doesn't cost
+    anything for configs that are never used.
+    """
+
+    def __init__(self, cfgfile):
+        self.cfgfile = cfgfile
+        self._cfg = None
+
+
+    def _load(self):
+        """parse config once
+        """
+        if self._cfg is None:
+            with open(self.cfgfile, 'r') as stream:
+                try:
+                    self._cfg = yaml.load(stream, Loader=YamlLoader)
+                except yaml.YAMLError:
+                    logger.fatal("Error in loading %s", self.cfgfile)
+                    raise
+        return self._cfg
+
+
+    def __getitem__(self, key):
+        return self._load()[key]
+
+
+    def __iter__(self):
+        return iter(self._load())
+
+
+    def __len__(self):
+        return len(self._load())
+
+
+    def __repr__(self):
+        if self._cfg is None:
+            return "{}({!r})".format(self.__class__.__name__, self.cfgfile)
+        return repr(self._cfg)
+
+
+site_cfg = LazyConfig(SITE_CFG_FILE)
+rest_services = LazyConfig(REST_CFG_FILE)
+bcl2fastq_qc_conf = LazyConfig(BCL2FASTQQC_CFG_FILE)
+mongo_conns = LazyConfig(MONGO_CFG_FILE)
+legacy_mapper = LazyConfig(LEGACY_MAPPER_CFG_FILE)
+novogene_conf = LazyConfig(NOVOGENE_CFG_FILE)
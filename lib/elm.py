@@ -0,0 +1,185 @@
+"""Client for the ELM REST services (see rest_services in config)
+
+Connections are kept alive and shared per process, requests time out
+and are retried with backoff on connection errors and server errors.
+Responses are cached per process for a limited time and optionally on
+disk (e.g. for dry runs).
+"""
+
+#--- standard library imports
+#
+import os
+import time
+import logging
+import hashlib
+import threading
+
+#--- third-party imports
+#
+import requests
+
+#--- project specific imports
+#
+from config import rest_services
+from utils import load_json_cache
+from utils import save_json_cache
+
+
+__author__ = "Andreas Wilm"
+__email__ = "wilma@gis.a-star.edu.sg"
+__copyright__ = "2017 Genome Institute of Singapore"
+__license__ = "The MIT License (MIT)"
+
+
+# connect and read timeout in seconds
+DEFAULT_TIMEOUT = (10, 60)
+DEFAULT_RETRIES = 3
+# seconds. doubled with every retry
+DEFAULT_BACKOFF = 1.0
+# seconds responses are cached in process
+DEFAULT_TTL = 300
+DEFAULT_POOLSIZE = 10
+
+RETRY_STATUS_CODES = [500, 502, 503, 504]
+
+
+# global logger
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler()
+handler.setFormatter(logging.Formatter(
+    '[{asctime}] {levelname:8s} {filename} {message}', style='{'))
+logger.addHandler(handler)
+
+
+class ElmClient(object):
+    """Client for ELM REST services. Use get_client() to get the
+    shared instance instead of creating a new one
+    """
+
+    def __init__(self, testing=False,
+                 timeout=DEFAULT_TIMEOUT,
+                 retries=DEFAULT_RETRIES,
+                 backoff=DEFAULT_BACKOFF,
+                 ttl=DEFAULT_TTL,
+                 poolsize=DEFAULT_POOLSIZE,
+                 cachedir=None):
+        """
+        - testing: use testing instead of production services
+        - ttl: seconds responses are cached in process. 0 to disable
+        - cachedir: if set, responses are cached on disk here and
+          cached responses never expire (meant for dry runs)
+        """
+
+        self.server = 'testing' if testing else 'production'
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.ttl = ttl
+        self.cachedir = cachedir
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=poolsize, pool_maxsize=poolsize)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        # url: (time, data)
+        self._cache = dict()
+        self._lock = threading.Lock()
+
+
+    def _disk_cachefile(self, url):
+        """disk cache file for url
+        """
+        return os.path.join(self.cachedir, "{}.json".format(
+            hashlib.md5(url.encode()).hexdigest()))
+
+
+    def _get(self, url):
+        """get url with retries. returns response json
+        """
+        attempt = 0
+        while True:
+            try:
+                response = self.session.get(url, timeout=self.timeout)
+                if response.status_code in RETRY_STATUS_CODES and attempt < self.retries:
+                    raise requests.HTTPError("Status code {}".format(response.status_code))
+                break
+            except (requests.ConnectionError, requests.Timeout, requests.HTTPError) as e:
+                if attempt >= self.retries:
+                    raise
+                wait = self.backoff * 2**attempt
+                logger.warning("Request to %s failed (%s). Retrying in %.1fs", url, e, wait)
+                time.sleep(wait)
+                attempt += 1
+
+        if response.status_code != requests.codes.ok:
+            response.raise_for_status()
+            raise requests.HTTPError("Unexpected status code {} for {}".format(
+                response.status_code, url))
+        return response.json()
+
+
+    def get_json(self, url):
+        """return json data for url, using cached data if possible
+        """
+
+        if self.ttl:
+            with self._lock:
+                cached = self._cache.get(url)
+            if cached and time.time() - cached[0] < self.ttl:
+                logger.debug("Using cached response for %s", url)
+                return cached[1]
+
+        data = None
+        if self.cachedir:
+            data = load_json_cache(self._disk_cachefile(url), url)
+            if data is not None:
+                logger.debug("Using disk cached response for %s", url)
+        if data is None:
+            data = self._get(url)
+            logger.debug("rest_data from %s: %s", url, data)
+            if self.cachedir:
+                try:
+                    os.makedirs(self.cachedir, exist_ok=True)
+                    save_json_cache(self._disk_cachefile(url), url, data)
+                except OSError as e:
+                    logger.warning("Couldn't cache response for %s: %s", url, e)
+
+        if self.ttl:
+            with self._lock:
+                self._cache[url] = (time.time(), data)
+        return data
+
+
+    def run_details(self, run_num):
+        """return run details for run_num (run id without flowcell)
+        """
+        url = rest_services['run_details'][self.server].replace("run_num", run_num)
+        return self.get_json(url)
+
+
+    def lib_details(self, lib_id):
+        """return library details for lib_id (library or MUX id)
+        """
+        url = rest_services['lib_details'][self.server].replace("lib_id", lib_id)
+        return self.get_json(url)
+
+
+# one client per testing state and process. see get_client()
+_CLIENTS = dict()
+_CLIENTS_LOCK = threading.Lock()
+
+
+def get_client(testing=False, **kwargs):
+    """return ElmClient shared within this process. kwargs are passed
+    to ElmClient on first call only. the on-disk cache directory can
+    also be set with the environment variable RPD_ELM_CACHEDIR
+    """
+
+    with _CLIENTS_LOCK:
+        if testing not in _CLIENTS:
+            if 'cachedir' not in kwargs and os.getenv('RPD_ELM_CACHEDIR'):
+                kwargs['cachedir'] = os.getenv('RPD_ELM_CACHEDIR')
+            _CLIENTS[testing] = ElmClient(testing, **kwargs)
+        return _CLIENTS[testing]
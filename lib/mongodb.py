@@ -3,7 +3,9 @@
 
 #--- standard library imports
 #
+import os
 import logging
+import threading
 
 #--- third-party imports
 #
@@ -30,20 +32,267 @@ handler.setFormatter(logging.Formatter(
 logger.addHandler(handler)
 
 
-def mongodb_conn(use_test_server=False):
-    """Return connection to MongoDB server"""
-    if use_test_server:
-        logger.info("Using test MongoDB server")
-        constr = mongo_conns['test']
+# MongoClient options. clients are shared per process (see
+# mongodb_conn()), i.e. the pool is shared between threads
+DEFAULT_CLIENT_OPTS = {
+    'maxPoolSize': 10,
+    'connectTimeoutMS': 10000,
+    'socketTimeoutMS': 60000,
+    'serverSelectionTimeoutMS': 30000,
+}
+
+# projections for runcomplete queries. the analysis array can be huge,
+# so only fetch it if needed
+RUN_ONLY_PROJECTION = {"run": 1, "_id": 0}
+LAST_ANALYSIS_PROJECTION = {"run": 1, "timestamp": 1, "analysis": {"$slice": -1}}
+
+# index hints for runcomplete queries. only used if the index exists
+TIMESTAMP_HINT = [("timestamp", pymongo.ASCENDING)]
+RUN_HINT = [("run", pymongo.ASCENDING)]
+MACHINE_PREFIX_HINT = [("machine_prefix", pymongo.ASCENDING), ("timestamp", pymongo.ASCENDING)]
+
+# indices needed by the cron scanners, which all query a time window.
+# see tools/mongo_indexes.py for creation
+RUNCOMPLETE_INDEXES = [
+    TIMESTAMP_HINT,
+    RUN_HINT,
+    MACHINE_PREFIX_HINT,
+    [("analysis.Status", pymongo.ASCENDING), ("timestamp", pymongo.ASCENDING)],
+]
+PIPELINE_RUNS_INDEXES = [
+    [("site", pymongo.ASCENDING), ("ctime", pymongo.ASCENDING)],
+    [("run.status", pymongo.ASCENDING), ("ctime", pymongo.ASCENDING)],
+]
+
+# runcomplete field storing the machine prefix of the run id (see
+# machine_prefix()), so that queries don't need unindexable regexes
+MACHINE_PREFIX_FIELD = "machine_prefix"
+MACHINE_PREFIX_LEN = 4
+NOVOGENE_MACHINE_PREFIX = "NG00"
+
+# (pid, use_test_server): MongoClient
+_CLIENTS = dict()
+_CLIENTS_LOCK = threading.Lock()
+# collection full name: list of index keys
+_INDEX_KEYS = dict()
+
+
+def mongodb_conn(use_test_server=False, **client_opts):
+    """Return connection to MongoDB server. The client (and its
+    connection pool) is shared within this process. client_opts
+    override DEFAULT_CLIENT_OPTS on first call only. Returns None if
+    the connection failed
+    """
+    # MongoClient is not fork-safe, hence pid as part of the key
+    key = (os.getpid(), use_test_server)
+    with _CLIENTS_LOCK:
+        if key in _CLIENTS:
+            return _CLIENTS[key]
+
+        if use_test_server:
+            logger.info("Using test MongoDB server")
+            constr = mongo_conns['test']
+        else:
+            logger.info("Using production MongoDB server")
+            constr = mongo_conns['production']
+        opts = dict(DEFAULT_CLIENT_OPTS)
+        opts.update(client_opts)
+
+        try:
+            connection = pymongo.MongoClient(constr, **opts)
+        except pymongo.errors.ConnectionFailure:
+            logger.fatal("Could not connect to the MongoDB server")
+            return None
+        logger.debug("Database connection established")
+        _CLIENTS[key] = connection
+        return connection
+
+
+def has_index(collection, keys):
+    """Return True if collection has an index on keys (list of (key,
+    direction) tuples). Indices are looked up once per process
+    """
+    name = collection.full_name
+    if name not in _INDEX_KEYS:
+        try:
+            _INDEX_KEYS[name] = [list(v['key'])
+                                 for v in collection.index_information().values()]
+        except pymongo.errors.PyMongoError as e:
+            logger.warning("Couldn't get index information for %s: %s", name, e)
+            return False
+    return [tuple(k) for k in keys] in [[tuple(k) for k in v] for v in _INDEX_KEYS[name]]
+
+
+def machine_prefix(run_num):
+    """Return machine prefix of run id, e.g. HS00 for HS004-PE-R00138_AC6A7EANXX
+    """
+    return run_num[:MACHINE_PREFIX_LEN]
+
+
+def machine_prefix_query(prefix, exclude=False, include_missing=False):
+    """Return query (to be merged into a runcomplete query) matching
+    runs with (or, if exclude is set, without) given machine prefix.
+    Relies on the stored machine prefix, so call set_machine_prefix()
+    for the queried window first. If that's not possible (e.g. dry
+    run), use include_missing to match runs without stored machine
+    prefix on run id instead (slower, since no index can be used)
+    """
+    assert len(prefix) == MACHINE_PREFIX_LEN
+    if exclude:
+        stored = {MACHINE_PREFIX_FIELD: {"$exists": True, "$ne": prefix}}
+        legacy = {"run": {"$regex": "^((?!{}).)*$".format(prefix)}}
     else:
-        logger.info("Using production MongoDB server")
-        constr = mongo_conns['production']
+        stored = {MACHINE_PREFIX_FIELD: prefix}
+        legacy = {"run": {"$regex": "^{}".format(prefix)}}
+    if not include_missing:
+        return stored
+    legacy[MACHINE_PREFIX_FIELD] = {"$exists": False}
+    return {"$or": [stored, legacy]}
+
+
+def set_machine_prefix(collection, query=None, dry_run=False):
+    """Set machine prefix field for runcomplete records matching query
+    (e.g. the time window of a scanner) that are missing it, e.g.
+    because they were created outside the pipelines. Returns number of
+    records missing it
+    """
+    query = dict(query) if query else dict()
+    query[MACHINE_PREFIX_FIELD] = {"$exists": False}
+    query.setdefault("run", {"$exists": True})
+    ops = []
+    for record in collection.find(query, {"run": 1}):
+        ops.append(pymongo.UpdateOne({"_id": record["_id"]}, {"$set": {
+            MACHINE_PREFIX_FIELD: machine_prefix(record["run"])}}))
+    if ops:
+        logger.info("Setting %s for %d records", MACHINE_PREFIX_FIELD, len(ops))
+        if not dry_run:
+            collection.bulk_write(ops, ordered=False)
+    return len(ops)
+
+
+def find_projected(collection, query, projection, hint=None, sort=None, limit=0):
+    """Wrapper for collection.find() enforcing a projection. hint is
+    applied if the index exists. Returns a cursor
+    """
+    if not projection:
+        raise ValueError("Projection required")
+    cursor = collection.find(query, projection)
+    if hint and has_index(collection, hint):
+        cursor = cursor.hint(hint)
+    if sort:
+        cursor = cursor.sort(sort)
+    if limit:
+        cursor = cursor.limit(limit)
+    return cursor
+
+
+def per_mux_status_entry(mux_id, mux_dir, status):
+    """Return per MUX status entry as pushed to runcomplete analysis
+    """
+    entry = {"mux_id" : mux_id,
+             "mux_dir" : mux_dir,
+             "Status" : status}
+    if status == "SUCCESS":
+        entry.update({"StatsSubmission" : "TODO",
+                      "ArchiveSubmission" : "TODO",
+                      "DownstreamSubmission" : "TODO",
+                      "email_sent" : False})
+    elif status == "FAILED":
+        entry.update({"email_sent" : False})
+    elif status == "NOARCHIVE":
+        entry.update({"StatsSubmission" : "NOARCHIVE",
+                      "ArchiveSubmission" : "NOARCHIVE",
+                      "DownstreamSubmission" : "TODO",
+                      "email_sent" : True})
+    else:
+        raise ValueError(status)
+    return entry
+
+
+def update_run_status(db, run_num, analysis_id, status, outdir,
+                      user_name, end_time=None, dry_run=False):
+    """Set analysis status for run in runcomplete collection db.
+    STARTED and SEQRUNFAILED add a new analysis, SUCCESS and FAILED
+    finalize an existing one (requires end_time). Returns True on success
+    """
+
+    logger.info("Status for %s is %s", run_num, status)
+    if status in ["STARTED", "SEQRUNFAILED"]:
+        query = {"run": run_num}
+        update = {"$push":
+                  {"analysis": {
+                      "analysis_id" : analysis_id,
+                      "user_name" : user_name,
+                      "out_dir" : outdir,
+                      "Status" :  status,
+                  }},
+                  "$set": {MACHINE_PREFIX_FIELD: machine_prefix(run_num)}}
+    elif status in ["SUCCESS", "FAILED"]:
+        assert end_time
+        query = {"run": run_num, 'analysis.analysis_id' : analysis_id}
+        update = {"$set":
+                  {"analysis.$": {
+                      "analysis_id" : analysis_id,
+                      "end_time" : end_time,
+                      "user_name" : user_name,
+                      "out_dir" : outdir,
+                      "Status" :  status,
+                  },
+                   MACHINE_PREFIX_FIELD: machine_prefix(run_num)}}
+    else:
+        raise ValueError(status)
+
+    if dry_run:
+        return True
+    try:
+        res = db.update_one(query, update)
+        assert res.modified_count == 1, (
+            "Modified {} documents instead of 1".format(res.modified_count))
+    except (pymongo.errors.PyMongoError, AssertionError) as e:
+        # includes connection errors: caller keeps going with other runs
+        logger.fatal("MongoDB update failure while setting run %s analysis_id %s to %s: %s",
+                     run_num, analysis_id, status, e)
+        return False
+    return True
+
+
+def update_mux_statuses(db, run_num, analysis_id, mux_statuses, dry_run=False):
+    """Add per MUX status for all (mux_id, mux_dir, status) tuples in
+    mux_statuses to analysis of run in runcomplete collection db. All
+    updates are sent in one unordered bulk write. Failed updates are
+    retried in order one by one. Returns list of mux_ids that couldn't
+    be updated
+    """
+
+    query = {"run": run_num, 'analysis.analysis_id' : analysis_id}
+    ops = [pymongo.UpdateOne(query, {"$push": {
+        "analysis.$.per_mux_status": per_mux_status_entry(mux_id, mux_dir, status)}})
+           for (mux_id, mux_dir, status) in mux_statuses]
+    if dry_run or not ops:
+        return []
 
     try:
-        connection = pymongo.MongoClient(constr)
-    except pymongo.errors.ConnectionFailure:
-        logger.fatal("Could not connect to the MongoDB server")
-        return None
-    logger.debug("Database connection established")
-    return connection
+        db.bulk_write(ops, ordered=False)
+        return []
+    except pymongo.errors.BulkWriteError as e:
+        failed_idx = sorted(err['index'] for err in e.details.get('writeErrors', []))
+        logger.warning("Bulk MUX update for run %s analysis %s failed for %d of %d MUXes."
+                       " Retrying these one by one", run_num, analysis_id,
+                       len(failed_idx), len(ops))
+    except pymongo.errors.PyMongoError as e:
+        # nothing known about what was written. $push isn't idempotent,
+        # so don't retry
+        logger.fatal("Bulk MUX update for run %s analysis %s failed: %s",
+                     run_num, analysis_id, e)
+        return [mux_id for (mux_id, _, _) in mux_statuses]
 
+    failed = []
+    for i in failed_idx:
+        mux_id = mux_statuses[i][0]
+        try:
+            db.bulk_write([ops[i]], ordered=True)
+        except pymongo.errors.PyMongoError:
+            logger.fatal("MongoDB update failure while setting MUX %s of run %s analysis %s",
+                         mux_id, run_num, analysis_id)
+            failed.append(mux_id)
+    return failed
@@ -8,8 +8,6 @@ import sys
 import subprocess
 import logging
 import shutil
-import smtplib
-from email.mime.text import MIMEText
 from getpass import getuser
 #import socket
 import time
@@ -21,21 +19,26 @@ import tarfile
 import glob
 import argparse
 import copy
-from collections import deque
+import functools
+import hashlib
 
 #--- third-party imports
 #
 import yaml
-import requests
-import dateutil.relativedelta
+# elm (requests), dateutil and smtplib are imported where needed to
+# keep importing this module cheap
 
 #--- project specific imports
 #
 from config import site_cfg
-from config import rest_services
 from utils import generate_timestamp
-from utils import chroms_and_lens_from_fasta
+from utils import load_json_cache
+from utils import save_json_cache
+from utils import replace_vars
+from utils import fasta_meta
 from utils import bed_and_fa_are_compat
+from utils import reverse_lines
+from regionclusters import balanced_region_clusters
 
 
 __author__ = "Andreas Wilm"
@@ -77,43 +80,108 @@ WORKFLOW_COMPLETION_FLAGFILE = "WORKFLOW_COMPLETE"
 
 DOWNSTREAM_OUTDIR_TEMPLATE = "{basedir}/{user}/{pipelinename}-version-{pipelineversion}/{timestamp}"
 
-
-def snakemake_log_status(log):
+# cache for RPD variables parsed from site init. see get_rpd_vars()
+RPD_VARS_CACHEFILE = os.path.join(PIPELINE_ROOTDIR, ".rpd_vars_cache.json")
+# cache for parsed configs shipped with the pipelines. see
+# load_cfgfile_with_rpd_vars()
+CFG_CACHE_DIR = os.path.join(PIPELINE_ROOTDIR, ".cfg_cache")
+# maximum number of files in CFG_CACHE_DIR. oldest are removed first
+CFG_CACHE_MAX_FILES = 500
+
+# number of lines at end of snakemake log searched for exit status
+SNAKEMAKE_LOG_TAIL_LINES = 60
+# sidecar used by snakemake_log_status()
+SNAKEMAKE_LOG_STATUS_EXT = ".status.json"
+
+
+def _snakemake_log_tail_status(log, stop_offset=0):
+    """Parse at most SNAKEMAKE_LOG_TAIL_LINES lines of log backwards
+    from its end down to byte offset stop_offset. Returns tuple of
+    status, its timestamp, its line distance from end, the last seen
+    timestamp and the number of lines read
     """
-    Return exit status and timestamp (isoformat string) as tuple.
-    Exit status is either "SUCCESS" or "ERROR" or None
-    If exit status is None timestamp will be last seen timestamp or empty and the status unknown
-
-    Parses last lines of log, which could look like
-    [Fri Jun 17 11:13:16 2016] Exiting because a job execution failed. Look above for error message
-    [Fri Jul 15 01:29:12 2016] 17 of 17 steps (100%) done
-    [Thu Nov 10 22:45:27 2016] Nothing to be done.
-    """
-
-    # this is by design a bit fuzzy
-    with open(log) as fh:
-        last_lines = deque(fh, maxlen=60)
-    status = None
-    last_etime = None
-    while last_lines: # iterate from end
-        line = last_lines.pop()
+    status = etime = status_dist = last_etime = None
+    num_lines = 0
+    for line in reverse_lines(log, stop_offset):
+        if num_lines == SNAKEMAKE_LOG_TAIL_LINES:
+            break
+        num_lines += 1
         if "Refusing to overwrite existing log bundle" in line:
             continue
         if line.startswith("["):# time stamp required
             estr = line[1:].split("]")[0]
             try:
                 etime = datetime.strptime(estr, '%a %b %d %H:%M:%S %Y').isoformat()
-            except:
+            except ValueError:
                 continue
             if not last_etime:
                 last_etime = etime# first is last. useful for undefined status
             if 'steps (100%) done' in line or "Nothing to be done" in line:
                 status = "SUCCESS"
-                break
             elif 'Exiting' in line or "Error" in line:
                 status = "ERROR"
+            if status:
+                status_dist = num_lines - 1
                 break
-    return status, etime
+    if not status:
+        etime = None
+    return status, etime, status_dist, last_etime, num_lines
+
+
+def snakemake_log_status(log, use_sidecar=False):
+    """
+    Return exit status and timestamp (isoformat string) as tuple.
+    Exit status is either "SUCCESS" or "ERROR" or None
+    If exit status is None timestamp will be last seen timestamp or empty and the status unknown
+
+    Parses last lines of log, which could look like
+    [Fri Jun 17 11:13:16 2016] Exiting because a job execution failed. Look above for error message
+    [Fri Jul 15 01:29:12 2016] 17 of 17 steps (100%) done
+    [Thu Nov 10 22:45:27 2016] Nothing to be done.
+
+    If use_sidecar is set, the parsed offset and result are stored
+    next to the log, so that repeated calls only parse newly appended
+    lines
+    """
+
+    # this is by design a bit fuzzy
+    if not use_sidecar:
+        status, etime, _, last_etime, _ = _snakemake_log_tail_status(log)
+        return status, etime if status else (last_etime or "")
+
+    sidecar = log + SNAKEMAKE_LOG_STATUS_EXT
+    size = os.path.getsize(log)
+    key = {'log': os.path.abspath(log), 'inode': os.stat(log).st_ino}
+    cached = load_json_cache(sidecar, key)
+    if cached and cached['offset'] > size:
+        # truncated
+        cached = None
+    if cached and cached['offset'] == size:
+        res = cached
+    else:
+        stop_offset = cached['offset'] if cached else 0
+        status, etime, status_dist, last_etime, num_lines = _snakemake_log_tail_status(
+            log, stop_offset)
+        if cached and not status and num_lines < SNAKEMAKE_LOG_TAIL_LINES:
+            # reached old offset: continue with previous result
+            if cached['status'] and \
+               num_lines + cached['status_dist'] < SNAKEMAKE_LOG_TAIL_LINES:
+                status = cached['status']
+                etime = cached['etime']
+                status_dist = num_lines + cached['status_dist']
+            last_etime = last_etime or cached['last_etime']
+        res = {'offset': size, 'status': status, 'etime': etime,
+               'status_dist': status_dist, 'last_etime': last_etime}
+        # only store offsets at line boundaries
+        with open(log, 'rb') as fh:
+            fh.seek(max(size-1, 0))
+            complete = size == 0 or fh.read(1) == b'\n'
+        if complete:
+            try:
+                save_json_cache(sidecar, key, res)
+            except OSError as e:
+                logger.debug("Couldn't save %s: %s", sidecar, e)
+    return res['status'], res['etime'] if res['status'] else (res['last_etime'] or "")
 
 
 def get_downstream_outdir(requestor, pipeline_name, pipeline_version=None):
@@ -213,6 +281,8 @@ class PipelineHandler(object):
             assert os.path.exists(cluster_cfgfile)
         self.cluster_cfgfile = cluster_cfgfile
 
+        self.refresh_rpd_cache = def_args.refresh_rpd_cache
+
         self.pipeline_cfgfile_out = os.path.join(
             self.outdir, self.PIPELINE_CFGFILE)
 
@@ -343,25 +413,14 @@ class PipelineHandler(object):
         """
 
         merged_cfg = dict()
-        rpd_vars = get_rpd_vars()
+        rpd_vars = get_rpd_vars(refresh=self.refresh_rpd_cache)
 
         for cfgkey, cfgfile in [('global', self.params_cfgfile),
                                 ('references', self.refs_cfgfile),
                                 ('modules', self.modules_cfgfile)]:
             if not cfgfile:
                 continue
-            with open(cfgfile) as fh:
-                try:
-                    cfg = dict(yaml.safe_load(fh))
-                except:
-                    logger.fatal("Loading %s failed", cfgfile)
-                    raise
-            # to replace rpd vars the trick is to traverse
-            # dictionary fully and replace all instances
-            dump = json.dumps(cfg)
-            for k, v in rpd_vars.items():
-                dump = dump.replace("${}".format(k), v)
-            cfg = dict(json.loads(dump))
+            cfg = load_cfgfile_with_rpd_vars(cfgfile, rpd_vars)
             if cfgkey == 'global':
                 merged_cfg.update(cfg)
             else:
@@ -373,8 +432,7 @@ class PipelineHandler(object):
             reffa = merged_cfg['references'].get('genome')
             if reffa:
                 assert 'num_chroms' not in merged_cfg['references']
-                merged_cfg['references']['num_chroms'] = len(list(
-                    chroms_and_lens_from_fasta(reffa)))
+                merged_cfg['references']['num_chroms'] = len(fasta_meta(reffa))
 
         return merged_cfg
 
@@ -390,8 +448,18 @@ class PipelineHandler(object):
         # sanity check: bed only makes sense if we have a reference
         if b:
             f = master_cfg['references'].get('genome')
-            assert bed_and_fa_are_compat(b, f), (
-                "{} not compatible with {}".format(b, f))
+            assert bed_and_fa_are_compat(b, f, check_coords=True), (
+                "{} not compatible with {} (unknown contigs, coordinates"
+                " beyond contig ends or not sorted in reference order)".format(b, f))
+
+        # replace static region clusters with ones balanced for the
+        # available slots (and intervals if given)
+        slots = master_cfg.get('region_cluster_slots')
+        if slots and master_cfg.get('references', {}).get('region_clusters'):
+            master_cfg['references']['region_clusters'] = balanced_region_clusters(
+                master_cfg['references']['genome'], int(slots), b)
+            logger.info("Using %d region clusters balanced for %s slots",
+                        len(master_cfg['references']['region_clusters']), slots)
 
         assert 'ELM' not in master_cfg
         master_cfg['ELM'] = self.elm_data
@@ -523,31 +591,80 @@ def default_argparser(cfg_dir, allow_missing_cfgfile=False, allow_missing_outdir
         cfg_group.add_argument('--{}-cfg'.format(name),
                                default=cfg_file,
                                help="Config-file (yaml) for {}. (default: {})".format(descr, default))
+    cfg_group.add_argument('--refresh-rpd-cache', action='store_true',
+                           help="Advanced: Ignore cached RPD variables and re-read them from site init")
 
     return parser
 
 
-def get_pipeline_version(nospace=False):
-    """determine pipeline version as defined by updir file
+def _git_commit(git_dir):
+    """return commit HEAD in git_dir points to or None. reads refs
+    directly instead of calling git
+    """
+
+    # worktrees and submodules use a file pointing to the actual git dir
+    if os.path.isfile(git_dir):
+        with open(git_dir) as fh:
+            line = fh.readline().strip()
+        if not line.startswith("gitdir:"):
+            return None
+        git_dir = os.path.join(os.path.dirname(git_dir), line[len("gitdir:"):].strip())
+
+    try:
+        with open(os.path.join(git_dir, "HEAD")) as fh:
+            head = fh.readline().strip()
+    except OSError:
+        return None
+    if not head.startswith("ref:"):
+        return head# detached
+    ref = head[len("ref:"):].strip()
+
+    # loose refs take precedence over packed ones. worktrees keep
+    # refs in the common dir
+    git_dirs = [git_dir]
+    commondir_file = os.path.join(git_dir, "commondir")
+    if os.path.exists(commondir_file):
+        with open(commondir_file) as fh:
+            git_dirs.append(os.path.join(git_dir, fh.readline().strip()))
+    for d in git_dirs:
+        try:
+            with open(os.path.join(d, ref)) as fh:
+                return fh.readline().strip()
+        except OSError:
+            pass
+    for d in git_dirs:
+        try:
+            with open(os.path.join(d, "packed-refs")) as fh:
+                for line in fh:
+                    if line.startswith(("#", "^")):
+                        continue
+                    fields = line.split()
+                    if len(fields) == 2 and fields[1] == ref:
+                        return fields[0]
+        except OSError:
+            pass
+    return None
+
+
+@functools.lru_cache(maxsize=None)
+def _pipeline_version():
+    """determine pipeline version once per process. see get_pipeline_version()
     """
     version_file = os.path.abspath(os.path.join(PIPELINE_ROOTDIR, "VERSION"))
     with open(version_file) as fh:
         version = fh.readline().strip()
-    cwd = os.getcwd()
-    os.chdir(PIPELINE_ROOTDIR)
-    if os.path.exists(".git"):
-        commit = None
-        cmd = ['git', 'rev-parse', '--short', 'HEAD']
-        try:
-            res = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
-            commit = res.decode().strip()
-        except (subprocess.CalledProcessError, OSError) as _:
-            pass
-        if commit:
-            version = "{} {}".format(version, commit)
+    commit = _git_commit(os.path.join(PIPELINE_ROOTDIR, ".git"))
+    if commit:
+        version = "{} {}".format(version, commit[:7])
+    return version
+
+
+def get_pipeline_version(nospace=False):
+    """determine pipeline version as defined by updir file
+    """
+    version = _pipeline_version()
     if nospace:
         version = version.replace(" ", "-")
-    os.chdir(cwd)
     return version
 
 
@@ -584,7 +701,22 @@ def get_init_call():
     return cmd
 
 
-def get_rpd_vars():
+def _rpd_vars_cache_key():
+    """key for RPD variables cache: changes if init script, its
+    modification time or testing state change
+    """
+
+    init = site_cfg['init']
+    try:
+        mtime = os.path.getmtime(init)
+    except OSError:
+        mtime = None
+    return {'init': init,
+            'mtime': mtime,
+            'testing': is_devel_version()}
+
+
+def _read_rpd_vars_from_init():
     """Read RPD variables set by calling and parsing output from init
     """
 
@@ -592,8 +724,8 @@ def get_rpd_vars():
     cmd = ' '.join(cmd) + ' && set | grep "^RPD_"'
     try:
         res = subprocess.check_output(cmd, shell=True, stderr=subprocess.STDOUT)
-    except subprocess.CalledProcessError:
-        logger.fatal("Couldn't call init %s. Result was: %s", cmd, res)
+    except subprocess.CalledProcessError as e:
+        logger.fatal("Couldn't call init %s. Result was: %s", cmd, e.output)
         raise
     rpd_vars = dict()
     for line in res.decode().splitlines():
@@ -606,6 +738,96 @@ def get_rpd_vars():
     return rpd_vars
 
 
+def get_rpd_vars(refresh=False, cachefile=RPD_VARS_CACHEFILE):
+    """Return RPD variables set by site init
+
+    Calling init requires a shell, which is slow, so values are cached
+    in cachefile. The cache is invalidated if init path, its mtime or
+    the testing state (see get_init_call()) change. Use refresh to
+    force re-reading.
+    """
+
+    key = _rpd_vars_cache_key()
+    if key['mtime'] is None:
+        return _read_rpd_vars_from_init()
+    if not refresh:
+        rpd_vars = load_json_cache(cachefile, key)
+        if rpd_vars is not None:
+            return rpd_vars
+        logger.debug("No usable RPD vars cache found in %s", cachefile)
+
+    rpd_vars = _read_rpd_vars_from_init()
+    try:
+        save_json_cache(cachefile, key, rpd_vars)
+    except OSError as e:
+        logger.warning("Couldn't write RPD vars cache %s: %s", cachefile, e)
+    return rpd_vars
+
+
+def _is_json_safe(obj):
+    """check whether obj survives a json round trip unchanged, e.g.
+    no dates and no non-string keys
+    """
+    try:
+        return json.loads(json.dumps(obj)) == obj
+    except (TypeError, ValueError):
+        return False
+
+
+def _prune_cache_dir(cachedir, max_files):
+    """remove oldest json files in cachedir, so that at most max_files remain
+    """
+    cachefiles = glob.glob(os.path.join(cachedir, "*.json"))
+    if len(cachefiles) <= max_files:
+        return
+    cachefiles.sort(key=lambda f: os.path.getmtime(f) if os.path.exists(f) else 0)
+    for f in cachefiles[:len(cachefiles) - max_files]:
+        try:
+            os.unlink(f)
+        except OSError:
+            pass
+
+
+def load_cfgfile_with_rpd_vars(cfgfile, rpd_vars, cachedir=CFG_CACHE_DIR,
+                               max_cachefiles=CFG_CACHE_MAX_FILES):
+    """Parse yaml cfgfile and replace all RPD variables in it. Results
+    for cfgfiles shipped with the pipelines are cached per cfgfile, its
+    mtime and RPD variables, unless they can't be stored as json
+    without change (e.g. dates or non-string keys)
+    """
+
+    cfgfile = os.path.abspath(cfgfile)
+    shipped = os.path.realpath(cfgfile).startswith(
+        os.path.realpath(PIPELINE_ROOTDIR) + os.sep)
+    if shipped:
+        key = {'cfgfile': cfgfile,
+               'mtime': os.path.getmtime(cfgfile),
+               'rpd_vars': hashlib.md5(json.dumps(
+                   rpd_vars, sort_keys=True).encode()).hexdigest()}
+        cachefile = os.path.join(cachedir, "{}.json".format(
+            hashlib.md5(cfgfile.encode()).hexdigest()))
+        cfg = load_json_cache(cachefile, key)
+        if cfg is not None:
+            return cfg
+
+    with open(cfgfile) as fh:
+        try:
+            cfg = dict(yaml.safe_load(fh))
+        except:
+            logger.fatal("Loading %s failed", cfgfile)
+            raise
+    cfg = replace_vars(cfg, rpd_vars)
+
+    if shipped and _is_json_safe(cfg):
+        try:
+            os.makedirs(cachedir, exist_ok=True)
+            save_json_cache(cachefile, key, cfg)
+            _prune_cache_dir(cachedir, max_cachefiles)
+        except (OSError, TypeError, ValueError) as e:
+            logger.warning("Couldn't write config cache %s: %s", cachefile, e)
+    return cfg
+
+
 def isoformat_to_epoch_time(ts):
     """
     Converts ISO8601 format (analysis_id) into epoch time
@@ -621,6 +843,7 @@ def relative_epoch_time(epoch_time1, epoch_time2):
     """
     Relative time difference between two epoch time
     """
+    import dateutil.relativedelta
     dt1 = datetime.fromtimestamp(epoch_time1)
     dt2 = datetime.fromtimestamp(epoch_time2)
     rd = dateutil.relativedelta.relativedelta(dt1, dt2)
@@ -712,6 +935,9 @@ def send_status_mail(pipeline_name, success, analysis_id, outdir,
     - outdir: directory where results are found
     """
 
+    import smtplib
+    from email.mime.text import MIMEText
+
     body = "Pipeline {} (version {}) for {} ".format(
         pipeline_name, get_pipeline_version(), analysis_id)
     if success:
@@ -758,6 +984,8 @@ def send_mail(subject, body, toaddr=None, ccaddr=None,
 
     FIXME make toaddr and ccaddr lists
     """
+    import smtplib
+    from email.mime.text import MIMEText
 
     body += "\n"
     body += "\n\nThis is an automatically generated email\n"
@@ -825,15 +1053,9 @@ def path_to_url(out_path):
 def mux_to_lib(mux_id, testing=False):
     """returns the component libraries for MUX
     """
+    from elm import get_client
     lib_list = []
-    if not testing:
-        rest_url = rest_services['lib_details']['production'].replace("lib_id", mux_id)
-    else:
-        rest_url = rest_services['lib_details']['testing'].replace("lib_id", mux_id)
-    response = requests.get(rest_url)
-    if response.status_code != requests.codes.ok:
-        response.raise_for_status()
-    rest_data = response.json()
+    rest_data = get_client(testing).lib_details(mux_id)
     if 'plexes' not in rest_data:
         logger.fatal("FATAL: plexes info for %s is not available in ELM \n", mux_id)
         sys.exit(1)
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+"""Profile a command via /proc: runs the command and samples I/O, CPU
+and RSS summed over the command's process tree at intervals into a
+TSV timeseries. Exits with the command's exit status.
+
+Example:
+procprofile.py -o bcl2fastq.profile.tsv -- bcl2fastq ...
+"""
+
+#--- standard library imports
+#
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import threading
+import signal
+import subprocess
+from collections import OrderedDict
+
+#--- third-party imports
+#
+#/ should be none, to be callable from any job with python3 without problem
+
+#--- project specific imports
+#
+#/
+
+
+__author__ = "Andreas Wilm"
+__email__ = "wilma@gis.a-star.edu.sg"
+__copyright__ = "2017 Genome Institute of Singapore"
+__license__ = "The MIT License (MIT)"
+
+
+PROFILE_EXT = ".profile.tsv"
+PROFILE_COLUMNS = ['secs', 'procs', 'cpu_secs', 'rss_mb', 'read_mb', 'write_mb']
+DEFAULT_INTERVAL = 10
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+MB = 1024.0**2
+
+
+# global logger
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler()
+handler.setFormatter(logging.Formatter(
+    '[{asctime}] {levelname:8s} {filename} {message}', style='{'))
+logger.addHandler(handler)
+
+
+def proc_stat(pid):
+    """return (ppid, starttime, cpu secs, rss bytes) of pid from
+    /proc/<pid>/stat
+    """
+    with open("/proc/{}/stat".format(pid)) as fh:
+        stat = fh.read()
+    # comm (2nd field) may contain spaces and is enclosed in brackets
+    fields = stat[stat.rindex(')')+2:].split()
+    # fields now start at 3rd (state). see proc(5)
+    ppid = int(fields[1])
+    cpu_secs = (int(fields[11]) + int(fields[12])) / float(CLOCK_TICKS)
+    starttime = int(fields[19])
+    rss = int(fields[21]) * PAGE_SIZE
+    return ppid, starttime, cpu_secs, rss
+
+
+def proc_io(pid):
+    """return (read bytes, write bytes) of pid from /proc/<pid>/io,
+    i.e. what actually hit the storage layer. (0, 0) if not accessible
+    """
+    read_bytes = write_bytes = 0
+    try:
+        with open("/proc/{}/io".format(pid)) as fh:
+            for line in fh:
+                key, val = line.split(":")
+                if key == "read_bytes":
+                    read_bytes = int(val)
+                elif key == "write_bytes":
+                    write_bytes = int(val)
+    except (IOError, OSError):
+        pass
+    return read_bytes, write_bytes
+
+
+def process_tree(root_pid):
+    """return dict of pid: stat (see proc_stat()) for root_pid and
+    all its descendants
+    """
+    stats = dict()
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            stats[int(entry)] = proc_stat(entry)
+        except (IOError, OSError, ValueError):
+            # gone in the meantime
+            continue
+    children = dict()
+    for pid, stat in stats.items():
+        children.setdefault(stat[0], []).append(pid)
+    tree = dict()
+    todo = [root_pid]
+    while todo:
+        pid = todo.pop()
+        if pid in stats:
+            tree[pid] = stats[pid]
+        todo.extend(children.get(pid, []))
+    return tree
+
+
+class ProcessTreeSampler(object):
+    """Samples CPU, RSS and I/O of a process tree in a background
+    thread. Counters of processes are kept after they exited, so that
+    totals are cumulative (minus their last interval)
+    """
+
+    def __init__(self, root_pid, interval=DEFAULT_INTERVAL):
+        self.root_pid = root_pid
+        self.interval = interval
+        self.samples = []
+        # last counters per (pid, starttime): cpu_secs, read, write
+        self._counters = dict()
+        self._start = time.time()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+
+    def sample(self):
+        """take one sample"""
+        rss = 0
+        tree = process_tree(self.root_pid)
+        for pid, (_, starttime, cpu_secs, proc_rss) in tree.items():
+            self._counters[(pid, starttime)] = (cpu_secs,) + proc_io(pid)
+            rss += proc_rss
+        totals = [sum(c[i] for c in self._counters.values()) for i in range(3)]
+        self.samples.append((int(round(time.time() - self._start)), len(tree),
+                             round(totals[0], 1), round(rss/MB, 1),
+                             round(totals[1]/MB, 1), round(totals[2]/MB, 1)))
+
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.sample()
+            self._stop.wait(self.interval)
+
+
+    def start(self):
+        """start sampling"""
+        self._thread.start()
+
+
+    def stop(self):
+        """stop sampling"""
+        self._stop.set()
+        self._thread.join()
+
+
+    def write(self, tsv):
+        """write samples to tsv"""
+        with open(tsv, 'w') as fh:
+            fh.write("\t".join(PROFILE_COLUMNS) + "\n")
+            for s in self.samples:
+                fh.write("\t".join(str(x) for x in s) + "\n")
+
+
+def read_profile(tsv):
+    """return samples in tsv as list of dicts"""
+    samples = []
+    with open(tsv) as fh:
+        header = fh.readline().rstrip("\n").split("\t")
+        for line in fh:
+            samples.append(dict(zip(header, [float(x) for x in line.split("\t")])))
+    return samples
+
+
+def summarize_profile(tsv):
+    """return summary dict of timeseries in tsv"""
+    samples = read_profile(tsv)
+    summary = OrderedDict()
+    if not samples:
+        return summary
+    last = samples[-1]
+    secs = last['secs']
+    summary['wallclock_secs'] = secs
+    summary['cpu_secs'] = last['cpu_secs']
+    summary['cpu_util'] = round(last['cpu_secs']/secs, 2) if secs else None
+    summary['max_procs'] = int(max(s['procs'] for s in samples))
+    summary['max_rss_mb'] = max(s['rss_mb'] for s in samples)
+    summary['read_mb'] = last['read_mb']
+    summary['write_mb'] = last['write_mb']
+    summary['read_mb_per_sec'] = round(last['read_mb']/secs, 1) if secs else None
+    summary['write_mb_per_sec'] = round(last['write_mb']/secs, 1) if secs else None
+    return summary
+
+
+def write_run_profile_summary(tsvs, outfile, basedir=None):
+    """roll up profiles into a json summary with one entry per profile
+    (keyed by path relative to basedir) and totals
+    """
+    jobs = OrderedDict()
+    for tsv in sorted(tsvs):
+        key = os.path.relpath(tsv, basedir) if basedir else tsv
+        jobs[key] = summarize_profile(tsv)
+    totals = OrderedDict()
+    for k in ['wallclock_secs', 'cpu_secs', 'read_mb', 'write_mb']:
+        totals[k] = round(sum(j.get(k, 0) for j in jobs.values()), 1)
+    totals['max_rss_mb'] = max([j.get('max_rss_mb', 0) for j in jobs.values()] + [0])
+    with open(outfile, 'w') as fh:
+        json.dump(OrderedDict([('totals', totals), ('jobs', jobs)]), fh, indent=2)
+
+
+def main():
+    """main function"""
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-o', '--out', required=True,
+                        help="Output timeseries (TSV)")
+    parser.add_argument('-i', '--interval', type=float, default=DEFAULT_INTERVAL,
+                        help="Sampling interval in seconds (default: {})".format(
+                            DEFAULT_INTERVAL))
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+                        help="Increase verbosity")
+    parser.add_argument('-q', '--quiet', action='count', default=0,
+                        help="Decrease verbosity")
+    parser.add_argument('cmd', nargs=argparse.REMAINDER,
+                        help="Command to run (after --)")
+    args = parser.parse_args()
+
+    logger.setLevel(logging.WARN + 10*args.quiet - 10*args.verbose)
+
+    cmd = args.cmd[1:] if args.cmd[:1] == ['--'] else args.cmd
+    if not cmd:
+        parser.error("No command given")
+
+    proc = subprocess.Popen(cmd)
+    # pass on termination (e.g. by scheduler) to command
+    signal.signal(signal.SIGTERM, lambda signum, frame: proc.send_signal(signum))
+    sampler = ProcessTreeSampler(proc.pid, args.interval)
+    sampler.start()
+    try:
+        returncode = proc.wait()
+    finally:
+        sampler.stop()
+        # final sample has no processes left, but keeps totals
+        sampler.sample()
+        try:
+            sampler.write(args.out)
+        except (IOError, OSError) as e:
+            logger.warning("Couldn't write profile to %s: %s", args.out, e)
+    sys.exit(returncode)
+
+
+if __name__ == "__main__":
+    main()
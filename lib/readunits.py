@@ -56,12 +56,10 @@ def gen_rg_lib_id(unit):
 
 
 def get_sample_for_unit(unitname, config):
-    """FIXME:add-doc
+    """return name of sample that readunit unitname belongs to. see
+    ReadUnitIndex
     """
-    for samplename, readunits in config["samples"].items():
-        if unitname in readunits:
-            return samplename
-    raise ValueError(unitname)
+    return readunit_index(config).sample_for_unit(unitname)
 
 
 def gen_rg_pu_id(unit):
@@ -114,6 +112,87 @@ def fastqs_from_unit_as_list(unit):
     return [objectify_remote(x) for x in fqs]
 
 
+class ReadUnitIndex(object):
+    """Lookup tables for samples and readunits as in config (keys
+    'samples' and 'readunits'): unit to sample, sample to units, unit
+    to fastqs and unit to read group fields. Built once, since
+    Snakemake evaluates input functions and params per job, repeatedly
+    during DAG building. Fastqs are kept as given and only turned into
+    remote objects on lookup, so that remote providers are only created
+    for units that are used. Use readunit_index() to get an instance.
+    """
+
+    def __init__(self, samples, readunits):
+        self.sample_units = dict((s, list(units)) for s, units in samples.items())
+        self.unit_sample = dict()
+        for sample, units in samples.items():
+            for unit in units:
+                # first sample wins, as in previous linear scan
+                self.unit_sample.setdefault(unit, sample)
+        self.unit_fastqs = dict()
+        self.unit_rg = dict()
+        for key, unit in readunits.items():
+            self.unit_fastqs[key] = {'fq1': unit['fq1'], 'fq2': unit['fq2']}
+            self.unit_rg[key] = {'rg_id': unit['rg_id'],
+                                 'lib_id': gen_rg_lib_id(unit),
+                                 'pu_id': gen_rg_pu_id(unit),
+                                 'sample': self.unit_sample.get(key)}
+        # memo for unit_paths()
+        self._paths = dict()
+
+
+    def sample_for_unit(self, unit):
+        """return name of sample unit belongs to"""
+        try:
+            return self.unit_sample[unit]
+        except KeyError:
+            raise ValueError(unit)
+
+
+    def units_for_sample(self, sample):
+        """return readunit keys of sample"""
+        return self.sample_units[sample]
+
+
+    def fastqs_for_unit(self, unit):
+        """return fastqs of unit as fastqs_from_unit() would"""
+        return fastqs_from_unit(self.unit_fastqs[unit])
+
+
+    def rg_for_unit(self, unit):
+        """return read group fields of unit as dict with keys rg_id,
+        lib_id, pu_id and sample
+        """
+        return self.unit_rg[unit]
+
+
+    def unit_paths(self, template, sample, **kwargs):
+        """return template formatted for each unit of sample (as
+        {unit}), plus kwargs. same as expand() over the sample's units,
+        but memoized
+        """
+        key = (template, sample, tuple(sorted(kwargs.items())))
+        if key not in self._paths:
+            self._paths[key] = [template.format(unit=unit, **kwargs)
+                                for unit in self.sample_units[sample]]
+        return self._paths[key]
+
+
+# in process cache for readunit_index(). key is id of config. config
+# is kept as well, so that its id can't be reused
+_READUNIT_INDEX_CACHE = dict()
+
+
+def readunit_index(config):
+    """return ReadUnitIndex for config (with keys 'samples' and
+    'readunits'). built once per config
+    """
+    if id(config) not in _READUNIT_INDEX_CACHE:
+        _READUNIT_INDEX_CACHE[id(config)] = (config, ReadUnitIndex(
+            config['samples'], config.get('readunits', {})))
+    return _READUNIT_INDEX_CACHE[id(config)][1]
+
+
 def get_samples_and_readunits_from_cfgfile(cfgfile, raise_off=False):
     """Parse each ReadUnit in cfgfile and return as list
     """
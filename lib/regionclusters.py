@@ -0,0 +1,267 @@
+"""Length balanced region clusters
+
+Region clusters (config['references']['region_clusters']) define the
+shards that HaplotypeCaller, genotyping and MuTect run on. The static
+clusters in the references configs group whole chromosomes, so the
+largest chromosome determines the runtime. Here clusters are derived
+from contig lengths (or the bases covered by config['intervals'] if
+given), with the number of clusters chosen from the available slots
+and large contigs split at gaps (N-runs of the reference, or gaps
+between intervals), so that shards take roughly the same time.
+
+Clusters are contiguous in reference order (pieces are packed in
+order, not first-fit decreasing), because cluster results are
+concatenated in cluster order and have to stay sorted.
+"""
+
+#--- standard library imports
+#
+import os
+import re
+import hashlib
+from bisect import bisect_left
+
+#--- third-party imports
+#
+#/
+
+#--- project specific imports
+#
+from utils import fasta_meta
+from utils import load_bed_intervals
+from utils import load_json_cache
+from utils import save_json_cache
+
+
+__author__ = "Andreas Wilm"
+__email__ = "wilma@gis.a-star.edu.sg"
+__copyright__ = "2017 Genome Institute of Singapore"
+__license__ = "The MIT License (MIT)"
+
+
+# extension for sidecar caching N-runs per contig (see nruns())
+NRUNS_EXT = ".nruns.json"
+# per user cache for N-runs, used if the sidecar can't be written next
+# to the fasta (e.g. read-only reference dir)
+NRUNS_USER_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "rpd", "nruns")
+# only gaps (N-runs or between intervals) at least this long are used
+# as split points, so that padding doesn't make neighbouring shards
+# overlap
+MIN_GAP_LEN = 1000
+# clusters should have at least this weight (bases)
+MIN_CLUSTER_WEIGHT = 1000000
+# large contigs are split into pieces of about cluster weight divided
+# by this, so that packing has some granularity
+PIECES_PER_CLUSTER = 2
+# bytes read at once when scanning for N-runs
+SCAN_CHUNK_SIZE = 8*1024*1024
+
+NRUN_RE = re.compile(b'[Nn]+')
+
+
+def _read_fai(fasta):
+    """return dict of contig: (len, offset, linebases, linewidth)"""
+    fai = {}
+    with open(fasta + ".fai") as fh:
+        for line in fh:
+            name, length, offset, linebases, linewidth = line.split()[:5]
+            fai[name] = (int(length), int(offset), int(linebases), int(linewidth))
+    return fai
+
+
+def scan_nruns(fasta, fai_entry, min_len=MIN_GAP_LEN):
+    """return N-runs of at least min_len as list of (start, end)
+    (zero-based, half-open) for one contig. fai_entry is (len, offset,
+    linebases, linewidth) from the fai
+    """
+    length, offset, linebases, linewidth = fai_entry
+    nbytes = (length // linebases) * linewidth + length % linebases
+    # read whole lines only
+    chunk_size = max(1, SCAN_CHUNK_SIZE // linewidth) * linewidth
+    runs = []
+    pos = 0
+    with open(fasta, 'rb') as fh:
+        fh.seek(offset)
+        while nbytes > 0:
+            data = fh.read(min(chunk_size, nbytes))
+            if not data:
+                break
+            nbytes -= len(data)
+            seq = data.replace(b'\n', b'').replace(b'\r', b'')
+            for m in NRUN_RE.finditer(seq):
+                start, end = pos + m.start(), pos + m.end()
+                if runs and runs[-1][1] == start:
+                    # continued from previous chunk
+                    runs[-1] = (runs[-1][0], end)
+                else:
+                    runs.append((start, end))
+            pos += len(seq)
+    return [(s, e) for s, e in runs if e - s >= min_len]
+
+
+def nruns(fasta, chroms, min_len=MIN_GAP_LEN, user_cachedir=NRUNS_USER_CACHE_DIR):
+    """return dict of chrom: N-runs (see scan_nruns()) for chroms.
+    scanned runs are stored in a sidecar (fasta + NRUNS_EXT), or in
+    user_cachedir if the sidecar can't be written, and reused as long
+    as the fai doesn't change
+    """
+    fasta = os.path.abspath(fasta)
+    fai = fasta + ".fai"
+    stat = os.stat(fai)
+    key = {'mtime': stat.st_mtime, 'size': stat.st_size, 'min_len': min_len}
+    sidecar = fasta + NRUNS_EXT
+    user_cachefile = os.path.join(user_cachedir, "{}.json".format(
+        hashlib.md5(fasta.encode()).hexdigest()))
+    cached = load_json_cache(sidecar, key) or load_json_cache(user_cachefile, key) or {}
+    missing = [c for c in chroms if c not in cached]
+    if missing:
+        fai_entries = _read_fai(fasta)
+        for c in missing:
+            cached[c] = scan_nruns(fasta, fai_entries[c], min_len)
+        try:
+            save_json_cache(sidecar, key, cached)
+        except OSError:
+            try:
+                os.makedirs(user_cachedir, exist_ok=True)
+                save_json_cache(user_cachefile, key, cached)
+            except OSError:
+                pass# just don't cache
+    return dict((c, [tuple(r) for r in cached[c]]) for c in chroms)
+
+
+class Coverage(object):
+    """Bases covered by sorted, merged intervals of one contig
+    """
+
+    def __init__(self, intervals):
+        self.starts = [s for s, _ in intervals]
+        self.ends = [e for _, e in intervals]
+        self.cumsum = [0]
+        for s, e in intervals:
+            self.cumsum.append(self.cumsum[-1] + e - s)
+
+
+    def upto(self, pos):
+        """bases covered before pos"""
+        i = bisect_left(self.ends, pos)
+        covered = self.cumsum[i]
+        if i < len(self.starts) and self.starts[i] < pos:
+            covered += pos - self.starts[i]
+        return covered
+
+
+    def gaps(self, min_len):
+        """yield gaps of at least min_len between intervals as (start, end)"""
+        for end, start in zip(self.ends, self.starts[1:]):
+            if start - end >= min_len:
+                yield (end, start)
+
+
+def split_points(weight_upto, length, gaps, max_piece_weight):
+    """return positions (gap midpoints) at which to split a contig of
+    given length into pieces of at most about max_piece_weight.
+    weight_upto(pos) returns the weight before pos. contigs without
+    gaps are not split
+    """
+    total = weight_upto(length)
+    if total <= max_piece_weight or not gaps:
+        return []
+    num_pieces = -(-total // max_piece_weight)
+    candidates = [(s + e) // 2 for s, e in gaps]
+    cand_weights = [weight_upto(p) for p in candidates]
+    points = []
+    for i in range(1, num_pieces):
+        ideal = total * i // num_pieces
+        j = bisect_left(cand_weights, ideal)
+        # pick closest candidate
+        if j == len(candidates) or (j > 0 and ideal - cand_weights[j-1] < cand_weights[j] - ideal):
+            j -= 1
+        if not points or candidates[j] > points[-1]:
+            points.append(candidates[j])
+    return points
+
+
+def partition(weights, num_parts):
+    """split weights into at most num_parts consecutive groups
+    minimizing the largest group sum (binary search over the capacity
+    with in-order filling). returns list of group sizes
+    """
+    if not weights:
+        return []
+
+    def fill(capacity):
+        sizes = [0]
+        load = 0
+        for w in weights:
+            if sizes[-1] and load + w > capacity:
+                sizes.append(0)
+                load = 0
+            sizes[-1] += 1
+            load += w
+        return sizes
+
+    lo, hi = max(weights), sum(weights)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if len(fill(mid)) <= num_parts:
+            hi = mid
+        else:
+            lo = mid + 1
+    return fill(lo)
+
+
+def balanced_region_clusters(fasta, num_slots, bed=None,
+                             min_cluster_weight=MIN_CLUSTER_WEIGHT):
+    """return region clusters for fasta (samtools faidx'ed) as list of
+    lists of regions (chrom:start-end, one-based, inclusive) as used
+    in config['references']['region_clusters']. At most num_slots
+    clusters are created, each weighing at least min_cluster_weight
+    (if possible). Weight is the contig length, or the number of bases
+    covered by the intervals in bed if given.
+    """
+    assert num_slots > 0
+    meta = fasta_meta(fasta)
+    intervals = load_bed_intervals(bed) if bed else None
+
+    coverage = dict()
+    weights = dict()
+    for chrom, length in meta:
+        if intervals is not None:
+            coverage[chrom] = Coverage(intervals.get(chrom, []))
+            weights[chrom] = coverage[chrom].upto(length)
+        else:
+            weights[chrom] = length
+    total = sum(weights.values())
+    num_clusters = int(max(1, min(num_slots, total // min_cluster_weight)))
+    max_piece_weight = max(1, total // num_clusters // PIECES_PER_CLUSTER)
+
+    large = [c for c, _ in meta if weights[c] > max_piece_weight]
+    if intervals is None:
+        gaps = nruns(fasta, large)
+
+    # pieces in reference order: (chrom, start, end, weight)
+    pieces = []
+    for chrom, length in meta:
+        if chrom in large:
+            if intervals is None:
+                weight_upto = lambda pos: pos
+                chrom_gaps = gaps[chrom]
+            else:
+                weight_upto = coverage[chrom].upto
+                chrom_gaps = list(coverage[chrom].gaps(MIN_GAP_LEN))
+            points = split_points(weight_upto, length, chrom_gaps, max_piece_weight)
+        else:
+            weight_upto = None
+            points = []
+        bounds = [0] + points + [length]
+        for start, end in zip(bounds, bounds[1:]):
+            weight = weight_upto(end) - weight_upto(start) if weight_upto else weights[chrom]
+            pieces.append((chrom, start, end, weight))
+
+    clusters = []
+    offset = 0
+    for size in partition([p[3] for p in pieces], num_clusters):
+        clusters.append(["{}:{}-{}".format(c, s+1, e)
+                         for c, s, e, _ in pieces[offset:offset+size]])
+        offset += size
+    return clusters
@@ -4,6 +4,10 @@
 #--- standard library imports
 #
 import os
+import re
+import json
+import tempfile
+from bisect import bisect_right
 from datetime import datetime
 
 #--- third-party imports
@@ -21,6 +25,9 @@ __copyright__ = "2016 Genome Institute of Singapore"
 __license__ = "The MIT License (MIT)"
 
 
+# extension for fai sidecar used by fasta_meta()
+FASTA_META_EXT = ".meta.json"
+
 
 def generate_timestamp():
     """generate ISO8601 timestamp incl microsends, but with colons
@@ -38,6 +45,95 @@ def timestamp_from_string(analysis_id):
 
 
 
+def load_json_cache(cachefile, key):
+    """return data stored in json cachefile if it was stored with the
+    same key, otherwise None (also if cachefile is missing or unreadable)
+    """
+    try:
+        with open(cachefile) as fh:
+            cache = json.load(fh)
+        if cache.get('key') == key:
+            return cache['data']
+    except (OSError, ValueError, KeyError, AttributeError):
+        pass
+    return None
+
+
+def save_json_cache(cachefile, key, data):
+    """store data and key in json cachefile. written to a temporary file
+    first and then renamed, so that concurrent readers never see a
+    partial file. raises OSError on failure and TypeError or ValueError
+    if data can't be serialized
+    """
+    fd, tmpfile = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(cachefile)), suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'w') as fh:
+            json.dump({'key': key, 'data': data}, fh)
+        os.chmod(tmpfile, 0o644)
+        os.replace(tmpfile, cachefile)
+    except BaseException:
+        if os.path.exists(tmpfile):
+            os.unlink(tmpfile)
+        raise
+
+
+def reverse_lines(filename, stop_offset=0, blocksize=65536):
+    """yield lines of filename (without line ending) from last to first.
+    file is read blockwise from the end, so reading the last lines of
+    a huge file is cheap. stops at byte offset stop_offset, which
+    should be the start of a line
+    """
+    with open(filename, 'rb') as fh:
+        pos = fh.seek(0, os.SEEK_END)
+        rest = b''
+        at_eof = True
+        while pos > stop_offset:
+            size = min(blocksize, pos - stop_offset)
+            pos -= size
+            fh.seek(pos)
+            lines = (fh.read(size) + rest).split(b'\n')
+            # first piece might be incomplete: keep for next block
+            rest = lines.pop(0)
+            if at_eof and lines and lines[-1] == b'':
+                lines.pop()
+            at_eof = False
+            for line in reversed(lines):
+                yield line.decode(errors='replace')
+        if rest or not at_eof:
+            yield rest.decode(errors='replace')
+
+
+def replace_vars(obj, varmap, prefix="$"):
+    """return copy of obj (nested dicts, lists and strings) with all
+    occurences of prefix+variable name in strings replaced by their
+    value in varmap. this is done in one pass with longer names taking
+    precedence, so $VAR_EXTRA is not mistaken for $VAR
+
+    >>> replace_vars({'a': ['$X/1', '$XY/2'], 'b': 3}, {'X': 'x', 'XY': 'xy'})
+    {'a': ['x/1', 'xy/2'], 'b': 3}
+    """
+
+    if not varmap:
+        return obj
+    names = sorted(varmap.keys(), key=len, reverse=True)
+    var_re = re.compile("|".join(re.escape(prefix + n) for n in names))
+    lookup = dict((prefix + k, v) for k, v in varmap.items())
+
+    def _replace(o):
+        if isinstance(o, str):
+            if prefix not in o:
+                return o
+            return var_re.sub(lambda m: lookup[m.group(0)], o)
+        elif isinstance(o, dict):
+            return dict((_replace(k), _replace(v)) for k, v in o.items())
+        elif isinstance(o, list):
+            return [_replace(x) for x in o]
+        return o
+
+    return _replace(obj)
+
+
 def parse_regions_from_bed(bed):
     """yields regions from bed as three tuple
     """
@@ -51,28 +147,194 @@ def parse_regions_from_bed(bed):
             yield (chrom, start, end)
 
 
-def chroms_and_lens_from_fasta(fasta):
-    """return sequence and their length as two tuple. derived from fai
+def load_bed_intervals(bed):
+    """return intervals in bed as dict with chrom as key and sorted,
+    merged list of (start, end) (zero-based, half-open) as value.
+    overlapping and book-ended intervals are merged
+    """
+
+    unmerged = dict()
+    for chrom, start, end in parse_regions_from_bed(bed):
+        unmerged.setdefault(chrom, []).append((start, end))
+    intervals = dict()
+    for chrom, ivs in unmerged.items():
+        merged = []
+        for start, end in sorted(ivs):
+            if merged and start <= merged[-1][1]:
+                if end > merged[-1][1]:
+                    merged[-1] = (merged[-1][0], end)
+            else:
+                merged.append((start, end))
+        intervals[chrom] = merged
+    return intervals
+
+
+def parse_region(region):
+    """return region string chrom:start-end (one-based, inclusive) as
+    (chrom, start, end) (zero-based, half-open)
+    """
+
+    chrom, startend = region.rsplit(":", 1)
+    start, end = [int(x) for x in startend.split("-")]
+    start -= 1
+    assert start >= 0 and end > start, ("Invalid region {}".format(region))
+    return (chrom, start, end)
+
+
+def write_region_cluster_beds(region_clusters, outbeds, intervals_bed=None, meta=None):
+    """write one bed per region cluster (list of region strings, see
+    parse_region()) to outbeds (same order). if intervals_bed is given,
+    regions are intersected with its intervals. the intervals are
+    loaded once and all clusters are intersected against them via
+    binary search on the sorted, merged intervals. if meta (FastaMeta)
+    is given, regions are checked against it. returns number of bed
+    entries written per cluster, i.e. 0 for empty clusters
+    """
+
+    assert len(region_clusters) == len(outbeds)
+    intervals = load_bed_intervals(intervals_bed) if intervals_bed else None
+    if intervals is not None:
+        interval_ends = dict((c, [e for _, e in ivs]) for c, ivs in intervals.items())
+
+    num_entries = []
+    for regions, outbed in zip(region_clusters, outbeds):
+        entries = []
+        for region in regions:
+            chrom, start, end = parse_region(region)
+            assert meta is None or (chrom in meta and end <= meta.lens[chrom]), (
+                "Region {} not compatible with reference".format(region))
+            if intervals is None:
+                entries.append((chrom, start, end))
+                continue
+            ivs = intervals.get(chrom, [])
+            # first interval ending after start
+            i = bisect_right(interval_ends.get(chrom, []), start)
+            while i < len(ivs) and ivs[i][0] < end:
+                entries.append((chrom, max(start, ivs[i][0]), min(end, ivs[i][1])))
+                i += 1
+        with open(outbed, 'w') as fh:
+            for entry in entries:
+                fh.write("{}\t{}\t{}\n".format(*entry))
+        num_entries.append(len(entries))
+    return num_entries
+
+
+class FastaMeta(object):
+    """Metadata of a samtools faidx'ed fasta: contig names (in order),
+    their lengths and total length. Membership tests are O(1). Use
+    fasta_meta() to get an instance.
+    """
+
+    def __init__(self, chroms, lens):
+        self.chroms = tuple(chroms)
+        self.lens = dict(zip(self.chroms, lens))
+        self.contigs = frozenset(self.chroms)
+        self.total_len = sum(lens)
+        assert len(self.contigs) == len(self.chroms), ("Duplicate contig names")
+
+
+    def __len__(self):
+        return len(self.chroms)
+
+
+    def __contains__(self, chrom):
+        return chrom in self.contigs
+
+
+    def __iter__(self):
+        """yields contigs and their length as two tuple (in order)
+        """
+        for c in self.chroms:
+            yield (c, self.lens[c])
+
+
+# in process cache for fasta_meta(). key is fai and its mtime
+_FASTA_META_CACHE = dict()
+
+
+def fasta_meta(fasta):
+    """return FastaMeta for fasta. derived from fai. parsed fai is
+    stored in a compact sidecar (fai + FASTA_META_EXT) which is reused
+    as long as the fai doesn't change
     """
 
     fai = fasta + ".fai"
     assert os.path.exists(fai), ("{} not indexed".format(fasta))
-    with open(fai) as fh:
-        for line in fh:
-            (s, l) = line.split()[:2]
-            l = int(l)
-            yield (s, l)
+    stat = os.stat(fai)
+    key = {'mtime': stat.st_mtime, 'size': stat.st_size}
+    memo_key = (os.path.abspath(fai), stat.st_mtime, stat.st_size)
+    if memo_key in _FASTA_META_CACHE:
+        return _FASTA_META_CACHE[memo_key]
 
+    sidecar = fai + FASTA_META_EXT
+    data = load_json_cache(sidecar, key)
+    if data is None:
+        chroms, lens = [], []
+        with open(fai) as fh:
+            for line in fh:
+                (s, l) = line.split()[:2]
+                chroms.append(s)
+                lens.append(int(l))
+        data = {'chroms': chroms, 'lens': lens}
+        try:
+            save_json_cache(sidecar, key, data)
+        except OSError:
+            pass# e.g. read-only reference dir. just don't cache
+    meta = FastaMeta(data['chroms'], data['lens'])
+    _FASTA_META_CACHE[memo_key] = meta
+    return meta
 
-def bed_and_fa_are_compat(bed, fasta):
-    """checks whether samtools faidx'ed fasta is compatible with bed file
+
+def chroms_and_lens_from_fasta(fasta):
+    """return sequence and their length as two tuple. derived from fai
+    """
+
+    for (s, l) in fasta_meta(fasta):
+        yield (s, l)
+
+
+def bed_and_fa_are_compat(bed, fasta, check_coords=False):
+    """checks whether samtools faidx'ed fasta is compatible with bed
+    file, i.e. whether all bed contigs are found in fasta. stops at the
+    first unknown contig.
+
+    if check_coords is true, also checks (in the same pass) that end
+    coordinates don't exceed contig lengths and that the bed is sorted
+    (contigs in fasta order and starts ascending per contig)
     """
 
     assert os.path.exists(bed), ("Missing file {}".format(bed))
     assert os.path.exists(fasta), ("Missing fasta index {}".format(fasta))
 
-    bed_sqs = set([c for c, s, e in parse_regions_from_bed(bed)])
-    fa_sqs = [c for c, l in chroms_and_lens_from_fasta(fasta)]
+    meta = fasta_meta(fasta)
+    fa_sqs = meta.contigs
+    if check_coords:
+        order = dict((c, i) for i, c in enumerate(meta.chroms))
 
-    return all([s in fa_sqs for s in bed_sqs])
+    prev_chrom = None
+    prev_start = -1
+    with open(bed) as fh:
+        for line in fh:
+            if line.startswith('#') or not len(line.strip()) or line.startswith('track '):
+                continue
+            if not check_coords:
+                chrom = line.split(None, 1)[0]
+                if chrom != prev_chrom:
+                    if chrom not in fa_sqs:
+                        return False
+                    prev_chrom = chrom
+                continue
 
+            chrom, start, end = line.split()[:3]
+            start, end = int(start), int(end)
+            if chrom != prev_chrom:
+                if chrom not in fa_sqs:
+                    return False
+                if prev_chrom is not None and order[chrom] < order[prev_chrom]:
+                    return False# contigs out of order
+                prev_chrom = chrom
+                prev_start = -1
+            if start < prev_start or end > meta.lens[chrom]:
+                return False
+            prev_start = start
+    return True
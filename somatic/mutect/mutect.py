@@ -90,6 +90,9 @@ def main():
     parser.add_argument('-l', "--bed",
                         help="Bed file listing regions of interest."
                         " Required for WES and targeted sequencing.")
+    parser.add_argument('--region-cluster-slots', type=int,
+                        help="Advanced: Replace the predefined region clusters with up to"
+                        " this many clusters of similar length (or bed coverage)")
     #parser.add_argument('-D', '--dont-mark-dups', action='store_true',
     #                    help="Don't mark duplicate reads")
     parser.add_argument('--normal-bam',
@@ -185,6 +188,7 @@ def main():
 
     cfg_dict['seqtype'] = args.seqtype
     cfg_dict['intervals'] = os.path.abspath(args.bed) if args.bed else None
+    cfg_dict['region_cluster_slots'] = args.region_cluster_slots
     # WARNING: this currently only works because these two are the only members in reference dict
     # Should normally only write to root level
     #cfg_dict['mark_dups'] = not args.dont_mark_dups
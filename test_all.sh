@@ -105,6 +105,17 @@ echo "Done"
 set -e   
 
 
+echo "------------------------------------------------------------"
+echo "Checking import times of lib and wrappers"
+echo "------------------------------------------------------------"
+set +e
+./tools/import_time.py
+if [ $? -ne 0 ]; then
+    echo "ERROR: Import time regression"
+fi
+set -e
+
+
 echo
 echo "*** All tests completed/started"
 
@@ -18,7 +18,12 @@ import subprocess
 #/
 
 #--- project specific imports
-#/
+#
+LIB_PATH = os.path.abspath(
+    os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "lib"))
+if LIB_PATH not in sys.path:
+    sys.path.insert(0, LIB_PATH)
+from utils import reverse_lines
 
 # master log relative to outdir
 MASTERLOG = "snakemake.log"
@@ -164,13 +169,14 @@ def main():
         logger.warning("Master logfile {} not found: job not (yet) running (might be in queue)".format(masterlog))
     else:
         workflow_done = False
-        with open(masterlog) as fh:
-            for line in fh:
-                line = line.rstrip()
-                if line.startswith("["):
-                    if 'steps (100%) done' in line or "Nothing to be done" in line:
-                        print("Workflow completed: {}".format(line))
-                        workflow_done = True
+        # search from end: logs can be huge
+        for line in reverse_lines(masterlog):
+            line = line.rstrip()
+            if line.startswith("["):
+                if 'steps (100%) done' in line or "Nothing to be done" in line:
+                    print("Workflow completed: {}".format(line))
+                    workflow_done = True
+                    break
         if not workflow_done:
             print("Workflow not complete")
 
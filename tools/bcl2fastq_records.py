@@ -29,6 +29,9 @@ if LIB_PATH not in sys.path:
 	sys.path.insert(0, LIB_PATH)
 from pipelines import generate_window, path_to_url
 from mongodb import mongodb_conn
+from mongodb import find_projected
+from mongodb import has_index
+from mongodb import TIMESTAMP_HINT
 
 
 __author__ = "LIEW Jun Xian"
@@ -61,6 +64,17 @@ def instantiate_args():
 	return instance.parse_args()
 
 
+# fields shown in the web view (form_none()). the command line prints
+# whole records and doesn't use it
+RECORDS_PROJECTION = {"run": 1, "timestamp": 1, "raw-delete.Status": 1,
+	"analysis.analysis_id": 1, "analysis.end_time": 1, "analysis.out_dir": 1,
+	"analysis.Status": 1, "analysis.per_mux_status.mux_id": 1,
+	"analysis.per_mux_status.ArchiveSubmission": 1,
+	"analysis.per_mux_status.DownstreamSubmission": 1,
+	"analysis.per_mux_status.StatsSubmission": 1,
+	"analysis.per_mux_status.Status": 1, "analysis.per_mux_status.email_sent": 1}
+
+
 def instantiate_mongo(testing):
 	"""
 	Instantiates MongoDB database object
@@ -135,18 +149,21 @@ def form_post():
 			instance = {}
 			instance["timestamp"] = {"$gte": epoch_initial, "$lt": epoch_final}
 #            instance["analysis"] = {"$exists": True}
-			return form_none(instantiate_mongo(False).find(instance), \
+			return form_none(find_projected(instantiate_mongo(False), instance, \
+				RECORDS_PROJECTION, hint=TIMESTAMP_HINT), \
 				"RUNS FROM " + "-".join(list_from) + " TO " + "-".join(list_to))
 
-	return form_none(instantiate_mongo(False).find({"": ""}))
+	return form_none(find_projected(instantiate_mongo(False), {"": ""}, RECORDS_PROJECTION))
 
 
 @app.route('/')
-def form_none(mongo_results=instantiate_mongo(False).find({"": ""}), nav_caption=""):
+def form_none(mongo_results=None, nav_caption=""):
 	"""
 	Flask callback function for all requests
 	path_to_url: /mnt/projects/userrig/solexa/.. -> rpd/userrig/runs/solexaProjects/..
 	"""
+	if mongo_results is None:
+		mongo_results = find_projected(instantiate_mongo(False), {"": ""}, RECORDS_PROJECTION)
 	result = ""
 	result += ("<script>$(function(){$('.nav_caption').replaceWith('" \
 		+ '<span class="nav_caption">' + nav_caption + "</span>" + "');});</script>")
@@ -317,12 +334,14 @@ def main():
 #        os.system("flask run --host=0.0.0.0")
 		app.run(host="0.0.0.0", port="5000")
 	else:
+		# whole records are printed, so no projection here
+		mongo_found = mongo.find(query)
+		if has_index(mongo, TIMESTAMP_HINT):
+			mongo_found = mongo_found.hint(TIMESTAMP_HINT)
 		if args.arrange:
-			mongo_found = mongo.find(query).sort(list((j[0], 1) if j[1] == "asc" else (j[0], -1) \
+			mongo_found = mongo_found.sort(list((j[0], 1) if j[1] == "asc" else (j[0], -1) \
 				for j in list(zip([i for i in args.arrange if args.arrange.index(i) % 2 == 0], \
 					[i for i in args.arrange if args.arrange.index(i) % 2 == 1]))))
-		else:
-			mongo_found = mongo.find(query)
 
 		for record in mongo_found:
 			result = record
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""Local fake ELM REST server for testing: answers GET requests with
+the content of DATADIR/<last-url-path-component>.json (404 if
+missing). Point the testing URLs in etc/rest.yaml to it, e.g.
+http://localhost:8000/run_details/run_num
+"""
+
+#--- standard library imports
+#
+import os
+import sys
+import logging
+import argparse
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse
+
+#--- third-party imports
+#
+#/
+
+# --- project specific imports
+#
+#/
+
+
+__author__ = "Andreas Wilm"
+__email__ = "wilma@gis.a-star.edu.sg"
+__copyright__ = "2017 Genome Institute of Singapore"
+__license__ = "The MIT License (MIT)"
+
+
+# global logger
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler()
+handler.setFormatter(logging.Formatter(
+    '[{asctime}] {levelname:8s} {filename} {message}', style='{'))
+logger.addHandler(handler)
+
+
+def handler_for_datadir(datadir):
+    """return request handler class serving json files from datadir
+    """
+
+    class FakeElmHandler(BaseHTTPRequestHandler):
+        """serves json files from datadir
+        """
+
+        def do_GET(self):
+            """answer GET request with json file or 404
+            """
+            name = os.path.basename(urlparse(self.path).path.rstrip("/"))
+            jsonfile = os.path.join(datadir, name + ".json")
+            if not name or not os.path.exists(jsonfile):
+                self.send_error(404)
+                return
+            with open(jsonfile, 'rb') as fh:
+                body = fh.read()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.info(format, *args)
+
+    return FakeElmHandler
+
+
+def main():
+    """main function"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-d', '--datadir', required=True,
+                        help="Directory with json files to serve")
+    default = 8000
+    parser.add_argument('-p', '--port', type=int, default=default,
+                        help="Port to listen on (default: {})".format(default))
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+                        help="Increase verbosity")
+    parser.add_argument('-q', '--quiet', action='count', default=0,
+                        help="Decrease verbosity")
+    args = parser.parse_args()
+
+    logger.setLevel(logging.WARN + 10*args.quiet - 10*args.verbose)
+
+    if not os.path.isdir(args.datadir):
+        logger.fatal("Data directory %s does not exist", args.datadir)
+        sys.exit(1)
+
+    server = HTTPServer(('localhost', args.port), handler_for_datadir(args.datadir))
+    logger.info("Serving %s on port %d", args.datadir, args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+if __name__ == "__main__":
+    main()
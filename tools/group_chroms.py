@@ -1,11 +1,21 @@
 #!/usr/bin/env python3
 
 # will group chromosomes into consecutive groups, each not exceeding the length of the biggest chrom overall
+# or, if a number of slots is given, into balanced clusters (see lib/regionclusters.py)
 
 #
 from collections import OrderedDict
 import copy
 import sys
+import os
+
+# add lib dir for this pipeline installation to PYTHONPATH
+LIB_PATH = os.path.abspath(os.path.join(os.path.dirname(
+    os.path.realpath(__file__)), "..", "lib"))
+if LIB_PATH not in sys.path:
+    sys.path.insert(0, LIB_PATH)
+from utils import fasta_meta
+from regionclusters import balanced_region_clusters
 
 __author__ = "Andreas Wilm"
 __email__ = "wilma@gis.a-star.edu.sg"
@@ -13,14 +23,14 @@ __copyright__ = "2017 Genome Institute of Singapore"
 __license__ = "The MIT License (MIT)"
 
 
+def print_clusters(clusters):
+    for regions in clusters:
+        print("- [" + ", ".join(["'{}'".format(r) for r in regions]) + "]")
+
+
 def main(fai):
-    chrom_lens = OrderedDict()
-    with open(fai) as fh:
-        for line in fh:
-            chrom, size, _, _, _ = line.rstrip().split()
-            size = int(size)
-            assert chrom not in chrom_lens
-            chrom_lens[chrom] = size
+    assert fai.endswith(".fai")
+    chrom_lens = OrderedDict(fasta_meta(fai[:-len(".fai")]))
     chrom_lens_backup = copy.deepcopy(chrom_lens)
     maxlen = max(chrom_lens.values())
     
@@ -50,7 +60,13 @@ def main(fai):
 
 
 if __name__ == "__main__":
-    assert len(sys.argv)==2, ("Need fai as input")
+    assert len(sys.argv) in [2, 3, 4], ("Need fai as input (plus optional number of slots and bed)")
     fai = sys.argv[1]
+    if len(sys.argv) > 2:
+        # length (or bed coverage) balanced, splitting large chromosomes at gaps
+        assert fai.endswith(".fai")
+        bed = sys.argv[3] if len(sys.argv) > 3 else None
+        print_clusters(balanced_region_clusters(fai[:-len(".fai")], int(sys.argv[2]), bed))
+        sys.exit(0)
     main(fai)
     sys.stderr.write("WARNING: this only makes sense if the fa file is roughly ordered by size (hg19 for example has chrM first)\n")
@@ -18,6 +18,9 @@ LIB_PATH = os.path.abspath(
 if LIB_PATH not in sys.path:
     sys.path.insert(0, LIB_PATH)
 from mongodb import mongodb_conn
+from mongodb import machine_prefix_query
+from mongodb import set_machine_prefix
+from mongodb import NOVOGENE_MACHINE_PREFIX
 from pipelines import is_production_user
 from pipelines import generate_window
 from pipelines import is_devel_version
@@ -183,8 +186,12 @@ def main():
         sys.exit(1)
     db = connection.gisds.runcomplete
     epoch_present, epoch_back = generate_window(args.win)
-    results = db.find({"run" : {"$regex" : "^((?!NG00).)*$"}, "raw-delete": {"$exists": False},
-                       "timestamp": {"$gt": epoch_back, "$lt": epoch_present}})
+    query = {"raw-delete": {"$exists": False},
+             "timestamp": {"$gt": epoch_back, "$lt": epoch_present}}
+    set_machine_prefix(db, query, dry_run=args.dryrun)
+    query.update(machine_prefix_query(NOVOGENE_MACHINE_PREFIX, exclude=True,
+                                      include_missing=args.dryrun))
+    results = db.find(query)
     LOGGER.info("Looping through %s jobs", results.count())
     trigger = 0
     for record in results:
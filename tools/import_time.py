@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""Measure import time of library modules and pipeline wrappers with
+python -X importtime and fail on regressions, i.e. if modules that are
+meant to be imported lazily are pulled in or if the total import time
+exceeds a threshold. Wrappers are loaded without calling main().
+"""
+
+#--- standard library imports
+#
+import os
+import sys
+import logging
+import glob
+import subprocess
+import argparse
+import ast
+
+#--- third-party imports
+#
+#/
+
+# --- project specific imports
+#
+#/ by design: must run without the pipeline's dependencies
+
+
+__author__ = "Andreas Wilm"
+__email__ = "wilma@gis.a-star.edu.sg"
+__copyright__ = "2017 Genome Institute of Singapore"
+__license__ = "The MIT License (MIT)"
+
+
+LIB_PATH = os.path.abspath(os.path.join(os.path.dirname(
+    os.path.realpath(__file__)), "..", "lib"))
+
+# library modules which must not import any of DEFERRED_IMPORTS at
+# import time
+LIGHT_LIB_MODULES = ['config', 'utils', 'starterflag', 'readunits', 'pipelines']
+DEFERRED_IMPORTS = ['requests', 'dateutil', 'smtplib', 'pymongo']
+
+DEFAULT_MAX_MS = 500
+
+
+# global logger
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler()
+handler.setFormatter(logging.Formatter(
+    '[{asctime}] {levelname:8s} {filename} {message}', style='{'))
+logger.addHandler(handler)
+
+
+def calls_default_argparser(script):
+    """check whether script actually calls default_argparser(),
+    i.e. is a pipeline wrapper. mentions in strings or comments
+    don't count
+    """
+    with open(script) as fh:
+        try:
+            tree = ast.parse(fh.read(), script)
+        except (SyntaxError, ValueError):
+            return False
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Call):
+            func = node.func
+            name = func.id if isinstance(func, ast.Name) else getattr(func, 'attr', None)
+            if name == "default_argparser":
+                return True
+    return False
+
+
+def find_wrappers():
+    """return all pipeline wrapper scripts, i.e. scripts calling the
+    default argparser. this script is never included
+    """
+    rootdir = os.path.join(LIB_PATH, "..")
+    this_script = os.path.realpath(__file__)
+    wrappers = []
+    for pattern in ["*/*.py", "*/*/*.py"]:
+        for f in sorted(glob.glob(os.path.join(rootdir, pattern))):
+            if os.path.realpath(f) == this_script:
+                continue
+            if calls_default_argparser(f):
+                wrappers.append(os.path.normpath(f))
+    return wrappers
+
+
+def importtime(code):
+    """run code with -X importtime and return total time in ms and
+    the set of imported top-level modules. returns None if code
+    failed to run
+    """
+    cmd = [sys.executable, '-X', 'importtime', '-c', code]
+    res = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if res.returncode != 0:
+        logger.warning("Failed to run %s: %s", ' '.join(cmd),
+                       res.stderr.decode().splitlines()[-1:])
+        return None
+    total_us = 0
+    modules = set()
+    for line in res.stderr.decode().splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, _, name = line[len("import time:"):].split("|")
+        total_us += int(self_us)
+        modules.add(name.strip().split(".")[0])
+    return total_us/1000.0, modules
+
+
+def main():
+    """main function"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--max-ms', type=float, default=DEFAULT_MAX_MS,
+                        help="Maximum allowed total import time per"
+                        " module/wrapper in ms (default: {})".format(DEFAULT_MAX_MS))
+    parser.add_argument('wrappers', nargs='*',
+                        help="Wrappers to check (default: all)")
+    args = parser.parse_args()
+
+    targets = []
+    for m in LIGHT_LIB_MODULES:
+        code = "import sys; sys.path.insert(0, {!r}); import {}".format(LIB_PATH, m)
+        targets.append((m, code, True))
+    for w in args.wrappers if args.wrappers else find_wrappers():
+        # mimic 'python3 wrapper', which puts the script's dir first in sys.path
+        code = "import sys, runpy; sys.argv = [{0!r}]; sys.path.insert(0, {1!r});" \
+               " runpy.run_path({0!r})".format(w, os.path.dirname(w))
+        targets.append((w, code, False))
+
+    num_failed = 0
+    for name, code, is_light in targets:
+        res = importtime(code)
+        if res is None:
+            print("SKIPPED: {}".format(name))
+            continue
+        total_ms, modules = res
+        errors = []
+        if total_ms > args.max_ms:
+            errors.append("{:.1f}ms > {:.1f}ms".format(total_ms, args.max_ms))
+        if is_light:
+            deferred = sorted(modules & set(DEFERRED_IMPORTS))
+            if deferred:
+                errors.append("imports {}".format(", ".join(deferred)))
+        if errors:
+            num_failed += 1
+            print("FAILED: {} ({})".format(name, "; ".join(errors)))
+        else:
+            print("OK: {} ({:.1f}ms)".format(name, total_ms))
+
+    if num_failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+"""Create the MongoDB indices needed by the cron scanners, backfill
+the machine prefix field of runcomplete records and show query plans
+of the scanner queries. With --benchmark, compares query plans with
+and without indices on synthetic data in a scratch database of a
+(local) mongod.
+"""
+
+#--- standard library imports
+#
+import os
+import sys
+import logging
+import argparse
+import random
+import time
+
+#--- third-party imports
+#
+import pymongo
+
+#--- project specific imports
+#
+LIB_PATH = os.path.abspath(
+    os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "lib"))
+if LIB_PATH not in sys.path:
+    sys.path.insert(0, LIB_PATH)
+from pipelines import generate_window
+from mongodb import mongodb_conn
+from mongodb import machine_prefix
+from mongodb import set_machine_prefix
+from mongodb import machine_prefix_query
+from mongodb import MACHINE_PREFIX_FIELD
+from mongodb import NOVOGENE_MACHINE_PREFIX
+from mongodb import RUNCOMPLETE_INDEXES
+from mongodb import PIPELINE_RUNS_INDEXES
+
+
+__author__ = "Andreas Wilm"
+__email__ = "wilma@gis.a-star.edu.sg"
+__copyright__ = "2017 Genome Institute of Singapore"
+__license__ = "The MIT License (MIT)"
+
+
+INDEXES = {'runcomplete': RUNCOMPLETE_INDEXES,
+           'pipeline_runs': PIPELINE_RUNS_INDEXES}
+
+DEFAULT_WIN = 34
+DEFAULT_BENCHMARK_URI = "mongodb://localhost:27017"
+BENCHMARK_DB = "rpd_index_benchmark"
+
+
+# global logger
+logger = logging.getLogger(__name__)
+handler = logging.StreamHandler()
+handler.setFormatter(logging.Formatter(
+    '[{asctime}] {levelname:8s} {filename} {message}', style='{'))
+logger.addHandler(handler)
+
+
+def scanner_queries(win=DEFAULT_WIN):
+    """return list of (collection name, description, query) as used by
+    the cron scanners
+    """
+    epoch_present, epoch_back = generate_window(win)
+    runcomplete_win = {"timestamp": {"$gt": epoch_back, "$lt": epoch_present}}
+    pipeline_runs_win = {"ctime": {"$gt": epoch_back, "$lt": epoch_present}}
+
+    queries = []
+    queries.append(('runcomplete', "bcl2fastq_starter/check_elm_run_info",
+                    dict(runcomplete_win, analysis={"$exists": False})))
+    queries.append(('runcomplete', "archive_stats_cronjob/send_email_status",
+                    dict(runcomplete_win, analysis={"$exists": True})))
+    queries.append(('runcomplete', "bcl2fastq_dbupdate",
+                    dict(runcomplete_win, **{"analysis.Status": "STARTED"})))
+    queries.append(('runcomplete', "delegator",
+                    dict(runcomplete_win, **{"analysis.per_mux_status": {"$exists": True}})))
+    query = dict(runcomplete_win, **{"raw-delete": {"$exists": False}})
+    query.update(machine_prefix_query(NOVOGENE_MACHINE_PREFIX, exclude=True))
+    queries.append(('runcomplete', "illumina_raw_delete", query))
+    query = dict(runcomplete_win, **{"raw-delete": {"$exists": False}})
+    query.update(machine_prefix_query(NOVOGENE_MACHINE_PREFIX))
+    queries.append(('runcomplete', "novogene_raw_delete", query))
+    queries.append(('pipeline_runs', "downstream_handler",
+                    dict(pipeline_runs_win, site="GIS")))
+    queries.append(('pipeline_runs', "downstream_dbupdate",
+                    dict(pipeline_runs_win, **{"run.status": "STARTED"})))
+    return queries
+
+
+def create_indexes(db):
+    """create all indices (no-op for existing ones)
+    """
+    for colname, indexes in INDEXES.items():
+        for keys in indexes:
+            name = db[colname].create_index(keys, background=True)
+            logger.info("Index %s on %s", name, colname)
+
+
+def plan_stages(plan):
+    """return all stage names of a query plan
+    """
+    stages = [plan['stage']]
+    for sub in [plan.get('inputStage')] + plan.get('inputStages', []):
+        if sub:
+            stages.extend(plan_stages(sub))
+    return stages
+
+
+def explain(db, colname, query):
+    """return (scan type, keys examined, docs examined, docs returned,
+    ms) for query
+    """
+    res = db.command("explain", {"find": colname, "filter": query},
+                     verbosity="executionStats")
+    stages = plan_stages(res['queryPlanner']['winningPlan'])
+    scan = "IXSCAN" if "IXSCAN" in stages else "COLLSCAN"
+    stats = res['executionStats']
+    return (scan, stats['totalKeysExamined'], stats['totalDocsExamined'],
+            stats['nReturned'], stats['executionTimeMillis'])
+
+
+def print_plans(db, win):
+    """print query plan summary for all scanner queries
+    """
+    fmt = "{:40s} {:10s} {:>10s} {:>10s} {:>10s} {:>8s}"
+    print(fmt.format("query", "scan", "keys", "docs", "returned", "ms"))
+    for colname, name, query in scanner_queries(win):
+        print(fmt.format(name, *[str(x) for x in explain(db, colname, query)]))
+
+
+def populate_benchmark_db(db, num_runs):
+    """fill db with num_runs synthetic runcomplete and pipeline_runs
+    records spread over the last year
+    """
+    now = int(time.time()*1000)
+    year = 365*24*3600*1000
+    prefixes = ["HS00", "MS00", "NS00", NOVOGENE_MACHINE_PREFIX]
+    runs = []
+    jobs = []
+    for i in range(num_runs):
+        timestamp = now - random.randint(0, year)
+        run = "{}{}-PE-R{:05d}_FC{:07d}".format(
+            random.choice(prefixes), random.randint(1, 9), i, i)
+        record = {"run": run, "timestamp": timestamp}
+        # mimic records created before the machine prefix was stored
+        if random.random() < 0.5:
+            record[MACHINE_PREFIX_FIELD] = machine_prefix(run)
+        if random.random() < 0.9:
+            record["analysis"] = [{
+                "analysis_id": str(timestamp), "Status": random.choice(
+                    ["STARTED", "SUCCESS", "FAILED"]),
+                "per_mux_status": [{"mux_id": "MUX{}".format(i), "Status": "SUCCESS"}]}]
+        runs.append(record)
+        jobs.append({"ctime": timestamp, "site": random.choice(["GIS", "NSCC"]),
+                     "run": {"status": random.choice(["STARTED", "SUCCESS"])}})
+    db.runcomplete.insert_many(runs)
+    db.pipeline_runs.insert_many(jobs)
+
+
+def benchmark(uri, num_runs, win, keep=False):
+    """print query plans for synthetic data without and with indices
+    """
+    client = pymongo.MongoClient(uri, serverSelectionTimeoutMS=5000)
+    client.drop_database(BENCHMARK_DB)
+    db = client[BENCHMARK_DB]
+    try:
+        logger.info("Inserting %d synthetic runs into %s", num_runs, BENCHMARK_DB)
+        populate_benchmark_db(db, num_runs)
+        print("Without indices")
+        print_plans(db, win)
+        create_indexes(db)
+        set_machine_prefix(db.runcomplete)
+        print("\nWith indices")
+        print_plans(db, win)
+    finally:
+        if not keep:
+            client.drop_database(BENCHMARK_DB)
+        client.close()
+
+
+def main():
+    """main function"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-t', "--testing", action='store_true',
+                        help="Use MongoDB test server")
+    parser.add_argument('--create', action='store_true',
+                        help="Create missing indices")
+    parser.add_argument('--backfill', action='store_true',
+                        help="Set {} for all runcomplete records missing it (scanners"
+                        " do this for their window automatically)".format(
+                            MACHINE_PREFIX_FIELD))
+    parser.add_argument('--explain', action='store_true',
+                        help="Print query plans of scanner queries")
+    parser.add_argument('--benchmark', type=int, metavar="NUM_RUNS",
+                        help="Compare query plans with and without indices on"
+                        " NUM_RUNS synthetic runs in scratch database {} at"
+                        " --uri".format(BENCHMARK_DB))
+    parser.add_argument('--uri', default=DEFAULT_BENCHMARK_URI,
+                        help="MongoDB URI for --benchmark (default: {})".format(
+                            DEFAULT_BENCHMARK_URI))
+    parser.add_argument('--keep', action='store_true',
+                        help="Don't drop benchmark database")
+    parser.add_argument('-w', '--win', type=int, default=DEFAULT_WIN,
+                        help="Window in days for scanner queries (default: {})".format(
+                            DEFAULT_WIN))
+    parser.add_argument('-n', '--dry-run', action='store_true')
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+                        help="Increase verbosity")
+    parser.add_argument('-q', '--quiet', action='count', default=0,
+                        help="Decrease verbosity")
+    args = parser.parse_args()
+
+    logger.setLevel(logging.WARN + 10*args.quiet - 10*args.verbose)
+
+    if args.benchmark:
+        benchmark(args.uri, args.benchmark, args.win, args.keep)
+        return
+
+    if not any([args.create, args.backfill, args.explain]):
+        parser.error("Nothing to do")
+
+    connection = mongodb_conn(args.testing)
+    if connection is None:
+        sys.exit(1)
+    db = connection.gisds
+    if args.create:
+        if args.dry_run:
+            logger.warning("Skipping index creation in dry-run mode")
+        else:
+            create_indexes(db)
+    if args.backfill:
+        num = set_machine_prefix(db.runcomplete, dry_run=args.dry_run)
+        logger.info("%d records without %s", num, MACHINE_PREFIX_FIELD)
+    if args.explain:
+        print_plans(db, args.win)
+    connection.close()
+
+
+if __name__ == "__main__":
+    main()
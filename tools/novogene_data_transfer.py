@@ -13,7 +13,6 @@ import glob
 #
 import pymongo
 import yaml
-import requests
 
 # project specific imports
 #
@@ -23,6 +22,9 @@ LIB_PATH = os.path.abspath(
 if LIB_PATH not in sys.path:
     sys.path.insert(0, LIB_PATH)
 from mongodb import mongodb_conn
+from mongodb import machine_prefix_query
+from mongodb import set_machine_prefix
+from mongodb import NOVOGENE_MACHINE_PREFIX
 from pipelines import is_production_user
 from pipelines import is_devel_version
 from pipelines import send_mail
@@ -30,7 +32,7 @@ from pipelines import generate_window
 from pipelines import get_machine_run_flowcell_id
 from utils import generate_timestamp
 from config import novogene_conf
-from config import rest_services
+from elm import get_client
 from readunits import readunits_for_sampledir
 
 __author__ = "Lavanya Veeravalli"
@@ -58,12 +60,14 @@ def get_sg10_lib_list(rest_data):
         assert len(set(v)) == 1, ("runMode from {} lanes are not same for {}".format(len(v), k))
     return sg10k_lib_list.keys()
 
-def runs_from_db(connection, testing, win=14):
+def runs_from_db(connection, testing, win=14, dry_run=False):
     """Get the runs from pipeline_run collections"""
     db = connection.gisds.runcomplete
     epoch_present, epoch_back = generate_window(win)
-    results = db.find({"run" : {"$regex" : "^NG00"},
-                       "timestamp": {"$gt": epoch_back, "$lt": epoch_present}})
+    query = {"timestamp": {"$gt": epoch_back, "$lt": epoch_present}}
+    set_machine_prefix(db, query, dry_run=dry_run)
+    query.update(machine_prefix_query(NOVOGENE_MACHINE_PREFIX, include_missing=dry_run))
+    results = db.find(query)
     logger.info("Found %d runs", results.count())
     for record in results:
         run_number = record['run']
@@ -72,14 +76,7 @@ def runs_from_db(connection, testing, win=14):
             continue
         # Check if Novogene run_mode
         _, run_id, _ = get_machine_run_flowcell_id(run_number)
-        if testing:
-            rest_url = rest_services['run_details']['testing'].replace("run_num", run_id)
-        else:
-            rest_url = rest_services['run_details']['production'].replace("run_num", run_id)
-        response = requests.get(rest_url)
-        if response.status_code != requests.codes.ok:
-            response.raise_for_status()
-        rest_data = response.json()
+        rest_data = get_client(testing).run_details(run_id)
         sg10k_lib_list = get_sg10_lib_list(rest_data)
         run_records = {}
         for (analysis_count, analysis) in enumerate(record['analysis']):
@@ -295,7 +292,7 @@ def main():
         mail_to = 'veeravallil'# domain added in mail function
     else:
         mail_to = 'rpd@gis.a-star.edu.sg'
-    run_records = runs_from_db(connection, args.testing, args.win)
+    run_records = runs_from_db(connection, args.testing, args.win, args.dry_run)
     trigger = 0
     for run in run_records:
         for mux, mux_info in run.items():
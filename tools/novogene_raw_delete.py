@@ -16,6 +16,9 @@ LIB_PATH = os.path.abspath(
 if LIB_PATH not in sys.path:
     sys.path.insert(0, LIB_PATH)
 from mongodb import mongodb_conn
+from mongodb import machine_prefix_query
+from mongodb import set_machine_prefix
+from mongodb import NOVOGENE_MACHINE_PREFIX
 from pipelines import generate_window
 from pipelines import is_production_user
 from pipelines import isoformat_to_epoch_time
@@ -39,11 +42,14 @@ HANDLER.setFormatter(logging.Formatter(
     '[{asctime}] {levelname:8s} {filename} {message}', style='{'))
 LOGGER.addHandler(HANDLER)
 
-def runs_from_db(db, days=75, win=34):
+def runs_from_db(db, days=75, win=34, dry_run=False):
     """Get the runs from pipeline_run collections"""
     epoch_present, epoch_back = generate_window(win)
-    results = db.find({"run" : {"$regex" : "^NG00"}, "raw-delete": {"$exists": False},
-                       "timestamp": {"$gt": epoch_back, "$lt": epoch_present}})
+    query = {"raw-delete": {"$exists": False},
+             "timestamp": {"$gt": epoch_back, "$lt": epoch_present}}
+    set_machine_prefix(db, query, dry_run=dry_run)
+    query.update(machine_prefix_query(NOVOGENE_MACHINE_PREFIX, include_missing=dry_run))
+    results = db.find(query)
     LOGGER.info("Found %d runs for last %s days", results.count(), win)
     for record in results:
         LOGGER.debug("record: %s", record)
@@ -155,7 +161,7 @@ def main():
         mail_to = 'veeravallil'# domain added in mail function
     else:
         mail_to = 'rpd'
-    run_records = runs_from_db(db, args.days, args.win)
+    run_records = runs_from_db(db, args.days, args.win, args.dry_run)
     for run in run_records:
         if args.dry_run:
             LOGGER.info("Skipping dryrun option %s", run)
@@ -23,6 +23,10 @@ if LIB_PATH not in sys.path:
     sys.path.insert(0, LIB_PATH)
 from pipelines import generate_window
 from mongodb import mongodb_conn
+from mongodb import find_projected
+from mongodb import LAST_ANALYSIS_PROJECTION
+from mongodb import RUN_ONLY_PROJECTION
+from mongodb import TIMESTAMP_HINT
 
 
 __author__ = "LIEW Jun Xian"
@@ -116,7 +120,8 @@ def check_mongo():
     query = {}
     query["timestamp"] = {"$gte": epoch_window, "$lte": epoch_started}
     query["analysis.Status"] = "STARTED"
-    mongo = mongodb_conn(False).gisds.runcomplete.find(query)
+    db = mongodb_conn(False).gisds.runcomplete
+    mongo = find_projected(db, query, LAST_ANALYSIS_PROJECTION, hint=TIMESTAMP_HINT)
     count_warnings = 0
     for record in mongo:
 #        PrettyPrinter(indent=2).pprint(record)
@@ -129,7 +134,7 @@ def check_mongo():
     query = {}
     query["timestamp"] = {"$gte": epoch_window, "$lte": epoch_started}
     query["analysis"] = {"$exists": False}
-    mongo = mongodb_conn(False).gisds.runcomplete.find(query)
+    mongo = find_projected(db, query, RUN_ONLY_PROJECTION, hint=TIMESTAMP_HINT)
     count_warnings = 0
     for record in mongo:
 #        PrettyPrinter(indent=2).pprint(record)
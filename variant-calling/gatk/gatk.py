@@ -85,6 +85,9 @@ def main():
     parser.add_argument('-l', "--bed",
                         help="Bed file listing regions of interest."
                         " Required for WES and targeted sequencing.")
+    parser.add_argument('--region-cluster-slots', type=int,
+                        help="Advanced: Replace the predefined region clusters with up to"
+                        " this many clusters of similar length (or bed coverage)")
     parser.add_argument('--raw-bam',
                         help="Advanced: Injects raw (pre-dedup, pre-BQSR etc.) BAM (overwrites fq options)."
                         " WARNING: reference needs to match pipeline requirements")
@@ -174,6 +177,7 @@ def main():
     cfg_dict['intervals'] = os.path.abspath(args.bed) if args.bed else None# always safe, might be used for WGS as well
     cfg_dict['mark_dups'] = MARK_DUPS
     cfg_dict['bam_only'] = args.bam_only
+    cfg_dict['region_cluster_slots'] = args.region_cluster_slots
 
     pipeline_handler = PipelineHandler(
         PIPELINE_NAME, PIPELINE_BASEDIR,